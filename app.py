@@ -1,13 +1,20 @@
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 import requests
 import os
+import math
+from datetime import datetime, timedelta
 
-from models import db, connect_db, User, CoinbaseExchangeAuth, Account, Deposit, Currency, TargetAllocation
+from models import db, connect_db, User, Credentials, Account, Deposit, Currency, TargetAllocation
 from forms import UserAddForm, LoginForm, DepositForm, PortfolioForm, OrderForm, TargetAllocationForm
 
 from helpers.helpers import *
+from helpers.snapshots import refresh_user_info, ensure_snapshot, mark_active
+from helpers.history import portfolio_history, parse_timestamp, EPOCH
+from helpers import identity, metrics, signers, ticker
+from helpers.ratelimit import RateLimited
+from helpers.credentials import issue_demo_token, read_demo_token, VerifyTimeout
 
 app = Flask(__name__)
 
@@ -36,13 +43,26 @@ DEMO_PASSPHRASE = os.environ.get("DEMO_PASSPHRASE", 'pass')
 # debug = DebugToolbarExtension(app)
 
 connect_db(app)
+metrics.init_app(app)
 
-CB_DEMO_API_URL = "https://api-public.sandbox.pro.coinbase.com/"
-CB_API_URL = "https://api.pro.coinbase.com/"
+app.app_ctx_globals_class = identity.RequestGlobals
+
+CB_DEMO_API_URL = os.environ.get(
+    "CB_DEMO_API_URL", "https://api-public.sandbox.pro.coinbase.com/")
+CB_API_URL = os.environ.get("CB_API_URL", "https://api.pro.coinbase.com/")
+
+ticker.register_feed(CB_DEMO_API_URL, ticker.CB_DEMO_WS_URL)
+ticker.register_feed(CB_API_URL, ticker.CB_WS_URL)
 
 
 CURR_USER_KEY = "curr_user"
 DEMO = 'demo'
+DEMO_TOKEN = 'demo_token'
+
+DEMO_CREDENTIALS = Credentials(DEMO_API_KEY, DEMO_SECRET, DEMO_PASSPHRASE)
+
+# flashed when a credential check timed out, i.e.: during a burst of logins
+VERIFY_BUSY_MESSAGE = "We're handling a lot of logins right now, please try again in a moment."
 
 ##############################################################################
 # User signup/login/logout
@@ -50,39 +70,44 @@ DEMO = 'demo'
 
 @app.before_request
 def add_to_g():
-    """If we're logged in, add curr user to Flask global.
-    Also check if the user has selected demo mode to use the corresponding creds."""
+    """If we're logged in, add curr user's id to Flask global.
+    Also check if the user has selected demo mode to use the corresponding creds.
+
+    g.user and g.auth are only looked up when a view first uses them (see RequestGlobals)."""
 
     # set default api_url for coinbase pro to real environment
     g.api_url = CB_API_URL
 
-    if CURR_USER_KEY in session and DEMO not in session:
+    g.user_id = session.get(CURR_USER_KEY)
 
-        g.demo = False
+    g.demo = g.user_id is not None and DEMO in session
 
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if g.demo:
 
-        g.auth = g.user.auth
+        # every demo session shares the demo account's signer
+        g.auth = demo_signer()
 
-    else:
+        g.api_url = CB_DEMO_API_URL
 
-        g.user = None
 
-    if CURR_USER_KEY in session and DEMO in session:
+@app.after_request
+def record_activity(response):
+    """Mark users active, if the request looked them up."""
 
-        g.demo = True
+    user = identity.loaded_user()
 
-        g.user = User.query.get_or_404(session[CURR_USER_KEY])
+    if user:
+        mark_active(user)
 
-        g.auth = CoinbaseExchangeAuth(
-            DEMO_API_KEY, DEMO_SECRET, DEMO_PASSPHRASE)
+    return response
 
-        g.api_url = CB_DEMO_API_URL
+
+def demo_signer():
+    return signers.get_signer(DEMO, DEMO_CREDENTIALS)
 
 
 def update_user_info(user_id, auth):
-    update_user_accounts(user_id, auth)
-    update_allocations(user_id)
+    refresh_user_info(user_id, auth)
 
 
 def do_login(user):
@@ -95,6 +120,7 @@ def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
+        identity.forget(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
 
     if DEMO in session:
@@ -103,24 +129,51 @@ def do_logout():
     g.auth = None
 
 
+def log_in_again():
+    """Log out a user whose Coinbase Pro credentials aren't stored, so they can log in again.
+
+    Their requests can't be signed, and Coinbase Pro would only answer them with an error."""
+
+    do_logout()
+
+    flash("Please log in again to reconnect to Coinbase Pro.", "warning")
+    return redirect(url_for('login'))
+
+
 @app.route('/demo')
 def initiate_demo():
 
     g.api_url = CB_DEMO_API_URL
     session[DEMO] = True
 
-    # authenticate the user if the demo account already exists
-    user = User.authenticate(api_key=DEMO_API_KEY, api_secret=DEMO_SECRET,
-                             api_passphrase=DEMO_PASSPHRASE)
+    # returning demo visitors are logged back in by their token, without a bcrypt check
+    user_id = read_demo_token(session.get(DEMO_TOKEN), DEMO_API_KEY)
+    user = user_id and identity.load_user(user_id)
 
-    # create demo user if they don't exist
-    if not user:
-        user = User.signup(api_key=DEMO_API_KEY, api_secret=DEMO_SECRET,
-                           api_passphrase=DEMO_PASSPHRASE)
-    db.session.commit()
+    if not user or user.api_key != DEMO_API_KEY:
+
+        try:
+            # authenticate the user if the demo account already exists
+            user = User.authenticate(api_key=DEMO_API_KEY, api_secret=DEMO_SECRET,
+                                     api_passphrase=DEMO_PASSPHRASE)
+
+            # create demo user if they don't exist
+            if not user:
+                user = User.signup(api_key=DEMO_API_KEY, api_secret=DEMO_SECRET,
+                                   api_passphrase=DEMO_PASSPHRASE)
+
+        except VerifyTimeout:
+            db.session.rollback()
+            del session[DEMO]
+            flash(VERIFY_BUSY_MESSAGE, 'warning')
+            return redirect("/")
+
+        db.session.commit()
+
+        session[DEMO_TOKEN] = issue_demo_token(user)
 
     # use Coinbase Pro auth using the demo creds
-    g.auth = CoinbaseExchangeAuth(DEMO_API_KEY, DEMO_SECRET, DEMO_PASSPHRASE)
+    g.auth = demo_signer()
 
     do_login(user)
 
@@ -175,6 +228,11 @@ def signup():
         except TypeError:
             flash('Unable to authorize access to Coinbase Pro', 'danger')
 
+        except VerifyTimeout:
+            db.session.rollback()
+            flash(VERIFY_BUSY_MESSAGE, 'warning')
+            return redirect(url_for('signup'))
+
     else:
         return render_template('users/signup.html', form=form)
 
@@ -187,11 +245,27 @@ def login():
 
     if form.validate_on_submit():
 
-        user = User.authenticate(api_key=form.api_key.data, api_secret=form.api_secret.data,
-                                 api_passphrase=form.api_passphrase.data)
+        try:
+            user = User.authenticate(api_key=form.api_key.data, api_secret=form.api_secret.data,
+                                     api_passphrase=form.api_passphrase.data)
+
+        except VerifyTimeout:
+            db.session.rollback()
+            flash(VERIFY_BUSY_MESSAGE, 'warning')
+            return redirect(url_for('login'))
 
         if user:
 
+            # keep the stored signing credentials in step with the ones just verified
+            if user.credentials != (form.api_key.data, form.api_secret.data,
+                                    form.api_passphrase.data):
+                user.set_auth(form.api_key.data, form.api_secret.data,
+                              form.api_passphrase.data)
+                identity.forget(user.id)
+
+            # including a hash authenticate upgraded
+            db.session.commit()
+
             do_login(user)
 
             flash("Welcome Back!", "success")
@@ -224,14 +298,23 @@ def dashboard(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    if g.auth is None:
+        return log_in_again()
 
-    # update the user's accounts in the db with the latest Coinbase Pro data
-    update_user_info(user_id, g.auth)
+    user = load_portfolio(user_id, User.accounts) or abort(404)
+
+    # serve the stored accounts if they are recent, refreshing them from Coinbase Pro
+    # in the background or up front depending on how old they are
+    ensure_snapshot(user, g.auth)
 
     total_balance = total_balance_usd(user)
 
-    return render_template("users/dashboard.html", user=user, total_balance=total_balance)
+    # embedded in the page for the pie chart, so it doesn't need its own request
+    allocations = cached_pct_allocations(user.id, user.snapshot_version, lambda: pct_allocations(
+        [(account.currency, account.balance_usd) for account in user.accounts], total_balance))
+
+    return render_template("users/dashboard.html", user=user, total_balance=total_balance,
+                           pct_allocations=allocations)
 
 
 @app.route('/users/<int:user_id>/rebalance', methods=["GET", "POST"])
@@ -242,6 +325,9 @@ def rebalance(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if g.auth is None:
+        return log_in_again()
+
     # update the user's accounts in the db
     update_user_info(user_id, g.auth)
 
@@ -279,12 +365,17 @@ def rebalance(user_id):
             flash('Allocations should add up to 100%', 'danger')
             return redirect(url_for('rebalance', user_id=user_id))
 
-        flash('Rebalance complete', 'success')
         # udpate the target allocations in the db
         update_target_allocations(user_id, target_portfolio)
 
         # now rebalance portfolio according to those new targets
-        rebalance_portfolio(user_id, g.auth, 0)
+        outcome = rebalance_portfolio(user_id, g.auth)
+
+        if outcome["failed"]:
+            flash(f'Rebalance partly done: {outcome["placed"]} orders placed, '
+                  f'{len(outcome["failed"])} failed ({outcome["failed"][0]})', 'warning')
+        else:
+            flash('Rebalance complete', 'success')
 
         return redirect(url_for('dashboard', user_id=user_id))
 
@@ -299,7 +390,10 @@ def trade(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get(user_id)
+    if g.auth is None:
+        return log_in_again()
+
+    user = load_portfolio(user_id, User.accounts) or abort(404)
 
     valid_products = get_valid_products_for_orders(user.accounts)
     form = OrderForm()
@@ -333,13 +427,16 @@ def deposit(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    if g.auth is None:
+        return log_in_again()
 
     form = DepositForm()
 
     # get payment methods from coinbase and put in db
     update_payment_methods(user_id, "USD", g.auth)
 
+    user = load_portfolio(user_id, User.payment_methods) or abort(404)
+
     # get payment methods from db
     form.payment_method.choices = [(method.id, method.name)
                                    for method in user.payment_methods]
@@ -361,11 +458,47 @@ def deposit(user_id):
 # Routes for the front end
 @app.route('/api/users/portfolio_pcts', methods=['GET'])
 def get_portfolio_pct_allocations():
+    """Percentages for the pie chart, answered with 304 Not Modified until the accounts change."""
+
+    if not g.user:
+        return jsonify({"message": "Access unauthorized."}), 401
+
+    version = snapshot_version(g.user.id)
+    etag = f"pcts-{g.user.id}-{version}"
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(cached_pct_allocations(g.user.id, version))
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = 'private, no-cache'
+
+    return response
+
+
+@app.route('/api/users/portfolio_history', methods=['GET'])
+def get_portfolio_history():
+    """Balances over time for the dashboard chart.
+
+    start and end are unix timestamps, the last 7 days by default. Timestamps that are
+    out of range, or a start after the end, get a 400."""
+
+    if not g.user:
+        return jsonify({"message": "Access unauthorized."}), 401
+
     try:
-        pct_allocations = portfolio_pct_allocations(g.user.id)
-        return jsonify(pct_allocations), 200
-    except (AttributeError) as e:
-        print("can not get portfolio percentages")
+        end = parse_timestamp(request.args.get('end'), datetime.utcnow())
+        start = parse_timestamp(request.args.get('start')) or max(
+            end - timedelta(days=7), EPOCH)
+
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    if start > end:
+        return jsonify({"message": "start is after end."}), 400
+
+    return jsonify(portfolio_history(g.user.id, start, end)), 200
 
 
 ##############################################################################
@@ -375,7 +508,7 @@ def homepage():
     """Show homepage."""
 
     if g.user:
-        return render_template('users/dashboard.html', user=g.user)
+        return render_template('users/dashboard.html', user=load_portfolio(g.user.id, User.accounts))
 
     else:
         return render_template('home-anon.html')
@@ -393,3 +526,15 @@ def page_not_found(e):
     """404 NOT FOUND page."""
 
     return render_template('404.html'), 404
+
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    """503 SERVICE UNAVAILABLE when a provider's rate limit kept us from loading a page."""
+
+    retry_after = {"Retry-After": str(math.ceil(e.retry_after))}
+
+    if request.path.startswith('/api/'):
+        return jsonify({"message": str(e), "retry_after": e.retry_after}), 503, retry_after
+
+    return render_template('503.html'), 503, retry_after
@@ -0,0 +1 @@
+"""Offline benchmarks: a local Coinbase Pro / CoinGecko stand-in and runners that drive the app against it."""
@@ -0,0 +1,295 @@
+"""Outbound-call budgets per route and per helper.
+
+Counts Coinbase Pro and CoinGecko calls (as served by the stand-in), DB queries and wall
+time for one steady-state call of each route and helper, for portfolios of 2, 10 and 50
+assets, and fails if any count goes over the budgets committed in bench/budgets.json.
+
+    python -m bench.budgets
+    python -m bench.budgets --update    # rewrite budgets.json from this run
+
+Caches are warmed by an unmeasured call first, except for dashboard_cold, which is measured
+from empty caches and a stale snapshot, as the first dashboard view after a deploy. Uses the
+same bench database as bench.run.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from bench.standin import StandInServer, StandInConfig
+from bench.run import BENCH_DATABASE_URL, configure_environment, setup_app, clear_caches, \
+    make_senders, usd_products, target_percentages
+
+
+SIZES = (2, 10, 50)
+
+METRICS = ('coinbase', 'coingecko', 'queries', 'seconds')
+
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), 'budgets.json')
+
+
+class Meter:
+    """Counts the stand-in calls and DB queries made inside measure()."""
+
+    def __init__(self, server, engine):
+        from sqlalchemy import event
+
+        self.server = server
+        self.queries = 0
+
+        event.listen(engine, 'before_cursor_execute', self._count_query)
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    @contextmanager
+    def measure(self):
+        result = {}
+
+        calls = Counter(self.server.market.calls)
+        queries = self.queries
+        started = time.perf_counter()
+
+        yield result
+
+        result["seconds"] = time.perf_counter() - started
+        result["queries"] = self.queries - queries
+
+        for provider in ('coinbase', 'coingecko'):
+            result[provider] = self.server.market.calls[provider] - \
+                calls[provider]
+
+
+@contextmanager
+def cold_snapshots():
+    """Make dashboards refresh their snapshot while inside the block."""
+
+    from helpers import snapshots
+
+    ages = snapshots.SNAPSHOT_FRESH_AGE, snapshots.SNAPSHOT_MAX_AGE
+    snapshots.SNAPSHOT_FRESH_AGE = snapshots.SNAPSHOT_MAX_AGE = 0
+
+    try:
+        yield
+    finally:
+        snapshots.SNAPSHOT_FRESH_AGE, snapshots.SNAPSHOT_MAX_AGE = ages
+
+
+def route_calls(client, user_id, server):
+    """Get {name: function(iteration) -> callable} for every measured route."""
+
+    senders = make_senders(client, user_id, usd_products(server))
+
+    def dashboard_cold(i):
+        # before the meter starts, so the cold pass pays for every download itself
+        clear_caches()
+
+        def send():
+            with cold_snapshots():
+                return senders["dashboard"](i)()
+
+        return send
+
+    return dict(senders, dashboard_cold=dashboard_cold)
+
+
+def helper_calls(user_id):
+    """Get {name: function(iteration) -> callable} for every measured helper.
+
+    The callables run inside a demo-mode request context."""
+
+    from flask import g
+    from app import DEMO_API_KEY, DEMO_SECRET, DEMO_PASSPHRASE, CB_DEMO_API_URL
+    from models import User, CoinbaseExchangeAuth
+    from helpers import helpers
+
+    def with_g(call):
+        # as before_request would, outside the meter
+        user = User.query.get(user_id)
+
+        def run():
+            g.api_url = CB_DEMO_API_URL
+            g.demo = True
+            g.user = user
+            g.auth = CoinbaseExchangeAuth(
+                DEMO_API_KEY, DEMO_SECRET, DEMO_PASSPHRASE)
+
+            return call(g.auth)
+
+        return run
+
+    def rebalance_portfolio(i):
+        currencies = [account.currency for account in User.query.get(user_id).accounts]
+        percentages = target_percentages(sorted(currencies), i % 2)
+
+        helpers.update_target_allocations(user_id, [
+            {"currency": currency, "percentage": pct / 100} for currency, pct in percentages.items()])
+
+        return with_g(lambda auth: helpers.rebalance_portfolio(user_id, auth))
+
+    return {
+        "update_user_accounts": lambda i: with_g(lambda auth: helpers.update_user_accounts(user_id, auth)),
+        "update_allocations": lambda i: with_g(lambda auth: helpers.update_allocations(user_id)),
+        "portfolio_pct_allocations": lambda i: with_g(lambda auth: helpers.portfolio_pct_allocations(user_id)),
+        "get_valid_products_for_orders": lambda i: with_g(
+            lambda auth: helpers.get_valid_products_for_orders(g.user.accounts)),
+        "find_ticker": lambda i: with_g(lambda auth: helpers.find_ticker('ETH')),
+        "convert_currency": lambda i: with_g(lambda auth: helpers.convert_currency('ETH', 1)),
+        "get_current_price": lambda i: with_g(lambda auth: helpers.get_current_price('ETH-USD')),
+        "rebalance_portfolio": rebalance_portfolio,
+    }
+
+
+def measure_size(server, size):
+    """Measure every route and helper for a portfolio of size assets.
+
+    Returns {"routes": {name: result}, "helpers": {name: result}}."""
+
+    server.reset(StandInConfig(assets=size))
+
+    app, client, user_id = setup_app()
+
+    from models import db
+    meter = Meter(server, db.engine)
+
+    results = {"routes": {}, "helpers": {}}
+
+    with app.app_context():
+        for name, prepare in route_calls(client, user_id, server).items():
+            prepare(0)()
+
+            send = prepare(1)
+            with meter.measure() as result:
+                send()
+
+            results["routes"][name] = result
+
+    for name, prepare in helper_calls(user_id).items():
+        with app.test_request_context():
+            prepare(0)()
+
+        with app.test_request_context():
+            call = prepare(1)
+            with meter.measure() as result:
+                call()
+
+        results["helpers"][name] = result
+
+    from sqlalchemy import event
+    event.remove(db.engine, 'before_cursor_execute', meter._count_query)
+
+    return results
+
+
+def budget_for(metric, measured):
+    """The budget committed for a measurement: exact-ish for counts, loose for time."""
+
+    if metric == 'seconds':
+        return round(max(measured * 3, measured + .25), 2)
+
+    if metric == 'queries':
+        return measured + math.ceil(measured * .2) + 2
+
+    return measured + math.ceil(measured * .1)
+
+
+def make_budgets(measurements):
+    """Turn {size: results} into a budgets document."""
+
+    budgets = {}
+
+    for size, results in measurements.items():
+        for kind, named in results.items():
+            for name, result in named.items():
+                budgets.setdefault(kind, {}).setdefault(name, {})[str(size)] = {
+                    metric: budget_for(metric, result[metric]) for metric in METRICS}
+
+    return budgets
+
+
+def check(measurements, budgets):
+    """Compare measurements with budgets, returning the list of violations."""
+
+    violations = []
+
+    for size, results in measurements.items():
+        for kind, named in results.items():
+            for name, result in named.items():
+                budget = budgets.get(kind, {}).get(name, {}).get(str(size))
+
+                if budget is None:
+                    violations.append(f"{kind} {name} ({size} assets): no budget")
+                    continue
+
+                for metric in METRICS:
+                    if result[metric] > budget[metric]:
+                        violations.append(f"{kind} {name} ({size} assets): {metric} "
+                                          f"{result[metric]:.4g} > budget {budget[metric]}")
+
+    return violations
+
+
+def print_measurements(measurements, budgets):
+    print(f"{'':<36}{'assets':>8}" + "".join(f"{metric:>18}" for metric in METRICS))
+
+    for size, results in measurements.items():
+        for kind, named in results.items():
+            for name, result in named.items():
+                budget = budgets.get(kind, {}).get(name, {}).get(str(size), {})
+                cells = "".join(
+                    f"{result[metric]:>9.3g} / {budget.get(metric, '-'):<6}" for metric in METRICS)
+                print(f"{kind[:-1] + ' ' + name:<36}{size:>8}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--update', action='store_true',
+                        help="write budgets.json from this run instead of checking it")
+    parser.add_argument('--database-url', default=os.environ.get(
+        "BENCH_DATABASE_URL", BENCH_DATABASE_URL))
+    args = parser.parse_args()
+
+    # the bench database is wiped, so don't let it be the app's own by accident
+    if 'bench' not in args.database_url:
+        parser.error("--database-url must name a benchmark database (containing 'bench')")
+
+    with StandInServer(StandInConfig()) as server:
+        configure_environment(server, args.database_url, cold=False)
+
+        measurements = {size: measure_size(server, size) for size in args.sizes}
+
+    if args.update:
+        budgets = make_budgets(measurements)
+
+        with open(BUDGETS_PATH, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+        print_measurements(measurements, budgets)
+        print(f"wrote {BUDGETS_PATH}")
+        return
+
+    with open(BUDGETS_PATH) as f:
+        budgets = json.load(f)
+
+    print_measurements(measurements, budgets)
+
+    violations = check(measurements, budgets)
+
+    if violations:
+        print(f"\n{len(violations)} budget(s) exceeded:")
+        for violation in violations:
+            print(f"  {violation}")
+        sys.exit(1)
+
+    print("\nall budgets met")
+
+
+if __name__ == '__main__':
+    main()
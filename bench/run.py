@@ -0,0 +1,252 @@
+"""Drive the app's routes against the local stand-in and report latency percentiles.
+
+    python -m bench.run --assets 10 --latency 50 --iterations 20
+
+Uses a separate Postgres database (--database-url or BENCH_DATABASE_URL, cfinance_bench
+by default), whose tables are dropped and recreated on every run. Logs in through demo
+mode, so no credentials are needed.
+
+By default dashboards are served from fresh snapshots, as they are for active users.
+--cold makes every dashboard view refresh from the stand-in first.
+"""
+
+import argparse
+import json
+import math
+import os
+import tempfile
+import time
+
+from bench.standin import StandInServer, parse_config, config_from_args
+
+
+ROUTES = ('dashboard', 'portfolio_pcts', 'rebalance', 'trade', 'deposit')
+
+PERCENTILES = (50, 90, 99)
+
+BENCH_DATABASE_URL = 'postgresql:///cfinance_bench'
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples."""
+
+    ranked = sorted(samples)
+    rank = max(0, min(len(ranked) - 1, math.ceil(pct / 100 * len(ranked)) - 1))
+
+    return ranked[rank]
+
+
+def summarize(samples):
+    """Get the count, mean, percentiles and max of samples in seconds, reported in ms."""
+
+    summary = {"n": len(samples), "mean": sum(samples) / len(samples) * 1000}
+
+    for pct in PERCENTILES:
+        summary[f"p{pct}"] = percentile(samples, pct) * 1000
+
+    summary["max"] = max(samples) * 1000
+
+    return summary
+
+
+def configure_environment(server, database_url, cold):
+    """Point the app at the stand-in and the bench database. Must run before the app is imported."""
+
+    os.environ.update(server.environ())
+    os.environ["DATABASE_URL"] = database_url
+
+    # the stand-in doesn't rate limit, so don't hold calls back to the providers' limits
+    os.environ.setdefault("COINBASE_PRIVATE_RATE", '1000')
+    os.environ.setdefault("COINBASE_PRIVATE_BURST", '50')
+    os.environ.setdefault("HTTP_DEFAULT_RATE", '1000')
+    os.environ.setdefault("HTTP_DEFAULT_BURST", '100')
+    os.environ["SHARED_CACHE_PATH"] = os.path.join(
+        tempfile.mkdtemp(prefix='cfinance-bench-'), 'cache.sqlite3')
+
+    if cold:
+        os.environ["SNAPSHOT_FRESH_AGE"] = '0'
+        os.environ["SNAPSHOT_MAX_AGE"] = '0'
+
+
+def clear_caches():
+    """Forget every cached catalog, price, ticker and coalesced call, here and in the shared cache."""
+
+    from helpers import catalog, ticker
+    from helpers.coingecko import resolver as coingecko_ids
+    from helpers.shared_cache import cache as shared_cache
+    from helpers.singleflight import flight
+
+    flight.clear()
+    shared_cache.invalidate()
+    catalog.invalidate()
+    ticker.invalidate()
+    coingecko_ids.invalidate()
+
+
+def setup_app():
+    """Import the app, reset the bench database and caches, and log in to demo mode.
+
+    Can be called again to start over, i.e.: after resetting the stand-in's market.
+    Returns (app, client, user_id)."""
+
+    from app import app, CURR_USER_KEY
+    from models import db
+
+    clear_caches()
+
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+
+    db.drop_all()
+    db.create_all()
+
+    client = app.test_client()
+    client.get('/demo')
+
+    with client.session_transaction() as session:
+        user_id = session[CURR_USER_KEY]
+
+    # the first dashboard view stores the user's accounts
+    client.get(f'/users/{user_id}/dashboard')
+
+    return app, client, user_id
+
+
+def target_percentages(currencies, skewed):
+    """Integer target percentages that add up to 100, over the non-cash currencies.
+
+    Alternating between an even and a skewed split makes every rebalance trade."""
+
+    assets = [currency for currency in currencies if currency not in ('USD', 'USDC')]
+    percentages = {currency: 0 for currency in currencies}
+
+    if skewed and len(assets) > 1:
+        percentages[assets[0]] = 50
+        share, remainder = divmod(50, len(assets) - 1)
+        for i, currency in enumerate(assets[1:]):
+            percentages[currency] = share + (1 if i < remainder else 0)
+    else:
+        share, remainder = divmod(100, len(assets))
+        for i, currency in enumerate(assets):
+            percentages[currency] = share + (1 if i < remainder else 0)
+
+    return percentages
+
+
+def make_senders(client, user_id, products):
+    """Get a {route: function(iteration)} for the routes.
+
+    Each function prepares a request and returns a callable that sends it, so that
+    preparing it (i.e.: reading the user's currencies) isn't measured."""
+
+    from models import Account
+
+    def dashboard(i):
+        return lambda: client.get(f'/users/{user_id}/dashboard')
+
+    def portfolio_pcts(i):
+        return lambda: client.get('/api/users/portfolio_pcts')
+
+    def rebalance(i):
+        currencies = [currency for currency, in Account.query.with_entities(
+            Account.currency).filter_by(user_id=user_id).order_by(Account.currency)]
+
+        data = {}
+        for n, (currency, pct) in enumerate(target_percentages(currencies, i % 2).items()):
+            data[f'portfolio-{n}-currency'] = currency
+            data[f'portfolio-{n}-percentage'] = pct
+
+        return lambda: client.post(f'/users/{user_id}/rebalance', data=data)
+
+    def trade(i):
+        return lambda: client.post(f'/users/{user_id}/trade', data={
+            "product_id": products[i % len(products)],
+            "side": 'buy' if i % 2 == 0 else 'sell',
+            "funds": 1
+        })
+
+    def deposit(i):
+        return lambda: client.post(f'/users/{user_id}/deposit', data={
+            "payment_method": 'standin-bank-account',
+            "amount": 10
+        })
+
+    return {"dashboard": dashboard, "portfolio_pcts": portfolio_pcts, "rebalance": rebalance,
+            "trade": trade, "deposit": deposit}
+
+
+def usd_products(server):
+    return [product_id for product_id in server.market.products if product_id.endswith('-USD')]
+
+
+def run(args):
+    with StandInServer(config_from_args(args)) as server:
+        configure_environment(server, args.database_url, args.cold)
+
+        app, client, user_id = setup_app()
+
+        senders = make_senders(client, user_id, usd_products(server))
+
+        results = {}
+
+        for route in args.routes:
+            samples = []
+
+            with app.app_context():
+                # warm up caches (product catalog, coingecko ids) outside the measurement
+                senders[route](0)()
+
+                for i in range(args.iterations):
+                    send = senders[route](i + 1)
+
+                    started = time.perf_counter()
+                    response = send()
+                    samples.append(time.perf_counter() - started)
+
+                    if response.status_code >= 500:
+                        print(f"{route}: HTTP {response.status_code}")
+
+            results[route] = summarize(samples)
+
+        return results
+
+
+def print_results(results):
+    columns = ["n", "mean"] + [f"p{pct}" for pct in PERCENTILES] + ["max"]
+
+    print(f"{'route':<16}" + "".join(f"{column:>10}" for column in columns))
+
+    for route, summary in results.items():
+        print(f"{route:<16}{summary['n']:>10}" + "".join(
+            f"{summary[column]:>10.1f}" for column in columns[1:]))
+
+    print("(times in ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parse_config(parser)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=list(ROUTES))
+    parser.add_argument('--cold', action='store_true',
+                        help="refresh from the stand-in on every dashboard view")
+    parser.add_argument('--database-url', default=os.environ.get(
+        "BENCH_DATABASE_URL", BENCH_DATABASE_URL))
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    # the bench database is wiped, so don't let it be the app's own by accident
+    if 'bench' not in args.database_url:
+        parser.error("--database-url must name a benchmark database (containing 'bench')")
+
+    results = run(args)
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
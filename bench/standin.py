@@ -0,0 +1,519 @@
+"""Local stand-in for the Coinbase Pro and CoinGecko endpoints the app calls.
+
+Serves a synthetic market and a single portfolio from memory, with configurable
+latency, error injection and simulated order fills, so the app can be run and
+benchmarked without network access or sandbox credentials.
+
+    python -m bench.standin --port 8765 --assets 10 --latency 50
+
+then point the app at it (the websocket ticker feed gets its own port):
+
+    CB_API_URL=http://127.0.0.1:8765/coinbase/
+    CB_DEMO_API_URL=http://127.0.0.1:8765/coinbase/
+    COINGECKO_API_URL=http://127.0.0.1:8765/coingecko/api/v3/
+    CB_WS_URL=ws://127.0.0.1:8766/
+    CB_DEMO_WS_URL=ws://127.0.0.1:8766/
+
+Coinbase Pro auth headers are accepted without being checked.
+"""
+
+import argparse
+import asyncio
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+
+# real symbols first, then synthetic ones (A012, A013, ...) for larger portfolios
+SYMBOLS = ['BTC', 'ETH', 'LTC', 'XRP', 'ZRX', 'XLM',
+           'EOS', 'DAI', 'ALGO', 'DASH', 'OXT', 'ATOM']
+
+# fixed USD prices for the real symbols, synthetic ones get a seeded random price
+PRICES = {'USD': 1.0, 'USDC': 1.0, 'BTC': 9000.0, 'ETH': 200.0, 'LTC': 45.0, 'XRP': .2,
+          'ZRX': .3, 'XLM': .06, 'EOS': 2.5, 'DAI': 1.0, 'ALGO': .2, 'DASH': 70.0,
+          'OXT': .2, 'ATOM': 2.4}
+
+
+class StandInConfig:
+    """How the stand-in behaves.
+
+    latency and jitter are in seconds, error_rate is the fraction of requests answered
+    with a 503, and settle_rate is the fraction of orders reported as settled (the rest
+    are reported pending, though their fills are applied to the balances right away).
+    The websocket feed sends every subscribed product's ticker each ticker_interval seconds."""
+
+    def __init__(self, assets=10, latency=0.0, jitter=0.0, error_rate=0.0, settle_rate=1.0,
+                 fee_rate=.005, usd_balance=1000.0, ticker_interval=1.0, seed=0):
+        self.assets = assets
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.settle_rate = settle_rate
+        self.fee_rate = fee_rate
+        self.usd_balance = usd_balance
+        self.ticker_interval = ticker_interval
+        self.seed = seed
+
+
+class Market:
+    """The stand-in's prices, products and the portfolio's accounts."""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+
+        symbols = SYMBOLS[:max(config.assets, 1)] + [f"A{i:03}" for i in range(
+            len(SYMBOLS), config.assets)]
+
+        self.prices = {'USD': 1.0, 'USDC': 1.0}
+        for symbol in symbols:
+            self.prices[symbol] = PRICES.get(
+                symbol, round(self.random.uniform(.05, 500), 4))
+
+        # every asset trades against USD, and ETH also against BTC
+        self.products = [f"{symbol}-USD" for symbol in symbols]
+        if 'ETH' in symbols and 'BTC' in symbols:
+            self.products.append('ETH-BTC')
+
+        # an even split of the USD balance across the assets, plus cash
+        per_asset = config.usd_balance / (len(symbols) + 1)
+
+        self.accounts = {}
+        for symbol in symbols:
+            self.accounts[symbol] = round(per_asset / self.prices[symbol], 8)
+
+        # cash is listed last
+        self.accounts['USD'] = per_asset
+        self.accounts['USDC'] = 0.0
+
+        self.account_ids = {currency: str(uuid.UUID(
+            int=self.random.getrandbits(128))) for currency in self.accounts}
+
+        self.orders = []
+        self.conversions = []
+
+        # {provider: requests served}
+        self.calls = Counter()
+
+    def count(self, provider):
+        with self.lock:
+            self.calls[provider] += 1
+
+    def price(self, product_id):
+        base, quote = product_id.split('-')
+
+        return self.prices[base] / self.prices[quote]
+
+    def ticker_message(self, product_id, sequence):
+        """A websocket ticker channel message for a product."""
+
+        price = str(self.price(product_id))
+
+        return {"type": "ticker", "sequence": sequence, "product_id": product_id, "price": price,
+                "best_bid": price, "best_ask": price, "last_size": "1", "volume_24h": "1000",
+                "side": "buy", "trade_id": sequence,
+                "time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+    def fill(self, product_id, side, funds):
+        """Fill a market order for funds of the quote currency, returning the order response."""
+
+        base, quote = product_id.split('-')
+        funds = float(funds)
+        fees = funds * self.config.fee_rate
+
+        with self.lock:
+            if side == 'buy':
+                if funds > self.accounts.get(quote, 0) + 1e-9:
+                    return None
+
+                size = (funds - fees) / self.price(product_id)
+                self.accounts[base] = self.accounts.get(base, 0) + size
+                self.accounts[quote] -= funds
+                executed_value = funds - fees
+
+            else:
+                size = funds / self.price(product_id)
+
+                if size > self.accounts.get(base, 0) + 1e-9:
+                    return None
+
+                self.accounts[base] -= size
+                self.accounts[quote] = self.accounts.get(
+                    quote, 0) + funds - fees
+                executed_value = funds
+
+            settled = self.random.random() < self.config.settle_rate
+
+            order = {
+                "id": str(uuid.uuid4()),
+                "product_id": product_id,
+                "side": side,
+                "type": "market",
+                "funds": str(funds),
+                "specified_funds": str(funds),
+                "status": "done" if settled else "pending",
+                "settled": settled,
+                "filled_size": str(round(size, 8)) if settled else "0",
+                "executed_value": str(round(executed_value, 8)) if settled else "0",
+                "fill_fees": str(round(fees, 8)) if settled else "0",
+            }
+            self.orders.append(order)
+
+            return order
+
+    def convert(self, from_currency, to_currency, amount):
+        amount = float(amount)
+
+        with self.lock:
+            if amount > self.accounts.get(from_currency, 0) + 1e-9:
+                return None
+
+            self.accounts[from_currency] -= amount
+            self.accounts[to_currency] = self.accounts.get(
+                to_currency, 0) + amount
+
+            conversion = {"id": str(uuid.uuid4()), "amount": str(amount),
+                          "from": from_currency, "to": to_currency}
+            self.conversions.append(conversion)
+
+            return conversion
+
+
+def coingecko_id(symbol):
+    return 'usd-coin' if symbol == 'USDC' else f"{symbol.lower()}-standin"
+
+
+def create_app(config=None):
+    """Create the stand-in Flask app, with its Market as app.market."""
+
+    app = Flask(__name__)
+    app.market = Market(config or StandInConfig())
+
+    @app.before_request
+    def simulate_network():
+        config = app.market.config
+
+        # count the call under its provider, i.e.: "coinbase" or "coingecko"
+        app.market.count(request.path.split('/')[1])
+
+        delay = config.latency + random.uniform(-config.jitter, config.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if config.error_rate and random.random() < config.error_rate:
+            return jsonify({"message": "injected error"}), 503
+
+    ##########################################################################
+    # Coinbase Pro
+
+    @app.route('/coinbase/accounts')
+    def accounts():
+        with app.market.lock:
+            return jsonify([{"id": app.market.account_ids.setdefault(currency, str(uuid.uuid4())),
+                             "currency": currency,
+                             "balance": f"{balance:.8f}",
+                             "available": f"{balance:.8f}",
+                             "hold": "0.00000000"} for currency, balance in app.market.accounts.items()])
+
+    @app.route('/coinbase/currencies')
+    def currencies():
+        return jsonify([{"id": currency, "name": currency} for currency in app.market.prices])
+
+    @app.route('/coinbase/products')
+    def products():
+        return jsonify([{"id": product_id,
+                         "base_currency": product_id.split('-')[0],
+                         "quote_currency": product_id.split('-')[1]} for product_id in app.market.products])
+
+    @app.route('/coinbase/products/<product_id>/ticker')
+    def ticker(product_id):
+        if product_id not in app.market.products:
+            return jsonify({"message": "NotFound"}), 404
+
+        return jsonify({"trade_id": 1, "price": str(app.market.price(product_id)), "size": "1",
+                        "time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+
+    @app.route('/coinbase/orders', methods=['POST'])
+    def orders():
+        params = request.get_json(force=True)
+
+        if params.get("product_id") not in app.market.products:
+            return jsonify({"message": "Invalid product_id"}), 400
+
+        order = app.market.fill(params["product_id"],
+                                params["side"], params["funds"])
+
+        if order is None:
+            return jsonify({"message": "Insufficient funds"}), 400
+
+        return jsonify(order)
+
+    @app.route('/coinbase/conversions', methods=['POST'])
+    def conversions():
+        params = request.get_json(force=True)
+
+        if {params.get("from"), params.get("to")} != {'USD', 'USDC'}:
+            return jsonify({"message": "Invalid conversion"}), 400
+
+        conversion = app.market.convert(
+            params["from"], params["to"], params["amount"])
+
+        if conversion is None:
+            return jsonify({"message": "Insufficient funds"}), 400
+
+        return jsonify(conversion)
+
+    @app.route('/coinbase/payment-methods')
+    def payment_methods():
+        return jsonify([{"id": "standin-bank-account", "name": "Stand-in Bank", "currency": "USD",
+                         "type": "ach_bank_account"}])
+
+    @app.route('/coinbase/deposits/payment-method', methods=['POST'])
+    def deposit():
+        params = request.get_json(force=True)
+        amount = float(params["amount"])
+
+        with app.market.lock:
+            app.market.accounts[params["currency"]] = app.market.accounts.get(
+                params["currency"], 0) + amount
+
+        return jsonify({"id": str(uuid.uuid4()), "amount": str(amount), "currency": params["currency"],
+                        "payout_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+
+    ##########################################################################
+    # CoinGecko
+
+    @app.route('/coingecko/api/v3/coins/list')
+    def coins_list():
+        return jsonify([{"id": coingecko_id(symbol), "symbol": symbol.lower(), "name": symbol}
+                        for symbol in app.market.prices if symbol != 'USD'])
+
+    @app.route('/coingecko/api/v3/simple/price')
+    def simple_price():
+        ids = set(filter(None, request.args.get("ids", "").split(',')))
+        vs_currencies = filter(
+            None, request.args.get("vs_currencies", "").split(','))
+
+        by_id = {coingecko_id(symbol): symbol for symbol in app.market.prices}
+
+        prices = {}
+        for vs_currency in vs_currencies:
+            quote = vs_currency.upper()
+
+            if quote not in app.market.prices:
+                continue
+
+            for curr_id in ids & set(by_id):
+                prices.setdefault(curr_id, {})[vs_currency] = app.market.prices[by_id[curr_id]] / \
+                    app.market.prices[quote]
+
+        return jsonify(prices)
+
+    @app.errorhandler(404)
+    def not_found(e):
+        return jsonify({"message": "NotFound"}), 404
+
+    return app
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Don't log every request, the benchmarks report their own numbers."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class TickerFeedServer:
+    """Serves the Coinbase Pro websocket ticker channel for a stand-in's market.
+
+    Answers a subscribe message with a subscriptions message, then sends a ticker for
+    every subscribed product right away and again every ticker_interval."""
+
+    def __init__(self, stand_in, host='127.0.0.1', port=0):
+        self.stand_in = stand_in
+        self.host = host
+        self.port = port
+        self.url = None
+
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+        self._sockets = set()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    async def feed(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        self._sockets.add(ws)
+
+        self.stand_in.market.count('coinbase_feed')
+
+        subscribe = await ws.receive_json()
+        product_ids = subscribe.get("product_ids", [])
+
+        await ws.send_json({"type": "subscriptions",
+                            "channels": [{"name": "ticker", "product_ids": product_ids}]})
+
+        sequence = 0
+
+        try:
+            while not ws.closed:
+                # the market is replaced when the stand-in is reset, so look it up every time
+                market = self.stand_in.market
+
+                for product_id in product_ids:
+                    if product_id in market.products:
+                        sequence += 1
+                        await ws.send_json(market.ticker_message(product_id, sequence))
+
+                # reading (rather than sleeping) answers pings and notices the client closing
+                try:
+                    await ws.receive(timeout=market.config.ticker_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+        except ConnectionResetError:
+            pass
+
+        finally:
+            self._sockets.discard(ws)
+
+        return ws
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+
+        app = web.Application()
+        app.router.add_get('/', self.feed)
+
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+
+        port = self._runner.addresses[0][1]
+        self.url = f"ws://{self.host}:{port}/"
+        self._started.set()
+
+        self._loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    async def _shutdown(self):
+        # clients stay subscribed until they are disconnected, which cleanup would wait on
+        for ws in list(self._sockets):
+            await ws.close()
+
+        await self._runner.cleanup()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class StandInServer:
+    """Runs the stand-in on a local port in a background thread.
+
+        with StandInServer(StandInConfig(assets=10)) as server:
+            os.environ.update(server.environ())
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0, feed_port=0):
+        self.app = create_app(config)
+        self._server = make_server(
+            host, port, self.app, threaded=True, request_handler=QuietRequestHandler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+
+        self.url = f"http://{host}:{self._server.server_port}/"
+
+        self.feed = TickerFeedServer(self, host, feed_port).start()
+
+    @property
+    def market(self):
+        return self.app.market
+
+    def reset(self, config):
+        """Start over with a new market and portfolio."""
+
+        self.app.market = Market(config)
+
+    def environ(self):
+        """Get the environment variables that point the app at this stand-in."""
+
+        return {
+            "CB_API_URL": self.url + 'coinbase/',
+            "CB_DEMO_API_URL": self.url + 'coinbase/',
+            "COINGECKO_API_URL": self.url + 'coingecko/api/v3/',
+            "CB_WS_URL": self.feed.url,
+            "CB_DEMO_WS_URL": self.feed.url,
+        }
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self.feed.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def parse_config(parser):
+    """Add the StandInConfig options to an argument parser."""
+
+    parser.add_argument('--assets', type=int, default=10,
+                        help="number of assets in the portfolio")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="added latency per request, in ms")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="latency jitter, in ms")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="fraction of requests that fail with a 503")
+    parser.add_argument('--settle-rate', type=float, default=1,
+                        help="fraction of orders reported as settled")
+    parser.add_argument('--ticker-interval', type=float, default=1000,
+                        help="time between websocket ticker messages, in ms")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def config_from_args(args):
+    return StandInConfig(assets=args.assets, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                         error_rate=args.error_rate, settle_rate=args.settle_rate,
+                         ticker_interval=args.ticker_interval / 1000, seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--feed-port', type=int, default=8766)
+    parse_config(parser)
+    args = parser.parse_args()
+
+    server = StandInServer(config_from_args(args), port=args.port, feed_port=args.feed_port)
+    print(f"stand-in listening on {server.url}")
+    for name, value in server.environ().items():
+        print(f"{name}={value}")
+
+    server.serve_forever()
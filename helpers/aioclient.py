@@ -0,0 +1,247 @@
+"""Async HTTP client for fanning out Coinbase Pro and CoinGecko calls concurrently.
+
+aiohttp sessions are bound to an event loop, so each worker process runs one event loop
+in a background thread, with one session whose kept-alive connections every fan-out
+reuses. Request threads hand their fan-outs to it with run() and wait for the result.
+A semaphore caps how many calls each fan-out has in flight at once, and timeouts and
+retries follow the same settings as the pooled sync client.
+"""
+
+import asyncio
+import atexit
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from helpers import metrics
+from helpers.per_process import per_process
+from helpers.ratelimit import limiter_for, parse_retry_after, RateLimited, \
+    HTTP_RATE_LIMIT_MAX_WAIT
+from helpers.singleflight import flight, request_key
+from helpers.client import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, \
+    HTTP_BACKOFF_FACTOR, HTTP_POOL_SIZE, RETRY_STATUSES
+
+
+# most calls allowed in flight at once within a single fan-out
+HTTP_CONCURRENCY = int(os.environ.get("HTTP_CONCURRENCY", 8))
+
+# kept-alive connections per host, shared by every fan-out of a worker
+HTTP_ASYNC_POOL_SIZE = int(os.environ.get("HTTP_ASYNC_POOL_SIZE", HTTP_POOL_SIZE))
+
+
+def path_url(url):
+    """Get the path and query string of a url, the part Coinbase Pro signs."""
+
+    parts = urlsplit(url)
+
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+def make_session(limit_per_host):
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=limit_per_host),
+        timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT,
+                                      sock_read=HTTP_READ_TIMEOUT))
+
+
+class WorkerLoop:
+    """An event loop running in a background thread, and the session shared on it."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+
+        threading.Thread(target=self.loop.run_forever, name='aioclient', daemon=True).start()
+
+    def __repr__(self):
+        return f"<WorkerLoop {self.loop}>"
+
+
+_worker = per_process(WorkerLoop)
+
+
+def get_loop():
+    """Get this worker process's event loop, running in a background thread.
+
+    Loops are never shared across a fork, since their thread doesn't survive it."""
+
+    return _worker().loop
+
+
+@atexit.register
+def close_session():
+    """Close the worker loop's session, if it opened one, when the process exits."""
+
+    worker = _worker.peek()
+
+    if worker is not None and worker.session is not None and worker.loop.is_running():
+        asyncio.run_coroutine_threadsafe(worker.session.close(), worker.loop).result(timeout=1)
+
+
+def shared_session():
+    """Get the worker loop's session, opening it the first time. Only call it on that loop."""
+
+    worker = _worker()
+
+    if worker.session is None or worker.session.closed:
+        worker.session = make_session(HTTP_ASYNC_POOL_SIZE)
+
+    return worker.session
+
+
+def run(coroutine):
+    """Run a coroutine on this worker's event loop and wait for its result, i.e.: instead of asyncio.run.
+
+    Outbound call timings still go to the calling request's Server-Timing breakdown."""
+
+    timings = metrics.request_timings()
+
+    async def with_timings():
+        metrics.fanout_timings.set(timings)
+        return await coroutine
+
+    return asyncio.run_coroutine_threadsafe(with_timings(), get_loop()).result()
+
+
+class AsyncClient:
+    """A capped, retrying aiohttp client for the duration of one fan-out.
+
+        async with AsyncClient() as http:
+            accounts, products = await asyncio.gather(
+                http.get_json(api_url + 'accounts', auth=auth),
+                http.get_json(api_url + 'products'))
+
+    On the worker's loop (see run) it uses the shared session, and on any other loop it
+    opens one of its own for the fan-out."""
+
+    def __init__(self, concurrency=HTTP_CONCURRENCY):
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._session = None
+        self._owns_session = False
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        worker = _worker.peek()
+
+        if worker is not None and asyncio.get_event_loop() is worker.loop:
+            self._session = shared_session()
+        else:
+            self._session = make_session(self.concurrency)
+            self._owns_session = True
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._owns_session:
+            await self._session.close()
+
+    async def get_json(self, url, params=None, headers=None, auth=None, shared=False):
+        """GET a url and decode its JSON body, retrying connection errors, 429s and 5xx responses.
+
+        shared unauthenticated calls are coalesced with identical ones made concurrently,
+        by any thread, the same way as client.get_shared."""
+
+        if shared and auth is None:
+            return await flight.do_async(request_key('GET', url, params, kind='json'),
+                                         lambda: self._get_json(url, params, headers))
+
+        return await self._get_json(url, params, headers, auth)
+
+    async def _get_json(self, url, params=None, headers=None, auth=None):
+        headers = dict(headers or {})
+        limiter = limiter_for(url, auth)
+
+        for attempt in range(HTTP_RETRIES + 1):
+            await limiter.acquire_async(HTTP_RATE_LIMIT_MAX_WAIT)
+
+            # Coinbase Pro signatures include a timestamp, so every attempt is signed again
+            if auth is not None:
+                headers.update(auth.headers('GET', path_url(url)))
+
+            try:
+                async with self._semaphore:
+                    started = time.perf_counter()
+
+                    async with self._session.get(url, params=params, headers=headers) as response:
+                        metrics.record_outbound(url, 'GET', time.perf_counter() - started,
+                                                status=response.status)
+
+                        if response.status == 429:
+                            # the limiter spaces out the retry, no backoff needed on top
+                            self._throttled(limiter, response, attempt)
+                            continue
+
+                        limiter.succeed()
+
+                        if response.status not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                            return await response.json(content_type=None)
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                metrics.record_outbound(url, 'GET', time.perf_counter() - started,
+                                        error=type(e).__name__)
+
+                if attempt == HTTP_RETRIES:
+                    raise
+
+            # full jitter, same as the sync client
+            await asyncio.sleep(random.uniform(0, HTTP_BACKOFF_FACTOR * 2 ** attempt))
+
+    async def post_json(self, url, body, auth=None):
+        """POST body as JSON and decode the JSON response.
+
+        Orders and conversions aren't idempotent, so a POST is only retried when the
+        connection never opened, or after a 429 (which Coinbase Pro rejects unfilled)."""
+
+        data = json.dumps(body)
+        limiter = limiter_for(url, auth)
+
+        for attempt in range(HTTP_RETRIES + 1):
+            headers = {'Content-Type': 'application/json'}
+
+            await limiter.acquire_async(HTTP_RATE_LIMIT_MAX_WAIT)
+
+            # signed after waiting for the limiter, so the timestamp is current
+            if auth is not None:
+                headers.update(auth.headers('POST', path_url(url), data))
+
+            try:
+                async with self._semaphore:
+                    started = time.perf_counter()
+
+                    async with self._session.post(url, data=data, headers=headers) as response:
+                        metrics.record_outbound(url, 'POST', time.perf_counter() - started,
+                                                status=response.status)
+
+                        if response.status == 429:
+                            self._throttled(limiter, response, attempt)
+                            continue
+
+                        limiter.succeed()
+
+                        return await response.json(content_type=None)
+
+            except aiohttp.ClientConnectorError as e:
+                metrics.record_outbound(url, 'POST', time.perf_counter() - started,
+                                        error=type(e).__name__)
+
+                if attempt == HTTP_RETRIES:
+                    raise
+
+            await asyncio.sleep(random.uniform(0, HTTP_BACKOFF_FACTOR * 2 ** attempt))
+
+    @staticmethod
+    def _throttled(limiter, response, attempt):
+        """Slow the limiter down after a 429, raising RateLimited if out of retries."""
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        limiter.throttle(retry_after)
+
+        if attempt == HTTP_RETRIES:
+            raise RateLimited(limiter.name, retry_after or 1 / limiter.rate)
@@ -0,0 +1,140 @@
+"""Cached Coinbase Pro product catalog with precomputed routing maps.
+
+The /products list rarely changes, so its product ids are downloaded at most once per TTL
+for each Coinbase Pro environment (sandbox and production are cached separately by API
+url) and shared by every worker on the host. Each worker builds the routing maps once
+per version of the list.
+"""
+
+import os
+import threading
+
+import requests
+
+from helpers import client
+from helpers.shared_cache import cache as shared_cache
+
+
+PRODUCTS_TTL = int(os.environ.get("PRODUCTS_TTL", 5 * 60))
+
+# keep serving an expired catalog for up to a day while it is being refreshed
+PRODUCTS_STALE_TTL = 24 * 60 * 60
+
+# how long to wait before trying /products again after a failed download
+PRODUCTS_RETRY = 60
+
+# quote currencies to try, in order, when looking for a currency's ticker
+DEMO_QUOTE_PREFERENCE = ('USD', 'USDC', 'BTC')
+QUOTE_PREFERENCE = ('USD',)
+
+
+class ProductCatalog:
+    """A snapshot of the products (i.e.: "ETH-BTC") available on a Coinbase Pro environment."""
+
+    def __init__(self, product_ids):
+        self.product_ids = list(product_ids)
+        self._product_id_set = set(self.product_ids)
+
+        # {base currency: {quote currency: product id}}
+        self.tickers_by_base = {}
+
+        # {quote currency: {product ids}}
+        self.products_by_quote = {}
+
+        for product_id in self.product_ids:
+            base, quote = product_id.split('-')[:2]
+
+            self.tickers_by_base.setdefault(base, {})[quote] = product_id
+            self.products_by_quote.setdefault(quote, set()).add(product_id)
+
+        # {quote preference: {base currency: ticker}}, filled in once per preference
+        self._routes = {}
+
+    def __repr__(self):
+        return f"<ProductCatalog {len(self.product_ids)} products>"
+
+    def __contains__(self, product_id):
+        return product_id in self._product_id_set
+
+    def routes(self, quote_preference):
+        """Get the {base currency: ticker} routing table for a quote preference."""
+
+        quote_preference = tuple(quote_preference)
+        routes = self._routes.get(quote_preference)
+
+        if routes is None:
+            routes = {}
+
+            for base, tickers in self.tickers_by_base.items():
+                for quote in quote_preference:
+                    if quote in tickers:
+                        routes[base] = tickers[quote]
+                        break
+
+            self._routes[quote_preference] = routes
+
+        return routes
+
+    def find_ticker(self, currency, quote_preference):
+        """Get the first ticker for a currency in quote preference order, or None."""
+
+        return self.routes(quote_preference).get(currency)
+
+    def products_for_quotes(self, quote_currencies):
+        """Get every product that can be bought with any of the quote currencies."""
+
+        products = set()
+
+        for quote in quote_currencies:
+            products |= self.products_by_quote.get(quote, set())
+
+        return products
+
+
+# {api url: (shared cache version, ProductCatalog)}
+_catalogs = {}
+_lock = threading.Lock()
+
+
+def download_product_ids(api_url):
+    response = client.get_shared(api_url + "products")
+    response.raise_for_status()
+
+    return [product["id"] for product in response.json()]
+
+
+def get_catalog(api_url):
+    """Get the product catalog for a Coinbase Pro API url, downloading it if expired."""
+
+    entry = shared_cache.fetch(f"catalog:{api_url}", lambda: download_product_ids(api_url),
+                               PRODUCTS_TTL, stale_ttl=PRODUCTS_STALE_TTL, retry=PRODUCTS_RETRY,
+                               errors=(requests.RequestException, ValueError, KeyError))
+
+    cached = _catalogs.get(api_url)
+
+    if cached and cached[0] == entry.version:
+        return cached[1]
+
+    with _lock:
+        cached = _catalogs.get(api_url)
+
+        # another thread may have built it while we waited for the lock
+        if cached and cached[0] == entry.version:
+            return cached[1]
+
+        catalog = ProductCatalog(entry.value)
+        _catalogs[api_url] = (entry.version, catalog)
+
+        return catalog
+
+
+def invalidate(api_url=None):
+    """Drop the cached catalog for an API url, or every cached catalog."""
+
+    with _lock:
+        if api_url is None:
+            _catalogs.clear()
+            shared_cache.invalidate('catalog:')
+        else:
+            _catalogs.pop(api_url, None)
+            shared_cache.invalidate(f"catalog:{api_url}")
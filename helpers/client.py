@@ -0,0 +1,167 @@
+"""Pooled HTTP client shared by every outbound Coinbase Pro and CoinGecko call.
+
+Each worker process keeps one requests.Session so that TCP/TLS connections are reused
+across calls, and every call gets connect/read timeouts and bounded, jittered retries.
+"""
+
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from helpers import metrics
+from helpers.per_process import per_process
+from helpers.ratelimit import limiter_for, parse_retry_after, RateLimited, \
+    HTTP_RATE_LIMIT_MAX_WAIT, HOST_LIMITS, COINBASE_PRIVATE_BURST
+from helpers.singleflight import flight, request_key
+
+
+# (connect, read) timeouts in seconds, so a hung provider can't block a worker forever
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 10))
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+HTTP_BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", 0.3))
+
+# kept-alive connections per host
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+
+# Coinbase Pro is called in bursts of public and private (per API key) calls at once,
+# i.e.: a rebalance stage, so it gets a pool as big as both bursts
+COINBASE_POOL_SIZE = int(os.environ.get(
+    "COINBASE_POOL_SIZE", HOST_LIMITS['api.pro.coinbase.com'][1] + COINBASE_PRIVATE_BURST))
+
+# CoinGecko calls are cached and coalesced, so a few connections are plenty
+COINGECKO_POOL_SIZE = int(os.environ.get("COINGECKO_POOL_SIZE", 4))
+
+# {url prefix: kept-alive connections} for the hosts that need a different pool size
+# than HTTP_POOL_SIZE, including the ones the app is configured to call
+HOST_POOL_SIZES = {
+    'https://api.pro.coinbase.com/': COINBASE_POOL_SIZE,
+    'https://api-public.sandbox.pro.coinbase.com/': COINBASE_POOL_SIZE,
+    'https://api.coingecko.com/': COINGECKO_POOL_SIZE,
+    os.environ.get("CB_API_URL", 'https://api.pro.coinbase.com/'): COINBASE_POOL_SIZE,
+    os.environ.get("CB_DEMO_API_URL", 'https://api-public.sandbox.pro.coinbase.com/'): COINBASE_POOL_SIZE,
+    os.environ.get("COINGECKO_API_URL", 'https://api.coingecko.com/'): COINGECKO_POOL_SIZE,
+}
+
+# only idempotent requests are retried after they reach the server;
+# orders, deposits and conversions are only retried if the connection never opened
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff with full jitter, so workers don't retry in lockstep."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+
+        return random.uniform(0, backoff)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # 429s are left to the host's rate limiter, see request()
+        return status_code != 429 and super().is_retry(method, status_code, has_retry_after)
+
+
+def make_retry():
+    methods_kwarg = 'allowed_methods' if hasattr(
+        Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist'
+
+    return JitteredRetry(total=HTTP_RETRIES,
+                         connect=HTTP_RETRIES,
+                         read=HTTP_RETRIES,
+                         status=HTTP_RETRIES,
+                         backoff_factor=HTTP_BACKOFF_FACTOR,
+                         status_forcelist=RETRY_STATUSES,
+                         raise_on_status=False,
+                         **{methods_kwarg: RETRY_METHODS})
+
+
+def make_session():
+    """Create a session with pooled, retrying adapters for every host we call."""
+
+    session = requests.Session()
+
+    adapter = HTTPAdapter(pool_connections=len(HOST_POOL_SIZES) + 4,
+                          pool_maxsize=HTTP_POOL_SIZE, max_retries=make_retry())
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    for prefix, pool_size in HOST_POOL_SIZES.items():
+        session.mount(prefix, HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=pool_size, max_retries=make_retry()))
+
+    return session
+
+
+_session = per_process(make_session)
+
+
+def get_session():
+    """Get this worker process's session.
+
+    Sessions are never shared across a fork, since pooled sockets can't be shared
+    between processes."""
+
+    return _session()
+
+
+def request(method, url, **kwargs):
+    """Send a request through the pooled session, with the default timeouts.
+
+    Calls wait for a token from the host's rate limiter first, and are retried after a
+    429, which means the provider turned the request away without acting on it. Raises
+    RateLimited if the wait would be longer than HTTP_RATE_LIMIT_MAX_WAIT, or the
+    provider is still throttling after the retries."""
+
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+
+    limiter = limiter_for(url, kwargs.get('auth'))
+
+    for attempt in range(HTTP_RETRIES + 1):
+        limiter.acquire(HTTP_RATE_LIMIT_MAX_WAIT)
+
+        started = time.perf_counter()
+
+        try:
+            response = get_session().request(method, url, **kwargs)
+
+        except requests.RequestException as e:
+            metrics.record_outbound(url, method, time.perf_counter() - started,
+                                    error=type(e).__name__)
+            raise
+
+        metrics.record_outbound(url, method, time.perf_counter() - started,
+                                status=response.status_code)
+
+        if response.status_code != 429:
+            limiter.succeed()
+            return response
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        limiter.throttle(retry_after)
+
+    raise RateLimited(limiter.name, retry_after or 1 / limiter.rate)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def get_shared(url, params=None, headers=None, max_age=None):
+    """GET an unauthenticated url, sharing the response with identical concurrent calls.
+
+    Concurrent callers asking for the same url and params get the same response, as do
+    callers up to max_age seconds later (COALESCE_MAX_AGE by default)."""
+
+    return flight.do(request_key('GET', url, params),
+                     lambda: get(url, params=params, headers=headers), max_age)
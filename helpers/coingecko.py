@@ -0,0 +1,107 @@
+"""Resolve currency symbols (i.e.: "BAT") to CoinGecko coin ids.
+
+CoinGecko's coins/list payload is large, so it is downloaded at most once per TTL,
+indexed by symbol, and kept in the shared cache so that every worker on the host (and
+restarted ones) use the same copy instead of downloading their own.
+"""
+
+import os
+import time
+
+import requests
+
+from helpers import client
+from helpers.shared_cache import cache as shared_cache
+
+
+COINGECKO_API_URL = os.environ.get(
+    "COINGECKO_API_URL", 'https://api.coingecko.com/api/v3/')
+
+# refresh the symbol index once a day by default
+COINGECKO_IDS_TTL = int(os.environ.get("COINGECKO_IDS_TTL", 24 * 60 * 60))
+
+# keep serving an expired index for up to a week while it is being refreshed
+COINGECKO_IDS_STALE_TTL = 7 * 24 * 60 * 60
+
+# how long a process waits before trying coins/list again after a failed download
+COINGECKO_IDS_RETRY = 60
+
+COINGECKO_IDS_KEY = 'coingecko:ids'
+
+DOWNLOAD_ERRORS = (requests.RequestException, ValueError, KeyError)
+
+# coins that share a symbol with a more popular coin and should never be picked
+EXCLUDED_IDS = {'batcoin'}
+
+
+def build_symbol_index(coins):
+    """Build a {symbol: id} index from the coins/list payload.
+
+    The first listed coin wins for a symbol, same as scanning the list in order."""
+
+    index = {}
+
+    for coin in coins:
+        if coin["id"] in EXCLUDED_IDS:
+            continue
+
+        index.setdefault(coin["symbol"].lower(), coin["id"])
+
+    return index
+
+
+class CoinGeckoIdResolver:
+    """Symbol to CoinGecko id lookups from a symbol index in the shared cache, with a TTL."""
+
+    def __init__(self, cache=shared_cache, ttl=COINGECKO_IDS_TTL):
+        self.cache = cache
+        self.ttl = ttl
+
+        # when this process last failed to download the index with no copy to fall back on
+        self._failed_at = None
+
+    def resolve(self, symbol):
+        """Get the CoinGecko id for a symbol, or None if CoinGecko doesn't list it."""
+
+        return self.index().get(symbol.lower())
+
+    def index(self):
+        """Get the current {symbol: id} index, downloading it if needed."""
+
+        if self._failed_at is not None and time.time() - self._failed_at < COINGECKO_IDS_RETRY:
+            # don't download again yet, but use the index if another worker got it meanwhile
+            entry = self.cache.get(COINGECKO_IDS_KEY, stale=True)
+            return entry.value if entry is not None else {}
+
+        try:
+            index = self.cache.fetch(COINGECKO_IDS_KEY, self._download, self.ttl,
+                                     stale_ttl=COINGECKO_IDS_STALE_TTL, retry=COINGECKO_IDS_RETRY,
+                                     errors=DOWNLOAD_ERRORS, name='coingecko_ids').value
+
+        except DOWNLOAD_ERRORS as e:
+            print("could not download coingecko coins list.", e)
+
+            # rather than failing every lookup, this process serves an empty index until it
+            # retries. It stays out of the shared cache, where other workers would take it
+            # for a real index
+            self._failed_at = time.time()
+            return {}
+
+        self._failed_at = None
+
+        return index
+
+    def invalidate(self):
+        """Force the next lookup to download the index again."""
+
+        self._failed_at = None
+        self.cache.invalidate(COINGECKO_IDS_KEY)
+
+    def _download(self):
+        response = client.get_shared(COINGECKO_API_URL + 'coins/list')
+        response.raise_for_status()
+
+        return build_symbol_index(response.json())
+
+
+resolver = CoinGeckoIdResolver()
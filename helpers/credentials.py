@@ -0,0 +1,122 @@
+"""Checking Coinbase Pro credentials against the hash stored for a user.
+
+A user's secret and passphrase are checked together against one salted bcrypt hash, so
+a login costs one bcrypt round instead of two. bcrypt only reads the first 72 bytes of
+its input, so the pair is digested with SHA-256 first.
+
+Checks run on a small pool of threads per worker, which caps how many can hog the CPU
+at once (bcrypt releases the GIL while it works). The request still waits for its
+check, so under sync workers this frees nothing up, it only bounds the CPU. A check
+that can't finish within VERIFY_TIMEOUT, i.e.: queued behind a burst of logins, raises
+VerifyTimeout, and the view asks the user to try again.
+
+Returning demo visitors carry a signed token in their session, so they are logged back
+in without a check at all.
+"""
+
+import base64
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import bcrypt
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+from helpers.per_process import per_process
+
+
+# bcrypt work factor for new hashes; hashes made with another one are redone on login
+BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+
+# checks running at once per worker
+VERIFY_WORKERS = int(os.environ.get("VERIFY_WORKERS", 2))
+
+# longest a login waits for its check, in seconds
+VERIFY_TIMEOUT = float(os.environ.get("VERIFY_TIMEOUT", 10))
+
+# how long a demo session token logs its visitor back in for, in seconds
+DEMO_TOKEN_MAX_AGE = int(os.environ.get("DEMO_TOKEN_MAX_AGE", 30 * 24 * 60 * 60))
+
+
+class VerifyTimeout(Exception):
+    """A credential check didn't finish within VERIFY_TIMEOUT."""
+
+
+def combine(api_secret, api_passphrase):
+    """Digest the secret and passphrase into one short bcrypt input."""
+
+    digest = hashlib.sha256(f"{api_secret}\0{api_passphrase}".encode()).digest()
+
+    return base64.b64encode(digest)
+
+
+def hash_credentials(api_secret, api_passphrase, rounds=None):
+    """Hash the secret and passphrase together, i.e.: "$2b$12$..."."""
+
+    salt = bcrypt.gensalt(rounds or BCRYPT_LOG_ROUNDS)
+
+    return bcrypt.hashpw(combine(api_secret, api_passphrase), salt).decode('UTF-8')
+
+
+def check_credentials(hashed, api_secret, api_passphrase):
+    return bcrypt.checkpw(combine(api_secret, api_passphrase), hashed.encode('UTF-8'))
+
+
+def needs_rehash(hashed):
+    """True if the hash wasn't made with the current work factor."""
+
+    return int(hashed.split('$')[2]) != BCRYPT_LOG_ROUNDS
+
+
+_executor = per_process(lambda: ThreadPoolExecutor(VERIFY_WORKERS, thread_name_prefix='verify'))
+
+
+def get_executor():
+    """Get this worker's pool of threads for bcrypt, which never survives a fork."""
+
+    return _executor()
+
+
+def off_thread(function, *args):
+    """Run a bcrypt function on the pool and wait for its result.
+
+    Raises VerifyTimeout if it takes longer than VERIFY_TIMEOUT, including the wait for
+    a free thread."""
+
+    future = get_executor().submit(function, *args)
+
+    try:
+        return future.result(timeout=VERIFY_TIMEOUT)
+
+    except FutureTimeout:
+        # one that never got a thread is dropped, one already running can't be stopped
+        future.cancel()
+        raise VerifyTimeout(f"credential check took over {VERIFY_TIMEOUT}s")
+
+
+def demo_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='demo-session')
+
+
+def issue_demo_token(user):
+    """Get a token that logs this browser back in as the demo user."""
+
+    return demo_serializer().dumps({"user_id": user.id, "api_key": user.api_key})
+
+
+def read_demo_token(token, api_key):
+    """Get the user id a demo token was issued for, or None if it's invalid or expired."""
+
+    if not token:
+        return None
+
+    try:
+        data = demo_serializer().loads(token, max_age=DEMO_TOKEN_MAX_AGE)
+    except BadSignature:
+        return None
+
+    if data.get("api_key") != api_key:
+        return None
+
+    return data.get("user_id")
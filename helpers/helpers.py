@@ -1,67 +1,160 @@
 from models import db, Account, PaymentMethod, User, CurrentAllocation, TargetAllocation
+from helpers.coingecko import resolver as coingecko_ids
+from helpers.catalog import get_catalog, DEMO_QUOTE_PREFERENCE, QUOTE_PREFERENCE
+from helpers.prices import USD_REFERENCE, get_price_matrix, fetch_price_matrix
+from helpers.aioclient import AsyncClient
+from helpers.ticker import get_ticker, fresh_price
+from helpers.rebalance import plan_rebalance, project_order, project_conversion, order_stages, \
+    is_accepted, STABLECOINS, REBALANCE_THRESHOLD, EXPECTED_SLIPPAGE
+from helpers.ratelimit import RateLimited, COINBASE_PRIVATE_BURST
+from helpers import aioclient, client, metrics
 from flask import g
-import requests
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
+from collections import OrderedDict
+import asyncio
+import aiohttp
+import os
+import threading
 import simplejson as json
-import pandas as pd
 import numpy as np
 
 
 # CB_API_URL = "https://api-public.sandbox.pro.coinbase.com/"
-COINGECKO_API_URL = 'https://api.coingecko.com/api/v3/'
 
-# used for converting currencies from native to USD
-USD_REFERENCE = 'usd'
+# currencies that aren't tracked as accounts
+EXCLUDED_CURRENCIES = {'EUR', 'GBP'}
+DEMO_EXCLUDED_CURRENCIES = EXCLUDED_CURRENCIES | {'BAT', 'LINK'}
+
+# most order passes a single rebalance makes
+MAX_REBALANCE_PASSES = 30
+
+# the Account columns compared against Coinbase Pro when refreshing
+ACCOUNT_COLUMNS = (Account.id, Account.currency, Account.balance_native,
+                   Account.balance_usd, Account.available, Account.hold, Account.user_id)
+
+
+async def fetch_accounts_and_prices(api_url, auth, known_currencies):
+    """Fetch the user's Coinbase Pro accounts and their USD prices concurrently.
+
+    Prices for the currencies already stored for the user are requested alongside
+    /accounts, so only currencies the user didn't hold before need a second round trip."""
+
+    async with AsyncClient() as http:
+        accounts, prices = await asyncio.gather(
+            http.get_json(api_url + 'accounts', auth=auth),
+            fetch_price_matrix(http, known_currencies, [USD_REFERENCE]))
+
+        new_currencies = {account["currency"]
+                          for account in accounts} - set(known_currencies)
+
+        if new_currencies:
+            prices.update(await fetch_price_matrix(
+                http, new_currencies, [USD_REFERENCE]))
+
+    return accounts, prices
+
+
+def upsert_rows(model, rows, index_elements, update_columns):
+    """INSERT ... ON CONFLICT DO UPDATE rows into a model's table, in the current transaction."""
+
+    if not rows:
+        return
+
+    stmt = insert(model.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={column: stmt.excluded[column] for column in update_columns})
+
+    db.session.execute(stmt)
+
+
+def replace_user_rows(model, user_id, rows, key, update_columns):
+    """Make rows the user's whole set of a model's rows, in the current transaction.
+
+    Takes two statements however many rows there are: a DELETE of the user's rows whose
+    key isn't in rows, and an upsert of rows on (user_id, key)."""
+
+    # the upsert can't touch the same row twice, so the last row for a key wins
+    rows = list({row[key]: row for row in rows}.values())
+
+    stale = model.query.filter(model.user_id == user_id)
+
+    if rows:
+        stale = stale.filter(getattr(model, key).notin_([row[key] for row in rows]))
+
+    stale.delete(synchronize_session=False)
+
+    upsert_rows(model, rows, ['user_id', key], update_columns)
 
 
 def update_user_accounts(user_id, auth):
+    """Update the user's accounts in the db with the latest Coinbase Pro balances.
 
-    Account.query.filter_by(
-        user_id=user_id).delete()
-    db.session.commit()
+    Only accounts that were added, changed or closed since the last refresh are written."""
+
+    stored = {row.id: row._asdict() for row in db.session.query(
+        *ACCOUNT_COLUMNS).filter_by(user_id=user_id)}
+
+    known_currencies = [row["currency"] for row in stored.values()]
+
+    accounts, prices = aioclient.run(fetch_accounts_and_prices(
+        g.api_url, auth, known_currencies))
 
-    response = requests.get(g.api_url + 'accounts', auth=auth)
-    accounts = response.json()
+    # restricting to certain currencies
+    # not including LINK or BAT becuase you can't transact with it in the sandbox
+    excluded = DEMO_EXCLUDED_CURRENCIES if g.demo else EXCLUDED_CURRENCIES
 
-    accounts_to_add = []
+    fetched = {}
 
     for account in accounts:
-        id = account["id"]
         currency = account["currency"]
-        balance_native = account["balance"]
-        available = account["available"]
-        hold = account["hold"]
 
-        # restricting to certain currencies
-        # not including LINK or BAT becuase you can't transact with it in the sandbox
+        if currency in excluded:
+            continue
+
         try:
-            balance_usd = convert_currency(
-                currency, balance_native, USD_REFERENCE)
-
-            account = Account(id=id, currency=currency,
-                              balance_native=balance_native,
-                              balance_usd=balance_usd,
-                              available=available, hold=hold, user_id=user_id)
-
-            if g.demo:
-                if currency not in ['BAT', 'LINK', 'EUR', 'GBP']:
-                    accounts_to_add.append(account)
-            elif not g.demo:
-                if currency not in ['EUR', 'GBP']:
-                    accounts_to_add.append(account)
-            else:
-                print('account not recognized')
+            balance_usd = prices.convert(
+                currency, account["balance"], USD_REFERENCE)
 
         except KeyError:
-            pass
+            # no price for it (rate limits raise RateLimited instead), so keep the account
+            # at its last known value rather than dropping it as if it were closed
+            print(f"no USD price for {currency}, keeping its last known value.")
+            balance_usd = stored.get(account["id"], {}).get("balance_usd", 0)
+
+        fetched[account["id"]] = {
+            "id": account["id"],
+            "currency": currency,
+            "balance_native": float(account["balance"]),
+            "balance_usd": float(balance_usd),
+            "available": float(account["available"]),
+            "hold": float(account["hold"]),
+            "user_id": user_id
+        }
+
+    changed = [row for id, row in fetched.items() if stored.get(id) != row]
+    closed = set(stored) - set(fetched)
+
+    # closed accounts go first, in case a currency's account was replaced by a new one
+    if closed:
+        Account.query.filter(Account.user_id == user_id, Account.id.in_(
+            closed)).delete(synchronize_session=False)
+
+    upsert_rows(Account, changed, ['id'], [
+                column.key for column in ACCOUNT_COLUMNS if column.key != 'id'])
+
+    if changed or closed:
+        User.query.filter_by(id=user_id).update(
+            {"snapshot_version": User.snapshot_version + 1}, synchronize_session=False)
 
-    db.session.add_all(accounts_to_add)
     db.session.commit()
 
 
 def update_payment_methods(user_id, currency, auth):
     """Get payment methods from Coinbase Pro user for a specified currency."""
 
-    response = requests.get(g.api_url + "payment-methods", auth=auth)
+    response = client.get(g.api_url + "payment-methods", auth=auth)
     data = response.json()
 
     for method in data:
@@ -84,38 +177,40 @@ def update_payment_methods(user_id, currency, auth):
 
 
 def update_allocations(user_id):
-    """Update the user's portfolio of assets in the db with what is in CBP."""
+    """Update the user's portfolio of assets in the db with what is in CBP.
+
+    Only allocations that were added, changed or dropped are written."""
 
     assets = portfolio_pct_allocations(user_id)
-    CurrentAllocation.query.filter_by(
-        user_id=user_id).delete()
-    db.session.commit()
 
-    allocations = []
+    stored = dict(db.session.query(CurrentAllocation.currency, CurrentAllocation.percentage).filter_by(
+        user_id=user_id))
+
+    changed = [{"currency": asset, "percentage": pct, "user_id": user_id}
+               for asset, pct in assets.items() if stored.get(asset) != pct]
+    dropped = set(stored) - set(assets)
 
-    for asset, pct in assets.items():
-        allocation = CurrentAllocation(
-            currency=asset, percentage=pct, user_id=user_id)
-        allocations.append(allocation)
+    upsert_rows(CurrentAllocation, changed, [
+                'user_id', 'currency'], ['percentage'])
+
+    if dropped:
+        CurrentAllocation.query.filter(CurrentAllocation.user_id == user_id, CurrentAllocation.currency.in_(
+            dropped)).delete(synchronize_session=False)
 
-    db.session.add_all(allocations)
     db.session.commit()
 
 
 def update_target_allocations(user_id, target_portfolio):
-    """Update the user's target allocations in the db."""
+    """Update the user's target allocations in the db.
 
-    TargetAllocation.query.filter_by(user_id=user_id).delete()
-    db.session.commit()
+    The new targets replace the old ones in a single transaction, so no one ever sees
+    a partial set."""
 
-    targets = []
+    rows = [{"currency": t["currency"], "percentage": t["percentage"], "user_id": user_id}
+            for t in target_portfolio]
 
-    for t in target_portfolio:
-        target = TargetAllocation(
-            currency=t["currency"], percentage=t["percentage"], user_id=user_id)
-        targets.append(target)
+    replace_user_rows(TargetAllocation, user_id, rows, 'currency', ['percentage'])
 
-    db.session.add_all(targets)
     db.session.commit()
 
 
@@ -128,7 +223,7 @@ def handle_deposit(user_id, auth, amount, currency, payment_method_id):
         "payment_method_id": payment_method_id
     }
 
-    response = requests.post(
+    response = client.post(
         g.api_url + 'deposits/payment-method', data=json.dumps(params), auth=auth)
 
     data = response.json()
@@ -138,11 +233,24 @@ def handle_deposit(user_id, auth, amount, currency, payment_method_id):
 
 def get_currencies():
     """Get currencies from Coinbase API."""
-    response = requests.get(g.api_url + "currencies")
+    response = client.get_shared(g.api_url + "currencies")
     json = response.json()
     return json
 
 
+def load_portfolio(user_id, *relationships):
+    """Get the user with the given relationships (all of them by default) loaded up front, or None.
+
+    Each relationship is loaded with one SELECT ... WHERE user_id IN (...), however many
+    rows it has, instead of lazily when first used."""
+
+    relationships = relationships or (User.accounts, User.target_allocations,
+                                      User.current_allocations, User.payment_methods)
+
+    return User.query.options(*[selectinload(relationship) for relationship in relationships]
+                              ).filter_by(id=user_id).first()
+
+
 def total_balance_usd(user):
     accounts = user.accounts
     total_usd_balance = sum([account.balance_usd for account in accounts])
@@ -150,18 +258,55 @@ def total_balance_usd(user):
     return total_usd_balance
 
 
+def pct_allocations(accounts, total):
+    """Get the percentage of total for each of the (currency, balance_usd) accounts."""
+
+    return {currency: balance_usd / total if total else 0
+            for currency, balance_usd in accounts}
+
+
 def portfolio_pct_allocations(user_id):
     """Get the percentage of total balance for each asset in the user's accounts."""
 
-    user = User.query.get_or_404(user_id)
-    accounts = user.accounts
+    accounts = db.session.query(Account.currency, Account.balance_usd).filter_by(
+        user_id=user_id).all()
+
+    return pct_allocations(accounts, sum(balance_usd for _, balance_usd in accounts))
+
 
-    total = total_balance_usd(user)
+def snapshot_version(user_id):
+    return db.session.query(User.snapshot_version).filter_by(id=user_id).scalar()
 
-    pct_allocations = {
-        account.currency: account.balance_usd / total for account in accounts}
 
-    return pct_allocations
+# {user id: (snapshot version, pct allocations)}, least recently used first
+_allocations = OrderedDict()
+_allocations_lock = threading.Lock()
+
+ALLOCATIONS_CACHE_SIZE = int(os.environ.get("ALLOCATIONS_CACHE_SIZE", 1024))
+
+
+def cached_pct_allocations(user_id, version, compute=None):
+    """portfolio_pct_allocations, computed once per snapshot version by each worker.
+
+    compute() gets them when they aren't cached, if the caller already has the accounts."""
+
+    with _allocations_lock:
+        entry = _allocations.get(user_id)
+
+        if entry is not None and entry[0] == version:
+            _allocations.move_to_end(user_id)
+            return entry[1]
+
+    allocations = compute() if compute else portfolio_pct_allocations(user_id)
+
+    with _allocations_lock:
+        _allocations[user_id] = (version, allocations)
+        _allocations.move_to_end(user_id)
+
+        while len(_allocations) > ALLOCATIONS_CACHE_SIZE:
+            _allocations.popitem(last=False)
+
+    return allocations
 
 
 def place_order(user_id, auth, side, funds, product_id):
@@ -173,7 +318,7 @@ def place_order(user_id, auth, side, funds, product_id):
               'type': 'market',
               'funds': funds}
 
-    response = requests.post(
+    response = client.post(
         g.api_url + 'orders', data=json.dumps(params), auth=auth)
 
     data = response.json()
@@ -182,24 +327,18 @@ def place_order(user_id, auth, side, funds, product_id):
 
 def get_products():
     """Get available products (currencies) from Coinbase API."""
-    response = requests.get(g.api_url + "products")
-    data = response.json()
-    avail_prods = [prod["id"] for prod in data]
-    return avail_prods
+    return get_catalog(g.api_url).product_ids
 
 
 def get_product(product_id):
     """Get individual product (currency) info from Coinbase API."""
-    response = requests.get(g.api_url + f"products/{product_id}/ticker")
-    data = response.json()
-    return data
+    return get_ticker(g.api_url, product_id)
 
 
 def get_current_price(product_id):
     """Get the most recent ticker price from CBP."""
 
-    response = requests.get(g.api_url + f"products/{product_id}/ticker")
-    data = response.json()
+    data = get_ticker(g.api_url, product_id)
 
     return data.get('price', 'None')
 
@@ -212,16 +351,14 @@ def get_valid_products_for_orders(accounts):
 
     accounts = [
         account.currency for account in accounts if account.balance_usd > 0]
-    avail_prods = get_products()
 
-    valid_prods = set([
-        prod for prod in avail_prods
-        if prod.split('-')[1] in accounts and prod not in ['LINK-USDC', 'BAT-USDC']])
+    valid_prods = get_catalog(g.api_url).products_for_quotes(
+        accounts) - {'LINK-USDC', 'BAT-USDC'}
 
     return valid_prods
 
 
-def rebalance_portfolio(user_id, auth, max_rebalances):
+def rebalance_portfolio(user_id, auth, max_passes=MAX_REBALANCE_PASSES):
     """Rebalance a portfolio to the given allocation percentages.
     (i.e.: a portfolio composed of 50% BTC and 50% ETH will be bought according to those percentages, based on how the
     portfolio is currently allocated)
@@ -230,174 +367,261 @@ def rebalance_portfolio(user_id, auth, max_rebalances):
 
         [{"currency": currency, "percentage": percentage}]
 
+    Each pass plans against balances projected locally from the previous pass's order
+    responses. The accounts are only fetched again once the projection says the portfolio
+    has converged, or when the unconfirmed fills could be off by more than the threshold.
+
+    Returns how it went, so a partial rebalance can be reported, i.e.:
+
+        {"placed": 3, "failed": ["Insufficient funds"]}
+
+    where placed counts the orders and conversions the exchange accepted, and failed has
+    the error of every one it didn't (or that may not have gone through).
     """
 
+    outcome = {"placed": 0, "failed": []}
+
+    with metrics.timed('rebalance_refresh'):
+        update_user_accounts(user_id, auth)
+
+    user = load_portfolio(user_id, User.accounts, User.target_allocations)
+
+    with metrics.timed('rebalance_market'):
+        market = rebalance_market(user)
+    balances = account_balances(user)
+
+    synced = True
+    unconfirmed_usd = 0
+
+    for rebalance_pass in range(max_passes):
+
+        with metrics.timed('rebalance_plan'):
+            plan = plan_rebalance(**rebalance_inputs(market, balances))
+
+        print(f"rebalance pass {rebalance_pass}:", plan)
+
+        # keeping transacting as long as the delta between actual and target for any asset value is greater than threshold of 1%
+        if plan.converged:
+            if synced:
+                break
+
+            # confirm against the real balances before stopping
+            with metrics.timed('rebalance_resync'):
+                balances = resync_balances(user_id, auth)
+            synced = True
+            unconfirmed_usd = 0
+            continue
+
+        # nothing left that can be traded, i.e.: only cash is off target
+        if not plan.orders and not plan.conversions:
+            break
+
+        with metrics.timed('rebalance_execute'):
+            order_responses, conversion_responses = execute_plan(
+                user_id, auth, plan)
+
+        projected = [project_order(balances, order, response, market["usd_prices"])
+                     for order, response in zip(plan.orders, order_responses)]
+        projected += [project_conversion(balances, conversion, response)
+                      for conversion, response in zip(plan.conversions, conversion_responses)]
+
+        for response in order_responses + conversion_responses:
+            if is_accepted(response):
+                outcome["placed"] += 1
+            else:
+                outcome["failed"].append(response.get("message") or "rejected by Coinbase Pro")
+
+        accepted = [usd for usd in projected if usd is not None]
+
+        if not accepted:
+            print("no orders were accepted, stopping the rebalance.")
+            break
+
+        synced = False
+        unconfirmed_usd += sum(accepted)
+
+        if unconfirmed_usd * EXPECTED_SLIPPAGE > np.nansum(plan.usd_values) * REBALANCE_THRESHOLD:
+            with metrics.timed('rebalance_resync'):
+                balances = resync_balances(user_id, auth)
+            synced = True
+            unconfirmed_usd = 0
+
+    with metrics.timed('rebalance_refresh'):
+        if not synced:
+            update_user_accounts(user_id, auth)
+
+        update_allocations(user_id)
+
+    return outcome
+
+
+def account_balances(user):
+    """Get {currency: native balance} for the user's accounts."""
+
+    return {account.currency: account.balance_native for account in user.accounts}
+
+
+def resync_balances(user_id, auth):
+    """Fetch the user's accounts from Coinbase Pro and get their balances."""
+
     update_user_accounts(user_id, auth)
-    update_allocations(user_id)
 
-    user = User.query.get_or_404(user_id)
+    return account_balances(load_portfolio(user_id, User.accounts))
 
-    currencies = [(account.currency, account.balance_native)
-                  for account in user.accounts]
 
-    targets = [(target.currency, target.percentage)
-               for target in user.target_allocations]
+def rebalance_market(user):
+    """Get the tickers, targets and USD prices a user's rebalance is planned with.
 
-    targets_df = pd.DataFrame(
-        targets, columns=['Currency', 'Target Allocation'])
+    These are looked up once per rebalance, for the accounts that have a target allocation."""
 
-    df = pd.DataFrame(data=currencies, columns=[
-        "Currency", "Balance Native"])
+    targets = {target.currency: target.percentage
+               for target in user.target_allocations}
 
-    df = df.merge(targets_df)
+    currencies = [account.currency for account in user.accounts
+                  if account.currency in targets]
 
     # the tickers we need to use for each currency to transact/place orders
-    df["Ticker"] = df["Currency"].map(lambda x: find_ticker(x))
-    df["Ticker"] = np.where(df["Currency"] == 'USD', 'USD', df["Ticker"])
-    df["Ticker"] = np.where(df["Currency"] == 'USDC', 'USDC', df["Ticker"])
+    tickers = [currency if currency in STABLECOINS else find_ticker(currency)
+               for currency in currencies]
 
-    quote_currencies = df["Ticker"].str.split(pat='-', expand=True)
+    quotes = ['USD' if ticker in STABLECOINS else ticker.split('-')[1] if ticker else None
+              for ticker in tickers]
 
-    df["Quote Currency"] = quote_currencies[1]
-    df["Quote Currency"] = np.where(
-        df["Ticker"] == 'USD', 'USD', df["Quote Currency"])
-    df["Quote Currency"] = np.where(
-        df["Ticker"] == 'USDC', 'USD', df["Quote Currency"])
+    # price every currency and every quote currency in USD with a single request
+    priced = set(currencies) | set(filter(None, quotes))
+    prices = get_price_matrix(priced, [USD_REFERENCE])
 
-    df["Price in Quote"] = df.apply(lambda x: convert_currency(
-        x["Currency"], 1, x["Quote Currency"]), axis=1)
+    usd_prices = {currency: prices.get(currency, default=np.nan) for currency in priced}
+    usd_prices.update(exchange_usd_prices(currencies, tickers, quotes, usd_prices))
 
-    # create column with prices relevant to the ticker (i.e.: 'ETH-BTC' will have a price in 'BTC')
-    df["Price in Ticker"] = df["Ticker"].map(lambda x: get_current_price(x))
+    return {
+        "currencies": currencies,
+        "tickers": tickers,
+        "quotes": quotes,
+        "targets": [targets[currency] for currency in currencies],
+        "usd_prices": usd_prices
+    }
 
-    df["Price in USD"] = df["Currency"].map(
-        lambda x: convert_currency(x, 1, 'USD'))
 
-    df["Total USD Value"] = df["Price in USD"] * df["Balance Native"]
+def exchange_usd_prices(currencies, tickers, quotes, usd_prices):
+    """Get USD prices from the Coinbase Pro ticker feed, for the currencies it has fresh trades of.
 
-    df["Total USD Value Delta"] = sum(
-        df["Total USD Value"]) * df["Target Allocation"] - df["Total USD Value"]
+    Orders fill near the exchange's last trade rather than CoinGecko's average, so these
+    replace the CoinGecko prices. A currency quoted in something other than USD is priced
+    through its quote's USD product, i.e.: ETH-BTC times BTC-USD."""
 
-    df["Price in Ticker"] = pd.to_numeric(
-        df["Price in Ticker"], errors='coerce')
+    exchange_prices = {}
 
-    df["Total Ticker Value"] = np.where(
-        df["Price in Ticker"] is not "NaN", df["Price in Ticker"] * df["Balance Native"], df["Balance Native"])
+    for quote in set(filter(None, quotes)) - set(STABLECOINS):
+        price = fresh_price(g.api_url, f"{quote}-USD")
 
-    btc_usd_price = df.loc[df["Currency"] == 'BTC']["Price in Ticker"].to_list()[
-        0]
+        if price is not None:
+            exchange_prices[quote] = price
 
-    df["Delta Ticker Amount"] = np.where(df["Ticker"] != 'ETH-BTC', df["Total USD Value Delta"] /
-                                         df["Price in USD"] * df["Price in Ticker"], df["Total USD Value Delta"] / btc_usd_price)
+    for currency, ticker, quote in zip(currencies, tickers, quotes):
+        if not ticker or ticker in STABLECOINS:
+            continue
 
-    df["Delta Quote Amount"] = np.where(df["Ticker"] != 'ETH-BTC', df["Total USD Value Delta"] / df["Price in USD"] *
-                                        df["Price in Quote"], df["Total USD Value Delta"] / btc_usd_price)
+        price = fresh_price(g.api_url, ticker)
+        quote_usd = 1 if quote == 'USD' else exchange_prices.get(quote, usd_prices.get(quote))
 
-    df["Delta Ticker Amount"] = df["Delta Ticker Amount"].map(
-        lambda x: round(x, 2))
+        if price is not None and quote_usd is not None and not np.isnan(quote_usd):
+            exchange_prices[currency] = price * quote_usd
 
-    df["% Delta"] = abs(df['Total USD Value Delta'] / df['Total USD Value'])
+    return exchange_prices
 
-    df["Weight"] = np.where(df["Delta Quote Amount"] >
-                            0, 'underweight', 'overweight')
 
-    df["Amount Available to Trade"] = df["Quote Currency"].map(lambda x: [
-        account.balance_native for account in user.accounts if account.currency == x])
+def rebalance_inputs(market, balances):
+    """Get the plan_rebalance arrays for a market and {currency: native balance}."""
 
-    # create a df for placing orders
-    order_df = df[['Currency', 'Ticker', 'Delta Quote Amount',
-                   'Weight', 'Amount Available to Trade', 'Total Ticker Value', 'Balance Native']]
+    currencies, quotes, usd_prices = market["currencies"], market["quotes"], market["usd_prices"]
 
-    # keeping updating and transacting as long as the delta between actual and target for any asset value is greater than threshold of 1%
-    # don't make more than 30 iterations of rebalancing
+    return {
+        "currencies": currencies,
+        "tickers": market["tickers"],
+        "balances": [balances.get(currency, 0) for currency in currencies],
+        "targets": market["targets"],
+        "usd_prices": [usd_prices[currency] for currency in currencies],
+        "quote_usd_prices": [usd_prices[quote] if quote else np.nan for quote in quotes],
+        "available": [balances.get(quote, balances.get(currency, 0)) for currency, quote in zip(currencies, quotes)]
+    }
 
-    if (df["% Delta"] >= .01).any() and max_rebalances <= 30:
 
-        for index, row in order_df.iterrows():
+def execute_plan(user_id, auth, plan):
+    """Place a plan's orders and stablecoin conversions, one stage at a time (see order_stages).
 
-            currency = row["Currency"]
-            ticker = row["Ticker"]
-            weight = row["Weight"]
-            delta = round(row["Delta Quote Amount"], 2)
-            delta = abs(delta)
-            current_ticker_val = row["Total Ticker Value"]
-            amount_avail_to_trade = round(row["Amount Available to Trade"][0], 2) if len(
-                row["Amount Available to Trade"]) != 0 else row["Balance Native"]
+    Everything within a stage is submitted concurrently, under the Coinbase Pro
+    private endpoint rate limit.
 
-            print("##################################################################")
-            print("currency:", currency, "current val:", current_ticker_val,
-                  'amount:', amount_avail_to_trade, 'delta:', delta, 'weight:', weight)
+    Returns the exchange responses for the orders and for the conversions, in plan order."""
 
-            # # is the delta between our current and target too large, if yes then we continue placing trades
-            if delta > .01:
-                # check for overweight currencies first and sell them at the delta amount
-                if weight == 'overweight' and currency not in ['USD', 'USDC']:
+    return aioclient.run(submit_plan(g.api_url, auth, plan))
 
-                    order = place_order(user_id, auth, 'sell', delta, ticker)
 
-                    print(order)
-                    print(
-                        "##################################################################")
+async def submit_plan(api_url, auth, plan):
+    urls = {"order": api_url + 'orders', "conversion": api_url + 'conversions'}
+    params = {"order": [dict(order, type='market') for order in plan.orders],
+              "conversion": plan.conversions}
+    responses = {"order": [None] * len(plan.orders),
+                 "conversion": [None] * len(plan.conversions)}
 
-                # check for underweight currencies and check if there is amount available to trade
-                if weight == 'underweight' and delta <= amount_avail_to_trade:
-                    order = place_order(user_id, auth, 'buy',
-                                        delta, ticker)
+    async with AsyncClient(concurrency=COINBASE_PRIVATE_BURST) as http:
+        for stage in order_stages(plan):
+            # one failure mustn't cancel its siblings, some of which may already be placed
+            stage_responses = await asyncio.gather(*[
+                submit(http, urls[kind], auth, params[kind][i]) for kind, i in stage],
+                return_exceptions=True)
 
-                    print(order)
-                    print(
-                        "##################################################################")
+            for (kind, i), response in zip(stage, stage_responses):
+                if isinstance(response, Exception):
+                    print(params[kind][i], response)
+                    response = {"message": f"could not submit it. {response!r}",
+                                "unconfirmed": True}
 
-                elif delta > amount_avail_to_trade:
-                    order = place_order(user_id, auth, 'buy',
-                                        amount_avail_to_trade, ticker)
-                    print(order)
-                    print(
-                        "##################################################################")
+                responses[kind][i] = response
 
-                # check if we are currently at USD and USD is overweight, if so, convert USD to USDC
-                if currency == 'USD' and weight == 'overweight':
-                    conversion = stablecoin_conversion(
-                        auth, 'USD', 'USDC', delta)
-                    print(conversion)
-                    print(
-                        "##################################################################")
+    return responses["order"], responses["conversion"]
 
-                    # break out of this iteration to check deltas
-                    break
 
-                # check if we are currently at USDC and USDC is underweight, if so, convert USD to USDC
-                if currency == 'USDC' and weight == 'overweight':
-                    conversion = stablecoin_conversion(
-                        auth, 'USDC', 'USD', delta)
-                    print(conversion)
-                    print(
-                        "##################################################################")
+async def submit(http, url, auth, params):
+    """POST an order or conversion, turning failures into an error response.
 
-                    # break out of this iteration to check deltas
-                    break
+    Responses marked unconfirmed are for ones that may or may not have been placed."""
 
-        # rerun the rebalance
-        max_rebalances += 1
-        return rebalance_portfolio(user_id, auth, max_rebalances)
+    try:
+        response = await http.post_json(url, params, auth=auth)
 
+    except aiohttp.ClientConnectorError as e:
+        response = {"message": f"could not connect to Coinbase Pro. {e}"}
 
-def find_ticker(curr):
-    """Find relevant ticker (used for placing orders) for a currency."""
-    products = get_products()
+    except RateLimited as e:
+        # a 429 means it was turned away, never placed
+        response = {"message": f"Coinbase Pro is busy, try again in a moment. {e}"}
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # it was sent, so it may have been placed even though we never heard back
+        response = {"message": f"no response from Coinbase Pro. {e}", "unconfirmed": True}
 
-    if g.demo:
+    except ValueError as e:
+        # i.e.: an HTML error page from a proxy, which says nothing about the order
+        response = {"message": f"unreadable response from Coinbase Pro. {e}", "unconfirmed": True}
 
-        potential_tickers = [f'{curr}-USD', f'{curr}-USDC', f'{curr}-BTC']
+    if not isinstance(response, dict):
+        response = {"message": f"unexpected response from Coinbase Pro. {response!r}",
+                    "unconfirmed": True}
 
-    if not g.demo:
+    print(params, response)
 
-        potential_tickers = [f'{curr}-USD']
+    return response
 
-    for ticker in potential_tickers:
-        # find the first relevant ticker match within the accessible products
-        if ticker in products:
-            return ticker
+
+def find_ticker(curr):
+    """Find relevant ticker (used for placing orders) for a currency."""
+
+    quote_preference = DEMO_QUOTE_PREFERENCE if g.demo else QUOTE_PREFERENCE
+
+    # the first relevant ticker match within the accessible products
+    return get_catalog(g.api_url).find_ticker(curr, quote_preference)
 
 
 def stablecoin_conversion(auth, from_currency, to_currency, amount):
@@ -409,7 +633,7 @@ def stablecoin_conversion(auth, from_currency, to_currency, amount):
         "amount": amount
     }
 
-    response = requests.post(
+    response = client.post(
         g.api_url + 'conversions', data=json.dumps(params), auth=auth)
 
     data = response.json()
@@ -417,41 +641,13 @@ def stablecoin_conversion(auth, from_currency, to_currency, amount):
 
 
 def convert_currency(from_currency, amount, to_currency='USD'):
+    """Convert an amount of one currency to another using CoinGecko prices.
 
-    from_curr = from_currency.lower()
-    to_curr = to_currency.lower()
-
-    if from_curr == 'usd' and to_curr == 'usd':
-        return amount
-
-    if to_curr == 'usdc':
-        to_curr = 'usd'
+    To convert several currencies at once, use get_price_matrix instead."""
 
-    from_curr = get_coingecko_id(from_curr)
+    prices = get_price_matrix([from_currency], [to_currency])
 
-    params = {
-        "ids": from_curr,
-        "vs_currencies": to_curr
-    }
-
-    headers = {
-        'Accepts': 'application/json',
-    }
-
-    try:
-        response = requests.get(
-            COINGECKO_API_URL + 'simple/price', params=params, headers=headers)
-
-    except:
-        print(f"could not get price for {from_curr} in {to_curr}.")
-
-    json = response.json()
-    data = json[from_curr]
-    price = data[to_curr]
-
-    converted_amount = float(price) * float(amount)
-
-    return converted_amount
+    return prices.convert(from_currency, amount, to_currency)
 
 
 def validate_order(order):
@@ -475,16 +671,9 @@ def validate_order(order):
 def get_coingecko_id(symbol):
     """Get the currency id in coingecko using the currency symbol (i.e.: "BAT")."""
 
-    try:
-
-        response = requests.get(
-            COINGECKO_API_URL + 'coins/list')
-
-        data = response.json()
+    curr_id = coingecko_ids.resolve(symbol)
 
-        curr_id = [curr["id"] for curr in data if curr["symbol"]
-                   == symbol and curr['id'] != 'batcoin'][0]
-        return curr_id
+    if curr_id is None:
+        print(f"could not get coingecko id for {symbol}.")
 
-    except (IndexError, UnboundLocalError) as e:
-        print(f"could not get coingecko id for {symbol}.", e)
+    return curr_id
@@ -0,0 +1,192 @@
+"""Portfolio history for the dashboard charts.
+
+Every refresh of a user's accounts may add a raw snapshot of their balances, at most one
+per HISTORY_INTERVAL. Each snapshot is also folded into hourly, daily and weekly rollups,
+which keep the balances of the last snapshot within the hour, day or week. Raw snapshots
+and rollups are pruned to their retention as they are written, so a range query reads at
+most about HISTORY_MAX_POINTS points per currency from whichever level fits.
+"""
+
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from models import db, Account, PortfolioSnapshot, PortfolioRollup
+from helpers.helpers import upsert_rows
+
+
+# shortest time between two raw snapshots of the same user, in seconds
+HISTORY_INTERVAL = int(os.environ.get("HISTORY_INTERVAL", 5 * 60))
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+# weeks start on a Thursday, as the epoch did
+WEEK = 7 * DAY
+
+# rollup resolutions, finest first
+ROLLUPS = (HOUR, DAY, WEEK)
+
+# {resolution: how long it is kept, in seconds}, where resolution None is raw snapshots
+HISTORY_RETENTION = {
+    None: int(os.environ.get("HISTORY_RAW_RETENTION", 2 * DAY)),
+    HOUR: int(os.environ.get("HISTORY_HOURLY_RETENTION", 90 * DAY)),
+    DAY: int(os.environ.get("HISTORY_DAILY_RETENTION", 5 * 365 * DAY)),
+    WEEK: int(os.environ.get("HISTORY_WEEKLY_RETENTION", 5 * 365 * DAY)),
+}
+
+# most points per currency a range query should return
+HISTORY_MAX_POINTS = int(os.environ.get("HISTORY_MAX_POINTS", 500))
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket(ts, resolution):
+    """Get the start of the bucket ts falls in, i.e.: the start of its hour."""
+
+    seconds = int((ts - EPOCH).total_seconds())
+
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+
+def record_snapshot(user_id, now=None):
+    """Add the user's stored balances to their history, unless the last snapshot is too recent.
+
+    Returns True if a snapshot was added. The caller commits."""
+
+    now = now or datetime.utcnow()
+
+    last = db.session.query(func.max(PortfolioSnapshot.ts)).filter_by(
+        user_id=user_id).scalar()
+
+    if last is not None and (now - last).total_seconds() < HISTORY_INTERVAL:
+        return False
+
+    accounts = db.session.query(Account.currency, Account.balance_native,
+                                Account.balance_usd).filter_by(user_id=user_id).all()
+
+    if not accounts:
+        return False
+
+    rows = [{"user_id": user_id, "ts": now, "currency": currency,
+             "balance_native": balance_native, "balance_usd": balance_usd}
+            for currency, balance_native, balance_usd in accounts]
+
+    db.session.bulk_insert_mappings(PortfolioSnapshot, rows)
+
+    # the latest snapshot in a bucket is the bucket's value, so currencies it no longer
+    # holds are dropped from the bucket rather than left at an earlier balance
+    for resolution in ROLLUPS:
+        PortfolioRollup.query.filter(
+            PortfolioRollup.user_id == user_id,
+            PortfolioRollup.resolution == resolution,
+            PortfolioRollup.ts == bucket(now, resolution),
+            PortfolioRollup.currency.notin_([row["currency"] for row in rows])
+        ).delete(synchronize_session=False)
+
+        upsert_rows(PortfolioRollup,
+                    [dict(row, resolution=resolution, ts=bucket(now, resolution))
+                     for row in rows],
+                    ['user_id', 'resolution', 'ts', 'currency'],
+                    ['balance_native', 'balance_usd'])
+
+    # pruning once an hour is plenty
+    if last is None or bucket(last, HOUR) != bucket(now, HOUR):
+        prune(user_id, now)
+
+    return True
+
+
+def prune(user_id, now):
+    """Delete the user's raw snapshots and rollups that are past their retention."""
+
+    PortfolioSnapshot.query.filter(
+        PortfolioSnapshot.user_id == user_id,
+        PortfolioSnapshot.ts < now - timedelta(seconds=HISTORY_RETENTION[None])
+    ).delete(synchronize_session=False)
+
+    for resolution in ROLLUPS:
+        PortfolioRollup.query.filter(
+            PortfolioRollup.user_id == user_id,
+            PortfolioRollup.resolution == resolution,
+            PortfolioRollup.ts < now - timedelta(seconds=HISTORY_RETENTION[resolution])
+        ).delete(synchronize_session=False)
+
+
+def parse_timestamp(value, default=None):
+    """Get the datetime of a unix timestamp given as a string, or default if there is none.
+
+    Raises ValueError for anything that isn't a timestamp from 1970 to 9999."""
+
+    if value is None or value == '':
+        return default
+
+    try:
+        seconds = float(value)
+        if seconds < 0:
+            raise ValueError
+        return datetime.utcfromtimestamp(seconds)
+
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f"{value!r} is not a unix timestamp.")
+
+
+def resolution_for(start, end, now=None):
+    """Get the finest resolution that covers start to end in HISTORY_MAX_POINTS points or fewer.
+
+    None means raw snapshots. If none does, the coarsest, whose points portfolio_history
+    thins out to HISTORY_MAX_POINTS."""
+
+    now = now or datetime.utcnow()
+    span = (end - start).total_seconds()
+
+    for resolution in (None,) + ROLLUPS[:-1]:
+        retained_since = now - timedelta(seconds=HISTORY_RETENTION[resolution])
+
+        if span / (resolution or HISTORY_INTERVAL) <= HISTORY_MAX_POINTS and start >= retained_since:
+            return resolution
+
+    return ROLLUPS[-1]
+
+
+def portfolio_history(user_id, start, end):
+    """Get the user's balances from start to end, at the resolution that fits, i.e.:
+
+        {"resolution": 3600, "points": [{"ts": "2020-06-01T10:00:00Z", "total": 1520.5,
+                                         "balances": {"BTC": 1020.5, "USD": 500}}, ...]}
+    """
+
+    resolution = resolution_for(start, end)
+
+    if resolution is None:
+        model = PortfolioSnapshot
+        filters = [model.user_id == user_id, model.ts >= start]
+    else:
+        model = PortfolioRollup
+        filters = [model.user_id == user_id, model.resolution == resolution,
+                   model.ts >= bucket(start, resolution)]
+
+    rows = db.session.query(model.ts, model.currency, model.balance_usd).filter(
+        *filters, model.ts <= end).order_by(model.ts)
+
+    points = OrderedDict()
+
+    for ts, currency, balance_usd in rows:
+        point = points.get(ts)
+
+        if point is None:
+            point = points[ts] = {"ts": ts.isoformat() + 'Z', "total": 0, "balances": {}}
+
+        point["total"] += balance_usd
+        point["balances"][currency] = balance_usd
+
+    points = list(points.values())
+
+    # only a range longer than the weekly rollups cover at this many points can be over,
+    # so keep every stride-th point counting back from the latest
+    stride = -(-len(points) // HISTORY_MAX_POINTS)
+    if stride > 1:
+        points = points[::-1][::stride][::-1]
+
+    return {"resolution": (resolution or HISTORY_INTERVAL) * stride, "points": points}
@@ -0,0 +1,126 @@
+"""Who is making the request, looked up lazily and cached per worker.
+
+Most requests only need the user's id and credentials, so each worker keeps a small
+UserRecord per user for up to USER_CACHE_TTL seconds, and g.user and g.auth are only
+looked up the first time a view or template uses them. Requests that never do, i.e.:
+static files or anonymous visitors, don't query Postgres at all. Every page rendered
+from base.html reads g.user, so for a logged in user it costs one query whenever their
+record isn't cached (at most once per USER_CACHE_TTL per worker), and none otherwise.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g
+from flask.ctx import _AppCtxGlobals
+
+from models import db, User, Credentials
+from helpers import signers
+from helpers.per_process import per_process
+
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+
+# longest a worker serves a cached user record, which bounds how long a credential
+# change made through another worker can go unnoticed
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60))
+
+
+class UserRecord:
+    """The parts of a User most requests need, safe to keep outside of a db session."""
+
+    def __init__(self, id, api_key, credentials, last_active_at):
+        self.id = id
+        self.api_key = api_key
+        self.credentials = credentials
+        self.last_active_at = last_active_at
+        self.loaded_at = time.time()
+
+    def __repr__(self):
+        return f"<UserRecord #{self.id}: {self.api_key}>"
+
+
+# {user id: UserRecord}, least recently used first
+_records = per_process(OrderedDict)
+_lock = threading.Lock()
+
+
+def load_user(user_id):
+    """Get the user's UserRecord, from this worker's cache if it is recent, or None."""
+
+    records = _records()
+
+    with _lock:
+        record = records.get(user_id)
+
+        if record is not None and time.time() - record.loaded_at < USER_CACHE_TTL:
+            records.move_to_end(user_id)
+            return record
+
+    row = db.session.query(User.id, User.api_key, User.cb_secret, User.cb_passphrase,
+                           User.last_active_at).filter_by(id=user_id).first()
+
+    if row is None:
+        forget(user_id)
+        return None
+
+    credentials = None if row.cb_secret is None else Credentials(
+        row.api_key, row.cb_secret, row.cb_passphrase)
+    record = UserRecord(row.id, row.api_key, credentials, row.last_active_at)
+
+    with _lock:
+        records[user_id] = record
+        records.move_to_end(user_id)
+
+        while len(records) > USER_CACHE_SIZE:
+            records.popitem(last=False)
+
+    return record
+
+
+def forget(user_id):
+    """Drop the user's cached record and signer, i.e.: on logout or when their credentials change."""
+
+    with _lock:
+        _records().pop(user_id, None)
+
+    signers.forget(user_id)
+
+
+def loaded_user():
+    """Get the request's UserRecord if something already looked it up, without looking it up."""
+
+    return g.__dict__.get('_user')
+
+
+class RequestGlobals(_AppCtxGlobals):
+    """flask.g, where user and auth are looked up from g.user_id the first time they're used.
+
+    Either can still be assigned directly, i.e.: g.auth for demo sessions."""
+
+    @property
+    def user(self):
+        if '_user' not in self.__dict__:
+            user_id = self.get('user_id')
+            self._user = None if user_id is None else load_user(user_id)
+
+        return self._user
+
+    @user.setter
+    def user(self, value):
+        self._user = value
+
+    @property
+    def auth(self):
+        if '_auth' not in self.__dict__:
+            user = self.user
+            self._auth = None if user is None else signers.get_signer(
+                user.id, user.credentials)
+
+        return self._auth
+
+    @auth.setter
+    def auth(self, value):
+        self._auth = value
@@ -0,0 +1,390 @@
+"""Request, outbound call, query, cache and stage metrics, exposed on /metrics.
+
+Each worker process keeps its own counters and histograms and writes them to METRICS_DIR
+(one file per process) at most every METRICS_FLUSH_INTERVAL. /metrics adds up the files
+of every worker that is still running, so a scrape sees the whole gunicorn server
+whichever worker answers it, and deletes the files of workers that exited.
+
+/metrics answers requests carrying METRICS_TOKEN as a bearer token, or without one
+configured, only requests from the same host.
+
+Requests sent with an X-Timing header get a Server-Timing header back, breaking the
+request's time down into Coinbase Pro, CoinGecko, database and rebalance stage time.
+"""
+
+import contextvars
+import errno
+import glob
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from helpers.per_process import per_process
+
+
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), 'cfinance-metrics'))
+
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+
+# bearer token /metrics requires, i.e.: the one Prometheus is configured to send
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+LOOPBACK_ADDRS = {'127.0.0.1', '::1'}
+
+# latency histogram buckets, in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+TIMING_HEADER = 'X-Timing'
+
+HELP = {
+    'cfinance_request_seconds': "Time spent handling requests, by endpoint.",
+    'cfinance_requests_total': "Requests handled, by endpoint and status class.",
+    'cfinance_outbound_seconds': "Time spent on Coinbase Pro and CoinGecko calls.",
+    'cfinance_outbound_errors_total': "Coinbase Pro and CoinGecko calls that failed or returned an error status.",
+    'cfinance_rate_limited_total': "429 responses from Coinbase Pro and CoinGecko, by host.",
+    'cfinance_db_query_seconds': "Time spent executing SQL statements.",
+    'cfinance_db_errors_total': "SQL statements that raised an error.",
+    'cfinance_stage_seconds': "Time spent in instrumented stages, i.e.: rebalance planning.",
+    'cfinance_cache_lookups_total': "Cache lookups, by cache and result (hit, stale or miss).",
+    'cfinance_cache_hit_ratio': "Fraction of cache lookups answered from the cache (hit or stale).",
+}
+
+
+class Registry:
+    """This process's counters and histograms, keyed by (name, labels)."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def snapshot(self):
+        """Get the registry as a JSON-serializable dict."""
+
+        with self._lock:
+            return {
+                "counters": [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, dict(labels), dict(histogram, buckets=list(histogram["buckets"]))]
+                               for (name, labels), histogram in self.histograms.items()]
+            }
+
+
+_registry = per_process(Registry)
+_last_flush = 0
+
+
+def get_registry():
+    """Get this worker process's registry, never one inherited across a fork."""
+
+    return _registry()
+
+
+# the Server-Timing breakdown of the request a fan-out on the worker's event loop runs for
+fanout_timings = contextvars.ContextVar('fanout_timings', default=None)
+
+
+def request_timings():
+    """Get the current request's Server-Timing breakdown, or None if there is none."""
+
+    if has_request_context():
+        return getattr(g, 'timings', None)
+
+    return fanout_timings.get()
+
+
+def add_timing(category, seconds):
+    """Add to the current request's Server-Timing breakdown, if there is a request."""
+
+    timings = request_timings()
+
+    if timings is not None:
+        total, count = timings.get(category, (0, 0))
+        timings[category] = (total + seconds, count + 1)
+
+
+def provider(url):
+    return 'coingecko' if 'coingecko' in url else 'coinbase'
+
+
+def record_outbound(url, method, seconds, status=None, error=None):
+    """Record a Coinbase Pro or CoinGecko call. error is an exception class name, if it raised."""
+
+    registry = get_registry()
+    name = provider(url)
+
+    registry.observe('cfinance_outbound_seconds', {
+                     "provider": name, "method": method}, seconds)
+
+    if error or (status and status >= 400):
+        registry.inc('cfinance_outbound_errors_total', {
+                     "provider": name, "reason": error or str(status)})
+
+    add_timing(name, seconds)
+
+
+def record_cache(cache, result):
+    """Record a cache lookup, result is 'hit', 'stale' or 'miss'."""
+
+    get_registry().inc('cfinance_cache_lookups_total',
+                       {"cache": cache, "result": result})
+
+
+@contextmanager
+def timed(stage):
+    """Time a block as a stage, i.e.: with timed('rebalance_plan'): ..."""
+
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+
+        get_registry().observe('cfinance_stage_seconds', {"stage": stage}, seconds)
+        add_timing(stage, seconds)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+
+    get_registry().observe('cfinance_db_query_seconds', {}, seconds)
+    add_timing('db', seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _query_error(context):
+    started = context.connection.info.get('query_started') if context.connection else None
+    if started:
+        started.pop()
+
+    get_registry().inc('cfinance_db_errors_total', {
+        "reason": type(context.original_exception).__name__})
+
+
+def flush(force=False):
+    """Write this process's metrics to METRICS_DIR, at most every METRICS_FLUSH_INTERVAL."""
+
+    global _last_flush
+
+    now = time.time()
+
+    if not force and now - _last_flush < METRICS_FLUSH_INTERVAL:
+        return
+
+    _last_flush = now
+
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(get_registry().snapshot(), f)
+        os.replace(tmp_path, os.path.join(
+            METRICS_DIR, f"metrics-{os.getpid()}.json"))
+
+    except OSError as e:
+        print("could not write metrics.", e)
+
+
+def is_running(pid):
+    """Whether a process with this pid is running on this host."""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means it exists but belongs to someone else
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def collect():
+    """Add up the flushed metrics of every running worker into one snapshot.
+
+    Files left by workers that exited are deleted, so a restarted or recycled worker's
+    counters aren't added on top of its replacement's."""
+
+    counters = {}
+    histograms = {}
+
+    for path in glob.glob(os.path.join(METRICS_DIR, 'metrics-*.json')):
+        try:
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+        except ValueError:
+            continue
+
+        if not is_running(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+
+        for name, labels, histogram in snapshot["histograms"]:
+            key = (name, tuple(sorted(labels.items())))
+            total = histograms.setdefault(
+                key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+
+    return counters, histograms
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render(counters, histograms):
+    """Render collected metrics in the Prometheus text format."""
+
+    lines = []
+    seen = set()
+
+    def header(name, kind):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        header(name, 'histogram')
+
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+
+        lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {histogram['count']}")
+        lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+
+    # {cache: [answered from cache, lookups]}
+    lookups = {}
+    for (name, labels), value in counters.items():
+        if name == 'cfinance_cache_lookups_total':
+            labels = dict(labels)
+            totals = lookups.setdefault(labels["cache"], [0, 0])
+            totals[0] += value if labels["result"] != 'miss' else 0
+            totals[1] += value
+
+    for cache, (cached, total) in sorted(lookups.items()):
+        header('cfinance_cache_hit_ratio', 'gauge')
+        lines.append(f'cfinance_cache_hit_ratio{{cache="{cache}"}} {cached / total}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def authorized():
+    """Whether the request may read /metrics."""
+
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''),
+                                   f"Bearer {METRICS_TOKEN}")
+
+    return request.remote_addr in LOOPBACK_ADDRS
+
+
+def metrics_view():
+    if not authorized():
+        return Response("forbidden\n", status=403, mimetype='text/plain')
+
+    flush(force=True)
+
+    return Response(render(*collect()), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Time every request, add the Server-Timing header on request and serve /metrics."""
+
+    @app.before_request
+    def start_timing():
+        g.request_started = time.perf_counter()
+        g.timings = {}
+
+    @app.after_request
+    def record_request(response):
+        started = getattr(g, 'request_started', None)
+
+        if started is None:
+            return response
+
+        seconds = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+
+        registry = get_registry()
+        registry.observe('cfinance_request_seconds', {"endpoint": endpoint}, seconds)
+        registry.inc('cfinance_requests_total', {
+                     "endpoint": endpoint, "status": f"{response.status_code // 100}xx"})
+
+        if request.headers.get(TIMING_HEADER):
+            timings = [f'{category};dur={total * 1000:.1f};desc="{count} calls"'
+                       for category, (total, count) in g.timings.items()]
+            timings.append(f'total;dur={seconds * 1000:.1f}')
+            response.headers['Server-Timing'] = ', '.join(timings)
+
+        flush()
+
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,46 @@
+"""State every worker process keeps for itself, never one inherited across a fork.
+
+gunicorn forks its workers from a process that may already have made sessions, thread
+pools, event loops or caches. Pooled sockets can't be shared between processes and
+threads don't survive a fork, so each worker makes its own the first time it asks.
+"""
+
+import os
+import threading
+
+
+class PerProcess:
+    """The result of calling factory, made once in each process that asks for it."""
+
+    def __init__(self, factory):
+        self.factory = factory
+
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<PerProcess {getattr(self.factory, '__name__', self.factory)} pid={self._pid}>"
+
+    def __call__(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self.factory()
+                    self._pid = os.getpid()
+
+        return self._value
+
+    def peek(self):
+        """Get this process's value if it made one already, or None, without making it."""
+
+        return self._value if self._pid == os.getpid() else None
+
+
+def per_process(factory):
+    """Wrap a factory so each process calls it once and then reuses the result, i.e.:
+
+        get_session = per_process(make_session)
+    """
+
+    return PerProcess(factory)
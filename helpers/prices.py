@@ -0,0 +1,223 @@
+"""Batched currency prices from CoinGecko's simple/price endpoint.
+
+simple/price accepts comma separated ids and vs_currencies, so a whole portfolio
+can be priced against every quote currency it needs in a single request. Prices are
+kept in the shared cache for PRICES_TTL, per coin and vs currency, so only the coins no
+worker on the host has priced recently are requested.
+"""
+
+import asyncio
+import os
+
+from helpers import client, metrics
+from helpers.coingecko import COINGECKO_API_URL, resolver as coingecko_ids
+from helpers.shared_cache import cache as shared_cache
+
+
+# used for converting currencies from native to USD
+USD_REFERENCE = 'usd'
+
+# coingecko ids per simple/price request when fanning out concurrently
+PRICE_CHUNK_SIZE = int(os.environ.get("PRICE_CHUNK_SIZE", 25))
+
+# CoinGecko updates its prices about once a minute, so fetched ones are reused this long
+PRICES_TTL = int(os.environ.get("PRICES_TTL", 30))
+
+HEADERS = {
+    'Accepts': 'application/json',
+}
+
+
+def normalize_vs_currency(currency):
+    """CoinGecko has no USDC quote, so USDC amounts are quoted in USD."""
+
+    currency = currency.lower()
+
+    if currency == 'usdc':
+        return USD_REFERENCE
+
+    return currency
+
+
+class PriceMatrix:
+    """Prices for a set of currencies, each quoted in a set of vs currencies.
+
+    Prices are keyed by lowercased currency symbol, i.e.: {"btc": {"usd": 9000.0}}.
+    Looking up a price that wasn't fetched raises a KeyError."""
+
+    def __init__(self, prices=None):
+        self.prices = prices or {}
+
+    def __repr__(self):
+        return f"<PriceMatrix {self.prices}>"
+
+    def price(self, from_currency, to_currency=USD_REFERENCE):
+        """Get the price of one unit of from_currency in to_currency."""
+
+        from_curr = from_currency.lower()
+        to_curr = normalize_vs_currency(to_currency)
+
+        if from_curr == USD_REFERENCE and to_curr == USD_REFERENCE:
+            return 1
+
+        return self.prices[from_curr][to_curr]
+
+    def get(self, from_currency, to_currency=USD_REFERENCE, default=None):
+        """Get the price of one unit of from_currency in to_currency, or default if it wasn't fetched."""
+
+        try:
+            return self.price(from_currency, to_currency)
+        except KeyError:
+            return default
+
+    def convert(self, from_currency, amount, to_currency=USD_REFERENCE):
+        """Convert an amount of from_currency to to_currency."""
+
+        if from_currency.lower() == USD_REFERENCE and normalize_vs_currency(to_currency) == USD_REFERENCE:
+            return amount
+
+        return float(self.price(from_currency, to_currency)) * float(amount)
+
+    def update(self, other):
+        """Add the prices from another PriceMatrix."""
+
+        self.prices.update(other.prices)
+
+
+def resolve_price_ids(currencies):
+    """Get {coingecko id: [symbols]} for the currencies, several symbols may resolve to the same coin.
+
+    Currencies CoinGecko doesn't list are left out."""
+
+    ids = {}
+
+    for currency in set(c.lower() for c in currencies):
+        if currency == USD_REFERENCE:
+            continue
+
+        curr_id = coingecko_ids.resolve(currency)
+
+        if curr_id is None:
+            print(f"could not get coingecko id for {currency}.")
+            continue
+
+        ids.setdefault(curr_id, []).append(currency)
+
+    return ids
+
+
+def price_params(ids, vs_curr):
+    return {
+        "ids": ",".join(sorted(ids)),
+        "vs_currencies": ",".join(vs_curr)
+    }
+
+
+def price_key(curr_id, vs_curr):
+    return f"price:{curr_id}:{vs_curr}"
+
+
+def cached_prices(ids, vs_curr):
+    """Get the prices already in the shared cache, and the ids that still need to be fetched.
+
+    Returns ({coingecko id: {vs currency: price}}, [coingecko ids])."""
+
+    cached = shared_cache.get_many(price_key(curr_id, vs) for curr_id in ids for vs in vs_curr)
+
+    data = {}
+    missing = []
+
+    for curr_id in ids:
+        keys = [price_key(curr_id, vs) for vs in vs_curr]
+
+        if all(key in cached for key in keys):
+            data[curr_id] = {vs: cached[key] for vs, key in zip(vs_curr, keys)}
+            metrics.record_cache('prices', 'hit')
+        else:
+            missing.append(curr_id)
+            metrics.record_cache('prices', 'miss')
+
+    return data, missing
+
+
+def store_prices(data, ids, vs_curr):
+    """Put the prices for ids from a simple/price response in the shared cache."""
+
+    shared_cache.set_many({price_key(curr_id, vs): data[curr_id][vs]
+                           for curr_id in ids if isinstance(data.get(curr_id), dict)
+                           for vs in vs_curr if vs in data[curr_id]}, PRICES_TTL)
+
+
+def prices_from_response(ids, data):
+    """Map a simple/price response keyed by coingecko id back to {symbol: {vs currency: price}}."""
+
+    prices = {}
+
+    for curr_id, symbols in ids.items():
+        if curr_id in data:
+            for symbol in symbols:
+                prices[symbol] = data[curr_id]
+
+    return prices
+
+
+def get_price_matrix(currencies, vs_currencies=(USD_REFERENCE,)):
+    """Price every currency against every vs currency with one simple/price request.
+
+    Currencies CoinGecko doesn't list are left out of the matrix."""
+
+    vs_curr = sorted(set(normalize_vs_currency(c) for c in vs_currencies))
+
+    ids = resolve_price_ids(currencies)
+
+    if not ids or not vs_curr:
+        return PriceMatrix()
+
+    data, missing = cached_prices(ids, vs_curr)
+
+    if missing:
+        response = client.get_shared(
+            COINGECKO_API_URL + 'simple/price', params=price_params(missing, vs_curr), headers=HEADERS)
+        fetched = response.json()
+
+        store_prices(fetched, missing, vs_curr)
+        data.update((curr_id, fetched[curr_id]) for curr_id in missing if curr_id in fetched)
+
+    return PriceMatrix(prices_from_response(ids, data))
+
+
+async def fetch_price_matrix(http, currencies, vs_currencies=(USD_REFERENCE,)):
+    """Async get_price_matrix for an AsyncClient fan-out.
+
+    Uncached ids are requested in chunks of PRICE_CHUNK_SIZE, all chunks concurrently,
+    and the coins list index and shared cache are read off the event loop."""
+
+    vs_curr = sorted(set(normalize_vs_currency(c) for c in vs_currencies))
+
+    loop = asyncio.get_event_loop()
+    ids = await loop.run_in_executor(None, resolve_price_ids, list(currencies))
+
+    if not ids or not vs_curr:
+        return PriceMatrix()
+
+    data, missing = await loop.run_in_executor(None, cached_prices, ids, vs_curr)
+
+    curr_ids = sorted(missing)
+    chunks = [curr_ids[i:i + PRICE_CHUNK_SIZE]
+              for i in range(0, len(curr_ids), PRICE_CHUNK_SIZE)]
+
+    responses = await asyncio.gather(*[
+        http.get_json(COINGECKO_API_URL + 'simple/price',
+                      params=price_params(chunk, vs_curr), headers=HEADERS, shared=True)
+        for chunk in chunks])
+
+    fetched = {}
+    for response in responses:
+        fetched.update(response)
+
+    if curr_ids:
+        await loop.run_in_executor(None, store_prices, fetched, curr_ids, vs_curr)
+
+    data.update((curr_id, fetched[curr_id]) for curr_id in curr_ids if curr_id in fetched)
+
+    return PriceMatrix(prices_from_response(ids, data))
@@ -0,0 +1,197 @@
+"""Adaptive token-bucket rate limiting for calls to Coinbase Pro and CoinGecko.
+
+A bucket holds up to burst tokens and refills at rate tokens per second, and every call
+takes one. Callers that find it empty wait for their token rather than being turned
+away, unless the wait would be longer than they can afford, in which case they get a
+RateLimited error. Buckets are shared by every thread (and event loop) of a worker.
+
+Every host gets its own bucket for public calls, and every API key its own bucket for
+private (authenticated) ones, since that's how Coinbase Pro counts them. A 429 halves
+the bucket's rate and honors the response's Retry-After, and the rate creeps back up
+to its limit with every call that isn't throttled.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from helpers import metrics
+from helpers.per_process import per_process
+
+
+# Coinbase Pro's limits for private (authenticated) endpoints, per API key and worker process
+COINBASE_PRIVATE_RATE = float(os.environ.get("COINBASE_PRIVATE_RATE", 5))
+COINBASE_PRIVATE_BURST = int(os.environ.get("COINBASE_PRIVATE_BURST", 10))
+
+# {host: (rate, burst)} for public calls, from each provider's published limits
+HOST_LIMITS = {
+    'api.pro.coinbase.com': (3, 6),
+    'api-public.sandbox.pro.coinbase.com': (3, 6),
+    'api.coingecko.com': (float(os.environ.get("COINGECKO_RATE", 50 / 60)), 10),
+}
+
+# limits for public calls to any other host
+HTTP_DEFAULT_RATE = float(os.environ.get("HTTP_DEFAULT_RATE", 20))
+HTTP_DEFAULT_BURST = int(os.environ.get("HTTP_DEFAULT_BURST", 40))
+
+# longest a caller waits for a token before getting a RateLimited error, in seconds
+HTTP_RATE_LIMIT_MAX_WAIT = float(os.environ.get("HTTP_RATE_LIMIT_MAX_WAIT", 10))
+
+# throttled buckets never slow below this fraction of their limit
+MIN_RATE_FRACTION = .1
+
+# fraction of its limit a bucket's rate recovers by with every call that isn't throttled
+RECOVERY_FRACTION = .05
+
+
+class RateLimited(Exception):
+    """A call wasn't made because the provider's rate limit would have been exceeded.
+
+    retry_after is how many seconds until it is expected to go through."""
+
+    def __init__(self, host, retry_after):
+        super().__init__(f"rate limited by {host}, retry in {retry_after:.1f}s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value, now=None):
+    """Get the seconds to wait from a Retry-After header (delta seconds or an HTTP date), or None.
+
+    now is the current unix time, for dates."""
+
+    if not value:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - (now or time.time()))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allows rate calls per second on average, and up to burst at once.
+
+    clock is where the bucket reads the time from, in seconds."""
+
+    def __init__(self, rate, burst, name=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self.clock = clock
+
+        self._tokens = burst
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name} {self.rate:.2f}/s burst={self.burst}>"
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens +
+                           (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _wait(self, now):
+        """Seconds until the next token, once the one just taken is accounted for."""
+
+        return max(0, -self._tokens / self.rate)
+
+    def reserve(self, max_wait=None):
+        """Take a token, returning how many seconds to wait before using it.
+
+        Raises RateLimited without taking one if the wait would be over max_wait."""
+
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+
+            # tokens can go negative, which queues callers up behind each other
+            self._tokens -= 1
+            wait = self._wait(now)
+
+            if max_wait is not None and wait > max_wait:
+                self._tokens += 1
+                raise RateLimited(self.name, wait)
+
+            return wait
+
+    def acquire(self, max_wait=None):
+        """Wait for a token."""
+
+        time.sleep(self.reserve(max_wait))
+
+    async def acquire_async(self, max_wait=None):
+        """Wait for a token without blocking the event loop."""
+
+        await asyncio.sleep(self.reserve(max_wait))
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """A TokenBucket that slows down when the provider throttles it and recovers after."""
+
+    def __init__(self, rate, burst, name=None, clock=time.monotonic):
+        super().__init__(rate, burst, name, clock)
+
+        self.max_rate = rate
+        self._blocked_until = 0
+
+    def _wait(self, now):
+        return max(super()._wait(now), self._blocked_until - now)
+
+    def throttle(self, retry_after=None):
+        """Record a 429: halve the rate, and hold every call back for retry_after seconds."""
+
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+        metrics.get_registry().inc('cfinance_rate_limited_total', {"host": self.name})
+
+    def succeed(self):
+        """Record a call that wasn't throttled, recovering some of the rate."""
+
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate +
+                                self.max_rate * RECOVERY_FRACTION)
+
+
+_limiters = per_process(dict)
+_lock = threading.Lock()
+
+
+def limiter_for(url, auth=None):
+    """Get this worker's bucket for calls to a url, private to auth's API key if given."""
+
+    host = urlsplit(url).netloc
+    key = (host, getattr(auth, 'api_key', None))
+    limiters = _limiters()
+
+    with _lock:
+        limiter = limiters.get(key)
+
+        if limiter is None:
+            if auth is not None:
+                rate, burst = COINBASE_PRIVATE_RATE, COINBASE_PRIVATE_BURST
+            else:
+                rate, burst = HOST_LIMITS.get(
+                    host, (HTTP_DEFAULT_RATE, HTTP_DEFAULT_BURST))
+
+            limiter = limiters[key] = AdaptiveTokenBucket(rate, burst, host)
+
+    return limiter
@@ -0,0 +1,214 @@
+"""Vectorized rebalance planning.
+
+plan_rebalance takes a portfolio as parallel arrays (one entry per currency) and works
+out every delta, weight and order size in one NumPy pass. project_order and
+project_conversion apply the exchange's responses to a local copy of the balances, so
+the next pass can be planned without fetching the accounts again. None of this does
+any I/O, so fetching balances and prices and placing the orders is left to the caller.
+"""
+
+import math
+
+import numpy as np
+
+
+# fiat and stablecoins aren't traded through a product, they are converted into each other
+STABLECOINS = ('USD', 'USDC')
+
+# {overweight stablecoin: the stablecoin it is converted to}
+CONVERSIONS = {'USD': 'USDC', 'USDC': 'USD'}
+
+# keep rebalancing while any asset is this far (as a fraction of its value) from target
+REBALANCE_THRESHOLD = .01
+
+# orders at or below this many units of the quote currency aren't placed
+MIN_ORDER_SIZE = .01
+
+# expected gap between a projected fill and the real one (fees plus slippage), as a fraction of the fill
+EXPECTED_SLIPPAGE = .005
+
+
+class OrderPlan:
+    """The deltas and orders that bring a portfolio to its target allocations.
+
+    Per-currency arrays are in the order the portfolio was given in. orders are
+    place_order params, i.e.: {"side": "buy", "product_id": "ETH-USD", "funds": 10.0},
+    and conversions are stablecoin_conversion params, i.e.: {"from": "USD", "to": "USDC",
+    "amount": 10.0}."""
+
+    def __init__(self, currencies, usd_values, usd_deltas, pct_deltas, quote_deltas, orders, conversions):
+        self.currencies = currencies
+        self.usd_values = usd_values
+        self.usd_deltas = usd_deltas
+        self.pct_deltas = pct_deltas
+        self.quote_deltas = quote_deltas
+        self.orders = orders
+        self.conversions = conversions
+
+    def __repr__(self):
+        return f"<OrderPlan {len(self.orders)} orders, {len(self.conversions)} conversions>"
+
+    @property
+    def weights(self):
+        return np.where(self.quote_deltas > 0, 'underweight', 'overweight')
+
+    @property
+    def converged(self):
+        """Whether every asset is within REBALANCE_THRESHOLD of its target."""
+
+        return not (self.pct_deltas >= REBALANCE_THRESHOLD).any()
+
+
+def plan_rebalance(currencies, tickers, balances, targets, usd_prices, quote_usd_prices, available,
+                   min_order_size=MIN_ORDER_SIZE):
+    """Plan the orders that move each currency to its target fraction of the portfolio.
+
+    currencies   currency symbols, i.e.: "ETH"
+    tickers      the product each currency is traded through, i.e.: "ETH-BTC", or None
+    balances     native balance of each currency
+    targets      target fraction of the total USD value for each currency
+    usd_prices   USD price of each currency
+    quote_usd_prices  USD price of each ticker's quote currency
+    available    balance of each ticker's quote currency, i.e.: the funds a buy can spend
+
+    Prices that couldn't be fetched should be NaN, and those currencies are left alone.
+
+    Only currencies at least REBALANCE_THRESHOLD off target are traded, and sells are
+    listed before buys. Overweight cash is only converted to the other
+    stablecoin, and only as much as that one is underweight.
+    """
+
+    currencies = np.asarray(currencies, dtype=object)
+    tickers = np.asarray(tickers, dtype=object)
+    balances = np.asarray(balances, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+    usd_prices = np.asarray(usd_prices, dtype=float)
+    quote_usd_prices = np.asarray(quote_usd_prices, dtype=float)
+    available = np.asarray(available, dtype=float)
+
+    usd_values = balances * usd_prices
+    total_usd = np.nansum(usd_values)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        usd_deltas = total_usd * targets - usd_values
+        pct_deltas = np.abs(usd_deltas / usd_values)
+
+        # how much of the quote currency the delta is worth, which is what orders are sized in
+        quote_deltas = usd_deltas / quote_usd_prices
+
+    sizes = np.round(np.abs(quote_deltas), 2)
+
+    # round the available funds down, so a buy never asks for more than is there
+    funds = np.minimum(sizes, np.floor(available * 100) / 100)
+
+    is_stablecoin = np.isin(currencies, STABLECOINS)
+    has_ticker = np.not_equal(tickers, None).astype(bool)
+    tradeable = (pct_deltas >= REBALANCE_THRESHOLD) & (
+        sizes > min_order_size) & has_ticker & ~is_stablecoin
+
+    sells = (quote_deltas < 0) & tradeable
+    buys = (quote_deltas > 0) & tradeable & (funds > 0)
+
+    orders = [{"side": "sell", "product_id": tickers[i], "funds": float(sizes[i])}
+              for i in np.flatnonzero(sells)]
+    orders += [{"side": "buy", "product_id": tickers[i], "funds": float(funds[i])}
+               for i in np.flatnonzero(buys)]
+
+    conversions = []
+
+    stablecoins = {currencies[i]: i for i in np.flatnonzero(is_stablecoin)}
+
+    for from_currency, to_currency in CONVERSIONS.items():
+        if from_currency in stablecoins and to_currency in stablecoins:
+            amount = round(min(-usd_deltas[stablecoins[from_currency]],
+                               usd_deltas[stablecoins[to_currency]]), 2)
+
+            if amount > min_order_size:
+                conversions.append(
+                    {"from": from_currency, "to": to_currency, "amount": float(amount)})
+
+    return OrderPlan(currencies, usd_values, usd_deltas, pct_deltas, quote_deltas, orders, conversions)
+
+
+def order_stages(plan):
+    """Group a plan's orders and conversions into stages whose members can be placed concurrently.
+
+    Sells and conversions free up the quote currencies that buys spend, so they make up
+    the first stage and buys the second. Each stage is a list of ("order", index) and
+    ("conversion", index) pairs into plan.orders and plan.conversions."""
+
+    first = [("order", i) for i, order in enumerate(plan.orders) if order["side"] == 'sell']
+    first += [("conversion", i) for i in range(len(plan.conversions))]
+
+    second = [("order", i) for i, order in enumerate(plan.orders) if order["side"] == 'buy']
+
+    return [stage for stage in (first, second) if stage]
+
+
+def is_accepted(response):
+    """Whether the exchange accepted an order or conversion, i.e.: it has an id and no error message."""
+
+    return bool(response) and not response.get("message") and bool(response.get("id"))
+
+
+def project_order(balances, order, response, usd_prices):
+    """Apply an order response to balances ({currency: native balance}) in place.
+
+    Settled orders are applied with their reported fills. Orders still pending are
+    estimated from their funds and usd_prices ({currency: USD price}).
+
+    Returns the USD value that was estimated rather than reported (0 for settled orders),
+    or None if the order was rejected. Orders whose response never arrived may or may not
+    have been placed, so they make the projection unknown (inf)."""
+
+    if response and response.get("unconfirmed"):
+        return math.inf
+
+    if not is_accepted(response):
+        return None
+
+    base, quote = order["product_id"].split('-')[:2]
+    sign = 1 if order["side"] == 'buy' else -1
+
+    if response.get("settled"):
+        size = float(response.get("filled_size") or 0)
+        value = float(response.get("executed_value") or 0)
+        fees = float(response.get("fill_fees") or 0)
+
+        balances[base] = balances.get(base, 0) + sign * size
+        balances[quote] = balances.get(quote, 0) - sign * value - fees
+
+        return 0
+
+    funds = float(order["funds"])
+    funds_usd = funds * usd_prices.get(quote, math.nan)
+    size = funds_usd / usd_prices.get(base, math.nan)
+
+    # without both prices there is nothing to project with, so treat the state as unknown
+    if math.isnan(size):
+        return math.inf
+
+    balances[base] = balances.get(base, 0) + sign * size
+    balances[quote] = balances.get(quote, 0) - sign * funds
+
+    return funds_usd
+
+
+def project_conversion(balances, conversion, response):
+    """Apply a stablecoin conversion response to balances in place.
+
+    Conversions are 1:1, so nothing is estimated. Returns 0, None if it was rejected, or
+    inf if its response never arrived."""
+
+    if response and response.get("unconfirmed"):
+        return math.inf
+
+    if not is_accepted(response):
+        return None
+
+    amount = float(conversion["amount"])
+
+    balances[conversion["from"]] = balances.get(conversion["from"], 0) - amount
+    balances[conversion["to"]] = balances.get(conversion["to"], 0) + amount
+
+    return 0
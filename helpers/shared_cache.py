@@ -0,0 +1,344 @@
+"""A cache shared by every worker process on a host, stored in a local SQLite file.
+
+gunicorn runs several workers, and each used to download and hold its own copy of the
+product catalog, the CoinGecko coins list and prices. Entries stored here are written
+once for the whole host: every write swaps the value and bumps the entry's version in one
+transaction, and a process only decodes an entry again when its version changed.
+
+Entries expire after their TTL, can keep being served stale for stale_ttl more seconds
+while one worker refreshes them (the others don't call out meanwhile), and are evicted
+from the file after that.
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from helpers import metrics
+
+
+SHARED_CACHE_PATH = os.environ.get(
+    "SHARED_CACHE_PATH", os.path.join(tempfile.gettempdir(), 'cfinance-cache.sqlite3'))
+
+# longest one worker may spend refreshing an entry before another may take over
+SHARED_CACHE_LEASE = 30
+
+# longest to wait for another worker's refresh when there is nothing to serve meanwhile
+SHARED_CACHE_WAIT = 10
+
+# how often each process sweeps evicted entries out of the file, in seconds
+EVICT_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    evict_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) SELECT 'version', COALESCE(MAX(version), 0) FROM entries;
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    until REAL NOT NULL
+);
+"""
+
+
+class Entry:
+    """A decoded cache entry. version goes up every time the key is written, and is never reused."""
+
+    def __init__(self, key, value, version, stored_at, expires_at):
+        self.key = key
+        self.value = value
+        self.version = version
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+
+    def __repr__(self):
+        return f"<Entry {self.key} v{self.version} expires_at={self.expires_at}>"
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires_at
+
+
+class SharedCache:
+    """Versioned, expiring JSON entries in a SQLite file every worker on the host opens."""
+
+    def __init__(self, path=SHARED_CACHE_PATH):
+        self.path = path
+
+        # {key: Entry}, the last version of each entry this process decoded
+        self._decoded = {}
+        self._local = threading.local()
+        self._evicted_at = 0
+
+    def __repr__(self):
+        return f"<SharedCache {self.path}>"
+
+    def _connection(self):
+        """Get this thread's connection, never one inherited across a fork."""
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+            # autocommit, so every statement is its own atomic transaction
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """Run statements as one transaction, holding the write lock from the start."""
+
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+
+    def get(self, key, stale=False):
+        """Get a key's Entry, or None if it is missing or expired (or evicted, if stale)."""
+
+        now = time.time()
+
+        try:
+            row = self._connection().execute(
+                'SELECT version, expires_at, evict_at FROM entries WHERE key = ?', (key,)).fetchone()
+
+            if row is None or row[2] <= now or (not stale and row[1] <= now):
+                return None
+
+            entry = self._decoded.get(key)
+
+            if entry is not None and entry.version == row[0]:
+                return entry
+
+            row = self._connection().execute(
+                'SELECT value, version, stored_at, expires_at FROM entries WHERE key = ?', (key,)).fetchone()
+
+        except sqlite3.Error as e:
+            print("could not read shared cache.", e)
+            return None
+
+        if row is None:
+            return None
+
+        entry = Entry(key, json.loads(row[0]), row[1], row[2], row[3])
+        self._decoded[key] = entry
+
+        return entry
+
+    def get_many(self, keys):
+        """Get {key: value} for the keys that are present and fresh."""
+
+        keys = list(keys)
+        values = {}
+
+        try:
+            # stay well under SQLite's limit on bound parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._connection().execute(
+                    f"SELECT key, value FROM entries WHERE expires_at > ? AND key IN ({','.join('?' * len(chunk))})",
+                    [time.time()] + chunk)
+
+                values.update((key, json.loads(value)) for key, value in rows)
+
+        except sqlite3.Error as e:
+            print("could not read shared cache.", e)
+
+        return values
+
+    def set(self, key, value, ttl, stale_ttl=0):
+        """Store a value for ttl seconds, servable stale for stale_ttl more. Returns its Entry."""
+
+        now = time.time()
+        version = self._write({key: value}, now, ttl, stale_ttl).get(key, 0)
+
+        entry = self._decoded[key] = Entry(key, value, version, now, now + ttl)
+
+        return entry
+
+    def set_many(self, values, ttl, stale_ttl=0):
+        """Store several values with the same TTL, all in one transaction."""
+
+        self._write(values, time.time(), ttl, stale_ttl)
+
+    def _write(self, values, now, ttl, stale_ttl):
+        """Write values, each with a new version. Returns {key: version}."""
+
+        versions = {}
+
+        try:
+            with self._transaction() as connection:
+                # versions come from one counter for the whole file rather than per key, so a
+                # key that is evicted or invalidated and written again never repeats a version
+                # a process may still hold decoded
+                connection.execute("UPDATE counters SET value = value + ? WHERE name = 'version'",
+                                   (len(values),))
+                last = connection.execute(
+                    "SELECT value FROM counters WHERE name = 'version'").fetchone()[0]
+
+                for version, (key, value) in enumerate(values.items(), last - len(values) + 1):
+                    versions[key] = version
+
+                    connection.execute("""
+                        INSERT OR REPLACE INTO entries (key, version, value, stored_at, expires_at, evict_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (key, versions[key], json.dumps(value), now, now + ttl, now + ttl + stale_ttl))
+
+        except sqlite3.Error as e:
+            print("could not write shared cache.", e)
+            return {}
+
+        self.evict()
+
+        return versions
+
+    def invalidate(self, prefix=''):
+        """Drop every entry whose key starts with prefix, i.e.: "catalog:"."""
+
+        self._decoded = {key: entry for key, entry in self._decoded.items()
+                         if not key.startswith(prefix)}
+
+        try:
+            self._connection().execute(
+                "DELETE FROM entries WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+        except sqlite3.Error as e:
+            print("could not clear shared cache.", e)
+
+    def evict(self, force=False):
+        """Delete entries that are past serving stale, at most every EVICT_INTERVAL."""
+
+        now = time.time()
+
+        if not force and now - self._evicted_at < EVICT_INTERVAL:
+            return
+
+        self._evicted_at = now
+
+        try:
+            connection = self._connection()
+            connection.execute('DELETE FROM entries WHERE evict_at <= ?', (now,))
+            connection.execute('DELETE FROM leases WHERE until <= ?', (now,))
+        except sqlite3.Error as e:
+            print("could not evict shared cache entries.", e)
+
+    def lease(self, key):
+        """Try to become the one worker refreshing a key. Returns True if this thread got it."""
+
+        now = time.time()
+
+        try:
+            with self._transaction() as connection:
+                row = connection.execute(
+                    'SELECT until FROM leases WHERE key = ?', (key,)).fetchone()
+
+                if row is not None and row[0] > now:
+                    return False
+
+                connection.execute('INSERT OR REPLACE INTO leases (key, holder, until) VALUES (?, ?, ?)',
+                                   (key, self._holder(), now + SHARED_CACHE_LEASE))
+
+        except sqlite3.Error as e:
+            print("could not lease shared cache entry.", e)
+
+            # without the cache, every worker refreshes for itself
+            return True
+
+        return True
+
+    def release(self, key):
+        try:
+            self._connection().execute(
+                'DELETE FROM leases WHERE key = ? AND holder = ?', (key, self._holder()))
+        except sqlite3.Error as e:
+            print("could not release shared cache lease.", e)
+
+    def _holder(self):
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def fetch(self, key, load, ttl, stale_ttl=0, retry=None, errors=(), name=None):
+        """Get a key's Entry, calling load() to refresh it once it expires.
+
+        Only one worker on the host calls load() for a key at a time. The others serve the
+        stale value meanwhile, or wait up to SHARED_CACHE_WAIT if there isn't one. If load
+        raises one of errors and there is a stale value, it is kept for retry more seconds.
+
+        name labels the cache in metrics, and defaults to the key's prefix."""
+
+        name = name or key.split(':')[0]
+        deadline = time.time() + SHARED_CACHE_WAIT
+
+        while True:
+            entry = self.get(key, stale=True)
+
+            if entry is not None and entry.fresh:
+                metrics.record_cache(name, 'hit')
+                return entry
+
+            leased = self.lease(key)
+
+            if not leased and entry is not None:
+                metrics.record_cache(name, 'stale')
+                return entry
+
+            if leased or time.time() >= deadline:
+                break
+
+            time.sleep(.05)
+
+        try:
+            # another worker may have refreshed it between our read and the lease
+            refreshed = self.get(key)
+            if refreshed is not None:
+                metrics.record_cache(name, 'hit')
+                return refreshed
+
+            metrics.record_cache(name, 'miss')
+
+            try:
+                value = load()
+
+            except errors as e:
+                if entry is None or retry is None:
+                    raise
+
+                # keep serving the stale value and try again shortly
+                print(f"could not refresh {name}.", e)
+                return self.set(key, entry.value, retry, stale_ttl)
+
+            return self.set(key, value, ttl, stale_ttl)
+
+        finally:
+            if leased:
+                self.release(key)
+
+
+cache = SharedCache()
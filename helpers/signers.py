@@ -0,0 +1,54 @@
+"""Per-process cache of ready Coinbase Pro signers, so requests aren't set up from scratch.
+
+Building a signer decodes the user's secret, so each worker keeps the most recently
+used SIGNER_CACHE_SIZE of them, keyed by user id. A signer is rebuilt when the user's
+stored credentials no longer match the ones it was built from.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from models import CoinbaseExchangeAuth
+from helpers.per_process import per_process
+
+
+SIGNER_CACHE_SIZE = int(os.environ.get("SIGNER_CACHE_SIZE", 1024))
+
+# {user id: (Credentials, CoinbaseExchangeAuth)}, least recently used first
+_signers = per_process(OrderedDict)
+_lock = threading.Lock()
+
+
+def get_signer(user_id, credentials):
+    """Get a signer for the user's Credentials, or None if they have none."""
+
+    if credentials is None:
+        return None
+
+    signers = _signers()
+
+    with _lock:
+        entry = signers.get(user_id)
+
+        if entry is not None and entry[0] == credentials:
+            signers.move_to_end(user_id)
+            return entry[1]
+
+    signer = CoinbaseExchangeAuth(*credentials)
+
+    with _lock:
+        signers[user_id] = (credentials, signer)
+        signers.move_to_end(user_id)
+
+        while len(signers) > SIGNER_CACHE_SIZE:
+            signers.popitem(last=False)
+
+    return signer
+
+
+def forget(user_id):
+    """Drop the user's signer, i.e.: when they log out."""
+
+    with _lock:
+        _signers().pop(user_id, None)
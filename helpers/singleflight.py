@@ -0,0 +1,157 @@
+"""Coalesce identical concurrent calls into one.
+
+When many threads ask for the same resource at once (i.e.: right after a cache expired
+or a deploy), the first one makes the call and the others wait for its result instead
+of making their own. Results can also be shared for max_age seconds after the call
+finishes, to absorb bursts that arrive just after it.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from helpers import metrics
+
+
+# how long a finished call's result is shared with later callers, in seconds
+COALESCE_MAX_AGE = float(os.environ.get("COALESCE_MAX_AGE", 1))
+
+# finished calls kept before expired ones are swept out
+MAX_FINISHED_CALLS = 1000
+
+
+def request_key(method, url, params=None, kind='response'):
+    """Key a request by its method, url and params, i.e.: ("response", "GET", url, (("ids", "bitcoin"),)).
+
+    kind keeps callers that get different things back for the same request apart, i.e.:
+    a requests.Response or a decoded JSON body."""
+
+    return (kind, method, url, tuple(sorted((params or {}).items())))
+
+
+class Call:
+    """One call in flight or finished, and its result or error."""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return f"<Call finished_at={self.finished_at}>"
+
+    def shareable(self, max_age):
+        return self.finished_at is None or (
+            self.error is None and time.time() - self.finished_at <= max_age)
+
+    def wait(self):
+        self.done.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, sharing its result with every concurrent caller."""
+
+    def __init__(self, max_age=COALESCE_MAX_AGE):
+        self.max_age = max_age
+
+        # {key: Call}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<SingleFlight {len(self._calls)} calls>"
+
+    def clear(self):
+        """Forget finished calls, so the next caller for every key calls again."""
+
+        with self._lock:
+            self._calls = {key: call for key, call in self._calls.items()
+                           if call.finished_at is None}
+
+    def _join(self, key, max_age):
+        """Get (call, leader), where leader is True if the caller has to make the call."""
+
+        max_age = self.max_age if max_age is None else max_age
+
+        with self._lock:
+            call = self._calls.get(key)
+
+            if call is not None and call.shareable(max_age):
+                metrics.record_cache('coalesced', 'hit')
+                return call, False
+
+            if len(self._calls) >= MAX_FINISHED_CALLS:
+                self._sweep(max_age)
+
+            call = self._calls[key] = Call()
+
+        metrics.record_cache('coalesced', 'miss')
+
+        return call, True
+
+    def _finish(self, key, call, result=None, error=None):
+        call.result = result
+        call.error = error
+        call.finished_at = time.time()
+        call.done.set()
+
+        # failed calls aren't shared after the fact, the next caller tries again
+        if error is not None:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+    def _sweep(self, max_age):
+        now = time.time()
+
+        self._calls = {key: call for key, call in self._calls.items()
+                       if call.finished_at is None or now - call.finished_at <= max_age}
+
+    def do(self, key, function, max_age=None):
+        """Call function(), unless a call for key is in flight or recent enough to share."""
+
+        call, leader = self._join(key, max_age)
+
+        if not leader:
+            return call.wait()
+
+        try:
+            result = function()
+        except BaseException as e:
+            # including cancellation, so waiting callers are never left hanging
+            self._finish(key, call, error=e)
+            raise
+
+        self._finish(key, call, result)
+
+        return result
+
+    async def do_async(self, key, coroutine_function, max_age=None):
+        """Async do(). Calls made in other threads or event loops are shared too."""
+
+        call, leader = self._join(key, max_age)
+
+        if not leader:
+            # the leader may be on another thread's event loop, so wait off this one
+            return await asyncio.get_event_loop().run_in_executor(None, call.wait)
+
+        try:
+            result = await coroutine_function()
+        except BaseException as e:
+            # including cancellation, so waiting callers are never left hanging
+            self._finish(key, call, error=e)
+            raise
+
+        self._finish(key, call, result)
+
+        return result
+
+
+flight = SingleFlight()
@@ -0,0 +1,132 @@
+"""Stale-while-revalidate account snapshots.
+
+A user's Account and CurrentAllocation rows are a snapshot of Coinbase Pro stamped with
+User.accounts_refreshed_at. Pages can serve a recent snapshot without any outbound calls,
+serve a somewhat older one while it is refreshed in a background thread, and only wait
+for Coinbase Pro and CoinGecko when the snapshot is missing or too old.
+"""
+
+import os
+import threading
+from datetime import datetime
+
+from flask import current_app, g
+
+from models import db, User
+from helpers import metrics
+from helpers.helpers import update_user_accounts, update_allocations
+from helpers.history import record_snapshot
+
+
+# snapshots younger than this are served as is
+SNAPSHOT_FRESH_AGE = int(os.environ.get("SNAPSHOT_FRESH_AGE", 30))
+
+# snapshots older than this are refreshed before they are served
+SNAPSHOT_MAX_AGE = int(os.environ.get("SNAPSHOT_MAX_AGE", 10 * 60))
+
+# how often a user's last activity is written
+ACTIVITY_RESOLUTION = int(os.environ.get("ACTIVITY_RESOLUTION", 60))
+
+# users with a background refresh in flight in this worker
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def refresh_user_info(user_id, auth):
+    """Refresh the user's accounts and current allocations and stamp the snapshot."""
+
+    update_user_accounts(user_id, auth)
+    update_allocations(user_id)
+    record_snapshot(user_id)
+
+    User.query.filter_by(id=user_id).update(
+        {"accounts_refreshed_at": datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+
+def snapshot_age(user):
+    """Get the age of the user's snapshot in seconds, or None if it was never refreshed."""
+
+    if user.accounts_refreshed_at is None:
+        return None
+
+    return (datetime.utcnow() - user.accounts_refreshed_at).total_seconds()
+
+
+def refresh_in_context(app, user_id, auth, api_url, demo):
+    """Refresh the user's snapshot outside of a request, i.e.: from a background thread."""
+
+    try:
+        with app.app_context():
+            g.api_url = api_url
+            g.demo = demo
+
+            refresh_user_info(user_id, auth)
+
+    except Exception as e:
+        print(f"could not refresh accounts for user {user_id}.", e)
+
+
+def refresh_in_background(user_id, auth):
+    """Refresh the user's snapshot in a background thread, unless one is already running.
+
+    Returns True if a refresh was started."""
+
+    with _lock:
+        if user_id in _refreshing:
+            return False
+        _refreshing.add(user_id)
+
+    app = current_app._get_current_object()
+    api_url, demo = g.api_url, g.demo
+
+    def run():
+        try:
+            refresh_in_context(app, user_id, auth, api_url, demo)
+
+        finally:
+            with _lock:
+                _refreshing.discard(user_id)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    return True
+
+
+def mark_active(user):
+    """Record that the user is using the app, so the scheduler keeps their snapshot warm.
+
+    user is the request's UserRecord. Written at most once per ACTIVITY_RESOLUTION to
+    keep requests read-only."""
+
+    now = datetime.utcnow()
+
+    if user.last_active_at and (now - user.last_active_at).total_seconds() < ACTIVITY_RESOLUTION:
+        return
+
+    User.query.filter_by(id=user.id).update(
+        {"last_active_at": now}, synchronize_session=False)
+    db.session.commit()
+
+    user.last_active_at = now
+
+
+def ensure_snapshot(user, auth):
+    """Make sure the user's snapshot is recent enough to serve.
+
+    Fresh snapshots are left alone, stale ones are refreshed in the background, and
+    missing or expired ones are refreshed before returning."""
+
+    age = snapshot_age(user)
+
+    if age is not None and age < SNAPSHOT_FRESH_AGE:
+        metrics.record_cache('snapshot', 'hit')
+        return
+
+    if age is not None and age < SNAPSHOT_MAX_AGE:
+        metrics.record_cache('snapshot', 'stale')
+        refresh_in_background(user.id, auth)
+        return
+
+    metrics.record_cache('snapshot', 'miss')
+    refresh_user_info(user.id, auth)
@@ -0,0 +1,239 @@
+"""Last-trade prices streamed from the Coinbase Pro websocket ticker channel.
+
+Each worker process keeps one websocket per Coinbase Pro environment, subscribed to
+every product in the catalog, and remembers the latest ticker and when it arrived for
+each product. Lookups are answered from memory while that ticker is fresher than
+TICKER_MAX_AGE, and fall back to the REST ticker endpoint otherwise, i.e.: before the
+feed has connected or while it is reconnecting.
+
+The rebalance planner sizes its orders with fresh_price, which never falls back, so a
+rebalance prices with the exchange's own last trades where the feed has them and with
+CoinGecko otherwise. A worker's feed starts the first time it is asked for a price.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+
+import aiohttp
+
+from helpers import client, metrics
+from helpers.catalog import get_catalog
+from helpers.per_process import per_process
+
+
+CB_WS_URL = os.environ.get("CB_WS_URL", 'wss://ws-feed.pro.coinbase.com')
+CB_DEMO_WS_URL = os.environ.get(
+    "CB_DEMO_WS_URL", 'wss://ws-feed-public.sandbox.pro.coinbase.com')
+
+# serve tickers up to this many seconds old from memory
+TICKER_MAX_AGE = float(os.environ.get("TICKER_MAX_AGE", 30))
+
+# set TICKER_FEED=0 to always use the REST ticker endpoint
+TICKER_FEED = os.environ.get("TICKER_FEED", '1') != '0'
+
+# longest wait between reconnection attempts, in seconds
+TICKER_RECONNECT_DELAY = 30
+
+
+def rest_ticker(message):
+    """Convert a websocket ticker message to the shape of the REST ticker endpoint's response."""
+
+    return {
+        "trade_id": message.get("trade_id"),
+        "price": message.get("price"),
+        "size": message.get("last_size"),
+        "bid": message.get("best_bid"),
+        "ask": message.get("best_ask"),
+        "volume": message.get("volume_24h"),
+        "time": message.get("time"),
+    }
+
+
+class TickerFeed:
+    """The latest ticker for each product of a Coinbase Pro environment, fed by its websocket."""
+
+    def __init__(self, api_url, feed_url, max_age=TICKER_MAX_AGE):
+        self.api_url = api_url
+        self.feed_url = feed_url
+        self.max_age = max_age
+
+        # {product id: (ticker, time it was received)}
+        self._tickers = {}
+        self._thread = None
+        self._loop = None
+        self._task = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<TickerFeed {self.feed_url} {len(self._tickers)} products>"
+
+    def get(self, product_id):
+        """Get the product's ticker if it is fresh, or None."""
+
+        entry = self._tickers.get(product_id)
+
+        if entry and time.time() - entry[1] < self.max_age:
+            return entry[0]
+
+        return None
+
+    def put(self, product_id, ticker, received_at=None):
+        self._tickers[product_id] = (ticker, received_at or time.time())
+
+    def clear(self):
+        self._tickers.clear()
+
+    def start(self):
+        """Start streaming in a background thread, unless it already is."""
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=asyncio.run, args=(self._run(),), daemon=True)
+                self._thread.start()
+
+        return self
+
+    def stop(self):
+        """Disconnect and stop streaming, i.e.: in tests. A stopped feed can't be started again."""
+
+        with self._lock:
+            self._stopped = True
+
+            if self._task is not None:
+                self._loop.call_soon_threadsafe(self._task.cancel)
+
+        if self._thread is not None:
+            self._thread.join()
+
+    async def _run(self):
+        with self._lock:
+            if self._stopped:
+                return
+
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.current_task()
+
+        attempt = 0
+
+        try:
+            while True:
+                try:
+                    await self._stream()
+                    attempt = 0
+
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError, KeyError) as e:
+                    print("coinbase ticker feed disconnected.", e)
+                    attempt += 1
+
+                # full jitter, so workers don't all reconnect at once
+                await asyncio.sleep(random.uniform(0, min(TICKER_RECONNECT_DELAY, 2 ** attempt)))
+
+        except asyncio.CancelledError:
+            pass
+
+    async def _stream(self):
+        loop = asyncio.get_running_loop()
+        product_ids = await loop.run_in_executor(None, lambda: get_catalog(self.api_url).product_ids)
+
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.feed_url, heartbeat=30) as ws:
+                await ws.send_json({"type": "subscribe", "product_ids": product_ids,
+                                    "channels": ["ticker"]})
+
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+
+                    data = message.json()
+
+                    if data.get("type") == 'ticker':
+                        self.put(data["product_id"], rest_ticker(data))
+
+                    elif data.get("type") == 'error':
+                        print("coinbase ticker feed error.", data.get("message"))
+
+
+# {api url: websocket feed url}
+feed_urls = {}
+
+# {api url: TickerFeed}
+_feeds = per_process(dict)
+_lock = threading.Lock()
+
+
+def register_feed(api_url, feed_url):
+    """Stream tickers for a Coinbase Pro API url from its websocket feed."""
+
+    feed_urls[api_url] = feed_url
+
+
+def get_feed(api_url):
+    """Get this worker process's running feed for an API url, or None if it has none.
+
+    Feeds are never shared across a fork, since their thread doesn't survive it."""
+
+    if not TICKER_FEED or api_url not in feed_urls:
+        return None
+
+    feeds = _feeds()
+
+    with _lock:
+        feed = feeds.get(api_url)
+
+        if feed is None:
+            feed = feeds[api_url] = TickerFeed(api_url, feed_urls[api_url])
+
+    return feed.start()
+
+
+def fresh_price(api_url, product_id):
+    """Get a product's last trade price from the feed if it is fresh, or None. Never calls out."""
+
+    feed = get_feed(api_url)
+    ticker = feed and feed.get(product_id)
+
+    try:
+        price = float(ticker["price"]) if ticker else None
+    except (KeyError, TypeError, ValueError):
+        price = None
+
+    metrics.record_cache('ticker', 'miss' if price is None else 'hit')
+
+    return price
+
+
+def get_ticker(api_url, product_id):
+    """Get a product's ticker from the feed, or from the REST endpoint if it isn't fresh."""
+
+    feed = get_feed(api_url)
+
+    if feed is not None:
+        ticker = feed.get(product_id)
+
+        if ticker is not None:
+            metrics.record_cache('ticker', 'hit')
+            return ticker
+
+    metrics.record_cache('ticker', 'miss')
+
+    response = client.get_shared(api_url + f"products/{product_id}/ticker")
+    data = response.json()
+
+    # until the feed catches up, the REST ticker is as good as a streamed one
+    if feed is not None and response.ok and data.get("price"):
+        feed.put(product_id, data)
+
+    return data
+
+
+def invalidate():
+    """Forget every ticker, i.e.: after the products or prices changed underneath us."""
+
+    with _lock:
+        for feed in _feeds().values():
+            feed.clear()
@@ -0,0 +1,201 @@
+"""Versioned schema migrations.
+
+db.create_all() only creates missing tables, so changes to existing tables are made by
+the numbered migrations below. Each runs in its own transaction and is recorded in
+schema_migrations, so running this again only applies the new ones:
+
+    python migrate.py
+
+A database made from scratch with db.create_all() (i.e.: by seed.py) already has the
+latest schema, and is stamped as migrated instead:
+
+    python migrate.py --stamp
+
+Every statement is written to be a no-op when its change is already there, so a
+migration is also safe to apply to a database that only partly has it.
+"""
+
+import argparse
+import copyreg
+import io
+import os
+import pickle
+
+from sqlalchemy import create_engine, text
+
+
+class LegacyAuth:
+    """Stands in for the CoinbaseExchangeAuth objects users.auth used to pickle.
+
+    Unpickling only restores their attributes, i.e.: api_key, secret_key and passphrase."""
+
+
+class LegacyAuthUnpickler(pickle.Unpickler):
+    """Unpickles users.auth without importing or running anything but LegacyAuth."""
+
+    # what older pickle protocols rebuild plain objects with
+    ALLOWED = {('copyreg', '_reconstructor'): copyreg._reconstructor,
+               ('builtins', 'object'): object}
+
+    def find_class(self, module, name):
+        if name == 'CoinbaseExchangeAuth':
+            return LegacyAuth
+
+        if (module, name) in self.ALLOWED:
+            return self.ALLOWED[module, name]
+
+        raise pickle.UnpicklingError(f"unexpected {module}.{name} in users.auth")
+
+
+def copy_pickled_credentials(connection):
+    """Copy the secret and passphrase of every pickled users.auth into cb_secret and cb_passphrase."""
+
+    has_auth = connection.execute(text("""SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'users' AND column_name = 'auth'""")).first()
+
+    if not has_auth:
+        return
+
+    rows = connection.execute(text(
+        "SELECT id, auth FROM users WHERE auth IS NOT NULL AND cb_secret IS NULL"))
+
+    for user_id, pickled in rows.fetchall():
+        try:
+            auth = LegacyAuthUnpickler(io.BytesIO(pickled)).load()
+            secret, passphrase = auth.secret_key, auth.passphrase
+        except (pickle.UnpicklingError, AttributeError, EOFError, TypeError, ValueError) as e:
+            # they can still log in again, which stores their credentials
+            print(f"could not read the pickled credentials of user {user_id}.", e)
+            continue
+
+        connection.execute(text("UPDATE users SET cb_secret = :secret, cb_passphrase = :passphrase "
+                                "WHERE id = :id"), secret=secret, passphrase=passphrase, id=user_id)
+
+
+# (version, description, statements), in the order they are applied; never edit one
+# that has shipped, add a new one instead. A statement is SQL, or a function that is
+# called with the migration's connection
+MIGRATIONS = [
+    (1, "refresh and activity timestamps, signing credentials as columns", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS accounts_refreshed_at TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_active_at TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS cb_secret VARCHAR",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS cb_passphrase VARCHAR",
+        # move the credentials out of the pickled auth objects before dropping them
+        copy_pickled_credentials,
+        "ALTER TABLE users DROP COLUMN IF EXISTS auth",
+    ]),
+    (2, "one combined credential hash", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS credential_hash VARCHAR",
+        "ALTER TABLE users ALTER COLUMN api_secret DROP NOT NULL",
+        "ALTER TABLE users ALTER COLUMN api_passphrase DROP NOT NULL",
+    ]),
+    (3, "portfolio history", [
+        """CREATE TABLE IF NOT EXISTS portfolio_snapshots (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            ts TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            currency VARCHAR NOT NULL,
+            balance_native FLOAT NOT NULL,
+            balance_usd FLOAT NOT NULL)""",
+        """CREATE INDEX IF NOT EXISTS portfolio_snapshots_user_id_ts_idx
+            ON portfolio_snapshots (user_id, ts)""",
+        """CREATE TABLE IF NOT EXISTS portfolio_rollups (
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            resolution INTEGER NOT NULL,
+            ts TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            currency VARCHAR NOT NULL,
+            balance_native FLOAT NOT NULL,
+            balance_usd FLOAT NOT NULL,
+            PRIMARY KEY (user_id, resolution, ts, currency))""",
+    ]),
+    (4, "snapshot versions", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS snapshot_version INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (5, "user_id indexes, and one account and target per user and currency", [
+        # drop the duplicates the unique keys would refuse. target_allocations ids are
+        # serial, so the latest target is kept
+        """DELETE FROM target_allocations a USING target_allocations b
+            WHERE a.user_id = b.user_id AND a.currency = b.currency AND a.id < b.id""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS target_allocations_user_id_currency_key
+            ON target_allocations (user_id, currency)""",
+        # accounts ids are Coinbase Pro UUIDs with nothing to say which is newer, so an
+        # arbitrary one is kept; the user's next refresh replaces it with the live account
+        """DELETE FROM accounts a USING accounts b
+            WHERE a.user_id = b.user_id AND a.currency = b.currency AND a.id < b.id""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS accounts_user_id_currency_key
+            ON accounts (user_id, currency)""",
+        # overlapping refreshes used to insert the same allocation twice; ids are serial,
+        # so the latest is kept, and the rows are rebuilt on the next refresh anyway
+        """DELETE FROM current_allocations a USING current_allocations b
+            WHERE a.user_id = b.user_id AND a.currency = b.currency AND a.id < b.id""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS current_allocations_user_id_currency_key
+            ON current_allocations (user_id, currency)""",
+        """CREATE INDEX IF NOT EXISTS ix_payment_methods_user_id
+            ON payment_methods (user_id)""",
+        """CREATE INDEX IF NOT EXISTS ix_deposits_user_id
+            ON deposits (user_id)""",
+    ]),
+]
+
+# arbitrary key for the advisory lock that keeps two deploys from migrating at once
+MIGRATION_LOCK = 7432101
+
+
+def applied_versions(connection):
+    connection.execute(text("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR NOT NULL,
+        applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))"""))
+
+    return {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def record(connection, version, description):
+    connection.execute(text("INSERT INTO schema_migrations (version, description) VALUES (:v, :d)"),
+                       v=version, d=description)
+
+
+def migrate(engine, stamp=False):
+    """Apply (or with stamp, only record) every migration the database doesn't have yet.
+
+    Returns the versions applied."""
+
+    applied = []
+
+    for version, description, statements in MIGRATIONS:
+        with engine.begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), key=MIGRATION_LOCK)
+
+            if version in applied_versions(connection):
+                continue
+
+            if not stamp:
+                for statement in statements:
+                    if callable(statement):
+                        statement(connection)
+                    else:
+                        connection.execute(text(statement))
+
+            record(connection, version, description)
+
+        applied.append(version)
+        print(f"{'stamped' if stamp else 'applied'} migration {version}: {description}")
+
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database-url', default=os.environ.get(
+        "DATABASE_URL", 'postgresql:///cfinance'))
+    parser.add_argument('--stamp', action='store_true',
+                        help="record every migration as applied without running it")
+    args = parser.parse_args()
+
+    if not migrate(create_engine(args.database_url), args.stamp):
+        print("already up to date.")
+
+
+if __name__ == '__main__':
+    main()
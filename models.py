@@ -9,12 +9,20 @@ import requests
 import base64
 from requests.auth import AuthBase
 from binascii import Error
+from collections import namedtuple
+
+from helpers import client
+from helpers.credentials import hash_credentials, check_credentials, needs_rehash, off_thread
 
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+# a user's Coinbase Pro credentials, i.e.: Credentials("key", "c2VjcmV0", "passphrase")
+Credentials = namedtuple('Credentials', ['api_key', 'secret', 'passphrase'])
+
+
 class User(db.Model):
     """User."""
 
@@ -26,10 +34,15 @@ class User(db.Model):
     api_key = db.Column(db.String,
                         nullable=False, unique=True)
 
+    # one salted hash of the secret and passphrase together, see helpers/credentials.py
+    credential_hash = db.Column(db.String, nullable=True)
+
+    # separate hashes of the secret and passphrase, from before credential_hash;
+    # cleared once the user logs in and gets a credential_hash
     api_secret = db.Column(db.String,
-                           nullable=False)
+                           nullable=True)
 
-    api_passphrase = db.Column(db.String, nullable=False)
+    api_passphrase = db.Column(db.String, nullable=True)
 
     accounts = db.relationship('Account',
                                backref='user')
@@ -43,21 +56,43 @@ class User(db.Model):
     current_allocations = db.relationship('CurrentAllocation',
                                           backref='user')
 
-    auth = db.Column(db.PickleType(), nullable=True)
+    # the Coinbase Pro secret and passphrase requests are signed with, since api_secret
+    # and api_passphrase only hold their hashes
+    cb_secret = db.Column(db.String, nullable=True)
+
+    cb_passphrase = db.Column(db.String, nullable=True)
+
+    # bumped whenever the user's stored accounts change, to key what's derived from them
+    snapshot_version = db.Column(db.Integer, nullable=False,
+                                 default=0, server_default='0')
+
+    # when accounts and current allocations were last refreshed from Coinbase Pro
+    accounts_refreshed_at = db.Column(db.DateTime, nullable=True)
+
+    # last time the user loaded a page, used by the background refresh scheduler
+    last_active_at = db.Column(db.DateTime, nullable=True)
 
     # try to initialize the user with an attribute holding the coinbase pro authentication
-    def __init__(self, api_key, api_secret, api_passphrase):
+    def __init__(self, api_key, credential_hash):
         self.api_key = api_key
-        self.api_secret = api_secret
-        self.api_passphrase = api_passphrase
+        self.credential_hash = credential_hash
 
     def __repr__(self):
         return f"<User #{self.id}: {self.api_key}>"
 
-    def set_auth(self, api_key, api_secret, api_passphrase):
-        cb_auth = CoinbaseExchangeAuth(api_key, api_secret, api_passphrase)
+    @property
+    def credentials(self):
+        """The user's Credentials, or None if they haven't stored any."""
 
-        self.auth = cb_auth
+        if self.cb_secret is None:
+            return None
+
+        return Credentials(self.api_key, self.cb_secret, self.cb_passphrase)
+
+    def set_auth(self, api_key, api_secret, api_passphrase):
+        self.api_key = api_key
+        self.cb_secret = api_secret
+        self.cb_passphrase = api_passphrase
 
     @classmethod
     def signup(cls, api_key, api_secret, api_passphrase):
@@ -66,26 +101,27 @@ class User(db.Model):
         First must check that the credentials provided actually exist in Coinbase and are
         authenticated with the custom Coinbase auth class.
 
-        Then we hash api_key, secret, and passphrase and add user to system.
+        Then we hash the secret and passphrase together and add user to system.
         """
 
-        coinbase_auth = CoinbaseExchangeAuth(
-            api_key, api_secret, api_passphrase)
+        try:
+            coinbase_auth = CoinbaseExchangeAuth(
+                api_key, api_secret, api_passphrase)
+        except Error:
+            # the secret isn't base64, so it can't be a Coinbase Pro secret
+            return False
 
         # test the auth to see if valid user exists in CBP
         is_auth = CoinbaseExchangeAuth.test_auth(coinbase_auth)
 
         if is_auth:
 
-            hashed_secret = bcrypt.generate_password_hash(
-                api_secret).decode('UTF-8')
-            hashed_passphrase = bcrypt.generate_password_hash(
-                api_passphrase).decode('UTF-8')
+            credential_hash = off_thread(
+                hash_credentials, api_secret, api_passphrase)
 
             user = User(
                 api_key=api_key,
-                api_secret=hashed_secret,
-                api_passphrase=hashed_passphrase
+                credential_hash=credential_hash
             )
 
             db.session.add(user)
@@ -106,24 +142,47 @@ class User(db.Model):
 
         user = cls.query.filter_by(api_key=api_key).first()
 
-        if user:
+        if not user:
+            return False
 
-            is_auth_api_secret = bcrypt.check_password_hash(
-                user.api_secret, api_secret)
-            is_auth_api_passphrase = bcrypt.check_password_hash(
-                user.api_passphrase, api_passphrase)
+        if user.credential_hash:
+            is_auth = off_thread(check_credentials,
+                                 user.credential_hash, api_secret, api_passphrase)
+        else:
+            is_auth = off_thread(user.check_legacy_hashes,
+                                 api_secret, api_passphrase)
 
-            if is_auth_api_secret and is_auth_api_passphrase:
+        if not is_auth:
+            return False
 
-                return user
+        # move the user to one hash with the current work factor while we have the plain
+        # credentials at hand; the caller commits it
+        if not user.credential_hash or needs_rehash(user.credential_hash):
+            user.credential_hash = off_thread(
+                hash_credentials, api_secret, api_passphrase)
+            user.api_secret = None
+            user.api_passphrase = None
 
-        return False
+        return user
+
+    def check_legacy_hashes(self, api_secret, api_passphrase):
+        """Check the separate secret and passphrase hashes of users from before credential_hash."""
+
+        if not self.api_secret or not self.api_passphrase:
+            return False
+
+        return (bcrypt.check_password_hash(self.api_secret, api_secret) and
+                bcrypt.check_password_hash(self.api_passphrase, api_passphrase))
 
 
 class Account(db.Model):
     """Accounts for the user in coinbase, related to how much balance/funding they have for each currency."""
 
     __tablename__ = "accounts"
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'currency',
+                            name='accounts_user_id_currency_key'),
+    )
 
     id = db.Column(db.String,
                    primary_key=True)
@@ -162,6 +221,7 @@ class PaymentMethod(db.Model):
         db.Integer,
         db.ForeignKey('users.id'),
         nullable=False,
+        index=True,
     )
 
 
@@ -191,6 +251,7 @@ class Deposit(db.Model):
         db.Integer,
         db.ForeignKey('users.id'),
         nullable=False,
+        index=True,
     )
 
     user = db.relationship('User')
@@ -210,6 +271,10 @@ class TargetAllocation(db.Model):
     """Target allocation percentages per currency for a user."""
 
     __tablename__ = "target_allocations"
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'currency',
+                            name='target_allocations_user_id_currency_key'),
+    )
 
     id = db.Column(db.Integer,
                    primary_key=True)
@@ -231,6 +296,10 @@ class CurrentAllocation(db.Model):
     """Current allocation percentages per currency for a user."""
 
     __tablename__ = "current_allocations"
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'currency',
+                            name='current_allocations_user_id_currency_key'),
+    )
 
     id = db.Column(db.Integer,
                    primary_key=True)
@@ -247,44 +316,114 @@ class CurrentAllocation(db.Model):
         nullable=False,
     )
 
+
+class PortfolioSnapshot(db.Model):
+    """A user's balance in one currency at one point in time, see helpers/history.py."""
+
+    __tablename__ = "portfolio_snapshots"
+    __table_args__ = (
+        db.Index('portfolio_snapshots_user_id_ts_idx', 'user_id', 'ts'),
+    )
+
+    id = db.Column(db.Integer,
+                   primary_key=True)
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id'),
+        nullable=False,
+    )
+
+    ts = db.Column(db.DateTime, nullable=False)
+
+    currency = db.Column(db.String,
+                         nullable=False)
+
+    balance_native = db.Column(db.Float,
+                               nullable=False)
+
+    balance_usd = db.Column(db.Float,
+                            nullable=False)
+
+
+class PortfolioRollup(db.Model):
+    """A user's last balance in one currency within an hour, day or week (resolution, in seconds)."""
+
+    __tablename__ = "portfolio_rollups"
+
+    # primary key in (user_id, resolution, ts) order, so range queries are index scans
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id'),
+        primary_key=True,
+    )
+
+    resolution = db.Column(db.Integer,
+                           primary_key=True)
+
+    ts = db.Column(db.DateTime,
+                   primary_key=True)
+
+    currency = db.Column(db.String,
+                         primary_key=True)
+
+    balance_native = db.Column(db.Float,
+                               nullable=False)
+
+    balance_usd = db.Column(db.Float,
+                            nullable=False)
+
+
 # Create custom authentication for Exchange
 
 
 class CoinbaseExchangeAuth(AuthBase):
+    """Signs requests with a user's Coinbase Pro credentials.
+
+    The secret is decoded once, when the signer is created. Raises binascii.Error if it
+    isn't base64."""
+
     def __init__(self, api_key, secret_key, passphrase):
         self.api_key = api_key
-        self.secret_key = secret_key
+        self.hmac_key = base64.b64decode(secret_key)
         self.passphrase = passphrase
 
+    def __repr__(self):
+        return f"<CoinbaseExchangeAuth {self.api_key}>"
+
     def __call__(self, request):
+        request.headers.update(self.headers(
+            request.method, request.path_url, request.body))
+        return request
+
+    def headers(self, method, path_url, body=None):
+        """Get the signed Coinbase Pro headers for a request (also used by the async client)."""
+
         timestamp = str(time.time())
-        message = timestamp + request.method + \
-            request.path_url + (request.body or '')
-        hmac_key = base64.b64decode(self.secret_key)
-        signature = hmac.new(hmac_key, message.encode(), hashlib.sha256)
+        message = timestamp + method + path_url + (body or '')
+        signature = hmac.new(self.hmac_key, message.encode(), hashlib.sha256)
         signature_b64 = base64.b64encode(signature.digest()).decode()
 
-        request.headers.update({
+        return {
             'CB-ACCESS-SIGN': signature_b64,
             'CB-ACCESS-TIMESTAMP': timestamp,
             'CB-ACCESS-KEY': self.api_key,
             'CB-ACCESS-PASSPHRASE': self.passphrase,
             'Content-Type': 'application/json'
-        })
-        return request
+        }
 
     @classmethod
     def test_auth(cls, auth):
         """Test the auth with an API call to validate that a user exists in Coinbase Pro."""
         try:
-            r = requests.get(g.api_url + 'accounts', auth=auth)
+            r = client.get(g.api_url + 'accounts', auth=auth)
             data = r.json()
 
             # check that the first account has an Id, signifying that it exists
             if data and r.status_code == 200:
                 return True
 
-        except Error:
+        except (Error, requests.RequestException):
             return False
 
         return False
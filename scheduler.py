@@ -0,0 +1,125 @@
+"""Background refresh scheduler.
+
+Keeps the Account and CurrentAllocation snapshots of recently active users fresh, so
+web workers can serve dashboards from Postgres without calling Coinbase Pro or CoinGecko.
+Runs as its own process (the "scheduler" line in Procfile):
+
+    python scheduler.py
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from app import app, demo_signer, CB_API_URL, CB_DEMO_API_URL, DEMO_API_KEY
+from models import db, User
+from helpers.snapshots import refresh_in_context, SNAPSHOT_FRESH_AGE
+from helpers.signers import get_signer
+
+
+# users who loaded a page within this window are kept fresh
+ACTIVE_USER_WINDOW = int(os.environ.get("ACTIVE_USER_WINDOW", 30 * 60))
+
+# target snapshot age, kept under SNAPSHOT_FRESH_AGE so web workers never refresh
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", SNAPSHOT_FRESH_AGE * 2 // 3))
+
+# each user's refresh is brought forward by up to this many seconds, so users who
+# became active together drift apart instead of refreshing in bursts
+REFRESH_STAGGER = float(os.environ.get(
+    "REFRESH_STAGGER", REFRESH_INTERVAL / 4))
+
+SCHEDULER_TICK = float(os.environ.get("SCHEDULER_TICK", 1))
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 4))
+
+
+def stagger(user_id):
+    """Spread users evenly over [0, REFRESH_STAGGER) by their id."""
+
+    return (user_id * 0.618033988749895) % 1 * REFRESH_STAGGER
+
+
+def is_due(user, now):
+    if user.accounts_refreshed_at is None:
+        return True
+
+    age = (now - user.accounts_refreshed_at).total_seconds()
+
+    return age >= REFRESH_INTERVAL - stagger(user.id)
+
+
+def refresh_args(user):
+    """Get the (auth, api_url, demo) to refresh a user with, or None if they have no creds."""
+
+    if user.api_key == DEMO_API_KEY:
+        return demo_signer(), CB_DEMO_API_URL, True
+
+    auth = get_signer(user.id, user.credentials)
+
+    if auth is None:
+        return None
+
+    return auth, CB_API_URL, False
+
+
+class Scheduler:
+    """Submits due refreshes for active users to a worker pool, one in flight per user."""
+
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def due_users(self):
+        now = datetime.utcnow()
+        active_since = now - timedelta(seconds=ACTIVE_USER_WINDOW)
+
+        users = User.query.filter(User.last_active_at >= active_since).all()
+
+        with self._lock:
+            return [user for user in users if user.id not in self._in_flight and is_due(user, now)]
+
+    def submit(self, user):
+        args = refresh_args(user)
+
+        if args is None:
+            return
+
+        with self._lock:
+            self._in_flight.add(user.id)
+
+        future = self.pool.submit(refresh_in_context, app, user.id, *args)
+        future.add_done_callback(lambda f, user_id=user.id: self._done(user_id))
+
+    def _done(self, user_id):
+        with self._lock:
+            self._in_flight.discard(user_id)
+
+    def tick(self):
+        with app.app_context():
+            for user in self.due_users():
+                self.submit(user)
+
+            # don't hold a connection between ticks
+            db.session.remove()
+
+    def run(self):
+        print(f"refreshing active users every {REFRESH_INTERVAL}s "
+              f"with {self.workers} workers.")
+
+        while True:
+            started = time.time()
+
+            try:
+                self.tick()
+            except Exception as e:
+                print("scheduler tick failed.", e)
+
+            time.sleep(max(0, SCHEDULER_TICK - (time.time() - started)))
+
+
+if __name__ == '__main__':
+    Scheduler().run()
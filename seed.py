@@ -2,7 +2,11 @@
 
 from models import db, User
 from app import app
+from migrate import migrate
 
 # Create all tables
 db.drop_all()
 db.create_all()
+
+# they already have the latest schema
+migrate(db.engine, stamp=True)
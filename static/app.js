@@ -2,6 +2,8 @@ $(function () {
   const $portfolioTableRow = $(".portfolio-table-row");
   const $currencyInfo = $(".currency-info");
   const $portfolioPieChart = $("#portfolio-pie-chart");
+  const $portfolioHistoryChart = $("#portfolio-history-chart");
+  const $portfolioHistoryRanges = $(".portfolio-history-range");
   const $portfolioPctTotal = $("#portfolio-pct-total");
   const $portfolioPctInputs = $(".portfolio-pct-input");
   const $arrows = $(".fas.fa-caret-up, .fas.fa-caret-down");
@@ -10,14 +12,20 @@ $(function () {
 
   /** dashboard */
   // get pct of portfolio for each currency for pie chart
+  // embedded in the dashboard, otherwise fetched (and revalidated with its ETag)
   async function portfolioAllocationPcts() {
-    const { data } = await axios.get(`/api/users/portfolio_pcts`);
+    const $embedded = $("#portfolio-pcts-data");
+    const data = $embedded.length
+      ? JSON.parse($embedded.text())
+      : (await axios.get(`/api/users/portfolio_pcts`)).data;
     const filteredData = _.pickBy(data, (x) => x !== 0);
     return filteredData;
   }
 
-  // append pie chart to dom
+  // append pie chart to dom, on the pages that have one
   (async () => {
+    if (!$portfolioPieChart.length) return;
+
     let data = await portfolioAllocationPcts();
     const labels = Object.keys(data);
     const datasets = [
@@ -81,6 +89,75 @@ $(function () {
     });
   })();
 
+  // get total balance over the last `range` seconds for the history chart
+  async function portfolioHistory(range) {
+    const end = Date.now() / 1000;
+    const { data } = await axios.get(`/api/users/portfolio_history`, {
+      params: { start: end - range, end: end },
+    });
+    return data;
+  }
+
+  // draw the history chart, and redraw it when another range is picked
+  let historyChart = null;
+
+  async function showPortfolioHistory(range) {
+    const { resolution, points } = await portfolioHistory(range);
+
+    // times of day for short ranges, dates for anything at daily resolution
+    const labels = points.map((point) => {
+      const date = new Date(point.ts);
+      return resolution >= 86400
+        ? date.toLocaleDateString()
+        : date.toLocaleString([], {
+            month: "short",
+            day: "numeric",
+            hour: "2-digit",
+            minute: "2-digit",
+          });
+    });
+
+    const data = {
+      labels: labels,
+      datasets: [
+        {
+          label: "Total Balance USD",
+          data: points.map((point) => point.total),
+          borderColor: "rgba(114, 124, 255, 0.85)",
+          backgroundColor: "rgba(114, 124, 255, 0.1)",
+          pointRadius: 0,
+          lineTension: 0,
+        },
+      ],
+    };
+
+    if (historyChart) {
+      historyChart.data = data;
+      historyChart.update();
+      return;
+    }
+
+    historyChart = new Chart($portfolioHistoryChart, {
+      type: "line",
+      data: data,
+      options: {
+        legend: false,
+        tooltips: { mode: "index", intersect: false, displayColors: false },
+        scales: { xAxes: [{ ticks: { maxTicksLimit: 8 } }] },
+      },
+    });
+  }
+
+  if ($portfolioHistoryChart.length) {
+    showPortfolioHistory($portfolioHistoryRanges.filter(".active").data("range"));
+  }
+
+  $portfolioHistoryRanges.on("click", function () {
+    $portfolioHistoryRanges.removeClass("active");
+    $(this).addClass("active");
+    showPortfolioHistory($(this).data("range"));
+  });
+
   /** rebalance route */
 
   function handlePctInputChange() {
@@ -0,0 +1,128 @@
+"""Tests for the token buckets in helpers/ratelimit.py, on a clock the tests move by hand."""
+
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from helpers.ratelimit import TokenBucket, AdaptiveTokenBucket, RateLimited, parse_retry_after, \
+    MIN_RATE_FRACTION, RECOVERY_FRACTION
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_a_full_bucket_allows_a_burst_then_queues_callers():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, burst=4, clock=clock)
+
+    assert [bucket.reserve() for i in range(4)] == [0, 0, 0, 0]
+
+    # each caller waits behind the ones before it
+    assert bucket.reserve() == .5
+    assert bucket.reserve() == 1
+
+
+def test_tokens_refill_at_the_rate_up_to_the_burst():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, burst=4, clock=clock)
+
+    for i in range(4):
+        bucket.reserve()
+
+    clock.advance(1)
+
+    assert [bucket.reserve() for i in range(2)] == [0, 0]
+    assert bucket.reserve() == .5
+
+    clock.advance(60)
+
+    assert [bucket.reserve() for i in range(4)] == [0, 0, 0, 0]
+    assert bucket.reserve() == .5
+
+
+def test_a_wait_over_max_wait_is_rate_limited_without_taking_a_token():
+    clock = Clock()
+    bucket = TokenBucket(rate=1, burst=1, clock=clock, name='api.example.com')
+
+    bucket.reserve()
+
+    with pytest.raises(RateLimited) as e:
+        bucket.reserve(max_wait=.5)
+
+    assert e.value.host == 'api.example.com'
+    assert e.value.retry_after == 1
+
+    # the next token is still a second away, not two
+    assert bucket.reserve(max_wait=1) == 1
+
+
+def test_throttling_halves_the_rate_down_to_a_floor():
+    bucket = AdaptiveTokenBucket(rate=10, burst=10, clock=Clock())
+
+    bucket.throttle()
+    assert bucket.rate == 5
+
+    for i in range(10):
+        bucket.throttle()
+
+    assert bucket.rate == 10 * MIN_RATE_FRACTION
+
+
+def test_throttling_empties_the_bucket_and_honors_retry_after():
+    clock = Clock()
+    bucket = AdaptiveTokenBucket(rate=10, burst=10, clock=clock)
+
+    bucket.throttle(retry_after=3)
+
+    assert bucket.reserve() == 3
+
+    clock.advance(3)
+
+    # blocked no longer, and the bucket refilled at the halved rate meanwhile
+    assert [bucket.reserve() for i in range(10)] == [0] * 10
+    assert bucket.reserve() == pytest.approx(1 / 5)
+
+
+def test_calls_that_arent_throttled_recover_the_rate():
+    bucket = AdaptiveTokenBucket(rate=10, burst=10, clock=Clock())
+
+    bucket.throttle()
+    bucket.succeed()
+
+    assert bucket.rate == pytest.approx(5 + 10 * RECOVERY_FRACTION)
+
+    for i in range(100):
+        bucket.succeed()
+
+    assert bucket.rate == 10
+
+
+def test_retry_after_in_seconds():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('1.5') == 1.5
+    assert parse_retry_after('-5') == 0
+
+
+def test_retry_after_as_an_http_date():
+    now = datetime(2020, 6, 1, 10, 0, tzinfo=timezone.utc).timestamp()
+
+    assert parse_retry_after('Mon, 01 Jun 2020 10:01:30 GMT', now=now) == 90
+
+    # a date that already passed means no wait
+    assert parse_retry_after(format_datetime(datetime(2020, 6, 1, 9, 0, tzinfo=timezone.utc), usegmt=True),
+                             now=now) == 0
+
+
+def test_retry_after_that_cant_be_parsed():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('') is None
+    assert parse_retry_after('soon') is None
@@ -0,0 +1,164 @@
+"""Tests for the I/O-free rebalance planner in helpers/rebalance.py."""
+
+import math
+import warnings
+
+from helpers.rebalance import plan_rebalance, order_stages, project_order, project_conversion
+
+
+def plan(portfolio, **kwargs):
+    """Plan a portfolio given as {currency: (ticker, balance, target, usd price)}, quoted in USD.
+
+    Funds for buys are whatever USD the portfolio holds."""
+
+    currencies = list(portfolio)
+    usd = portfolio.get('USD', (None, 0, 0, 1))[1]
+
+    return plan_rebalance(
+        currencies=currencies,
+        tickers=[portfolio[c][0] for c in currencies],
+        balances=[portfolio[c][1] for c in currencies],
+        targets=[portfolio[c][2] for c in currencies],
+        usd_prices=[portfolio[c][3] for c in currencies],
+        quote_usd_prices=[1 for c in currencies],
+        available=[portfolio[c][1] if c == 'USD' else usd for c in currencies],
+        **kwargs)
+
+
+def test_sells_go_in_the_first_stage_and_buys_in_the_second():
+    result = plan({
+        "ETH": ('ETH-USD', 10, .4, 200),
+        "BTC": ('BTC-USD', 1, .5, 9000),
+        "USD": ('USD', 1000, .1, 1),
+    })
+
+    assert result.orders == [{"side": "sell", "product_id": 'BTC-USD', "funds": 3000.0},
+                             {"side": "buy", "product_id": 'ETH-USD', "funds": 1000.0}]
+
+    assert order_stages(result) == [[("order", 0)], [("order", 1)]]
+
+
+def test_assets_within_the_threshold_are_left_alone():
+    result = plan({
+        "BTC": ('BTC-USD', 5020 / 9000, .5, 9000),
+        "ETH": ('ETH-USD', 4980 / 200, .5, 200),
+    })
+
+    assert result.orders == []
+    assert result.converged
+
+
+def test_only_assets_off_target_are_traded():
+    result = plan({
+        "BTC": ('BTC-USD', 1, .4, 9000),
+        "ETH": ('ETH-USD', 4980 / 200, .25, 200),
+        "USD": ('USD', 6000, .35, 1),
+    })
+
+    assert [order["product_id"] for order in result.orders] == ['BTC-USD']
+
+
+def test_a_target_with_no_balance_is_bought():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+
+        result = plan({
+            "BTC": ('BTC-USD', 1, .5, 9000),
+            "ETH": ('ETH-USD', 0, .25, 200),
+            "USD": ('USD', 4500, .25, 1),
+        })
+
+    assert result.orders == [{"side": "sell", "product_id": 'BTC-USD', "funds": 2250.0},
+                             {"side": "buy", "product_id": 'ETH-USD', "funds": 3375.0}]
+    assert result.conversions == []
+
+
+def test_buys_never_spend_more_than_is_available():
+    result = plan({
+        "BTC": ('BTC-USD', 0, .5, 9000),
+        "USD": ('USD', 100.009, .5, 1),
+    })
+
+    assert result.orders == [{"side": "buy", "product_id": 'BTC-USD', "funds": 50.0}]
+
+    result = plan({
+        "BTC": ('BTC-USD', 0, 1, 9000),
+        "USD": ('USD', 100.009, 0, 1),
+    })
+
+    assert result.orders == [{"side": "buy", "product_id": 'BTC-USD', "funds": 100.0}]
+
+
+def test_overweight_cash_is_converted_to_an_underweight_stablecoin():
+    balances = {"USD": 1000, "USDC": 0}
+
+    def plan_balances():
+        return plan({"USD": ('USD', balances["USD"], .5, 1),
+                     "USDC": ('USDC', balances["USDC"], .5, 1)})
+
+    result = plan_balances()
+
+    assert result.orders == []
+    assert result.conversions == [{"from": 'USD', "to": 'USDC', "amount": 500.0}]
+
+    project_conversion(balances, result.conversions[0], {"id": 'conversion-1'})
+
+    # and isn't converted back once both are on target
+    result = plan_balances()
+
+    assert result.conversions == []
+    assert result.converged
+
+
+def test_cash_isnt_converted_to_a_stablecoin_that_is_on_target():
+    result = plan({
+        "USD": ('USD', 600, .2, 1),
+        "USDC": ('USDC', 400, .2, 1),
+        "BTC": ('BTC-USD', 1, .6, 1000),
+    })
+
+    assert result.conversions == []
+    assert result.orders == [{"side": "buy", "product_id": 'BTC-USD', "funds": 200.0}]
+
+
+def test_unconfirmed_projections_are_unknown():
+    balances = {"BTC": 1, "USD": 100}
+    order = {"side": "buy", "product_id": 'BTC-USD', "funds": 50.0}
+    conversion = {"from": 'USD', "to": 'USDC', "amount": 50.0}
+    unconfirmed = {"message": "no response from Coinbase Pro.", "unconfirmed": True}
+
+    assert project_order(balances, order, unconfirmed, {"BTC": 9000, "USD": 1}) == math.inf
+    assert project_conversion(balances, conversion, unconfirmed) == math.inf
+
+    # a pending order can't be estimated without prices either
+    assert project_order(balances, order, {"id": 'order-1'}, {}) == math.inf
+
+    assert balances == {"BTC": 1, "USD": 100}
+
+
+def test_rejected_orders_arent_projected():
+    balances = {"BTC": 1, "USD": 100}
+    order = {"side": "buy", "product_id": 'BTC-USD', "funds": 50.0}
+
+    assert project_order(balances, order, {"message": "Insufficient funds"},
+                         {"BTC": 9000, "USD": 1}) is None
+    assert balances == {"BTC": 1, "USD": 100}
+
+
+def test_pending_and_settled_orders_are_projected():
+    balances = {"BTC": 1, "USD": 100}
+    prices = {"BTC": 10000, "USD": 1}
+
+    pending = project_order(balances, {"side": "buy", "product_id": 'BTC-USD', "funds": 50.0},
+                            {"id": 'order-1'}, prices)
+
+    assert pending == 50
+    assert balances == {"BTC": 1.005, "USD": 50}
+
+    settled = project_order(balances, {"side": "sell", "product_id": 'BTC-USD', "funds": 20.0},
+                            {"id": 'order-2', "settled": True, "filled_size": '.002',
+                             "executed_value": '20', "fill_fees": '.1'}, prices)
+
+    assert settled == 0
+    assert math.isclose(balances["BTC"], 1.003)
+    assert math.isclose(balances["USD"], 69.9)
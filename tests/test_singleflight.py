@@ -0,0 +1,112 @@
+"""Tests for coalescing concurrent calls in helpers/singleflight.py."""
+
+import threading
+
+import pytest
+
+from helpers.singleflight import SingleFlight
+
+
+def call_concurrently(flight, key, function, callers=5):
+    """Call flight.do(key, ...) from several threads at once.
+
+    function(everyone_joined) gets the function to call, given an Event that is set once
+    every caller has joined the call. Returns ([results], [errors])."""
+
+    results = []
+    errors = []
+    joined = threading.Semaphore(0)
+    everyone_joined = threading.Event()
+
+    join = flight._join
+
+    def counting_join(*args):
+        result = join(*args)
+        joined.release()
+        return result
+
+    flight._join = counting_join
+
+    def caller():
+        try:
+            results.append(flight.do(key, function(everyone_joined)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=caller) for i in range(callers)]
+
+    for thread in threads:
+        thread.start()
+
+    for i in range(callers):
+        assert joined.acquire(timeout=5)
+
+    everyone_joined.set()
+
+    for thread in threads:
+        thread.join(5)
+
+    flight._join = join
+
+    return results, errors
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    def function(everyone_joined):
+        def call():
+            calls.append(1)
+            everyone_joined.wait(5)
+            return 'result'
+
+        return call
+
+    results, errors = call_concurrently(flight, 'key', function)
+
+    assert calls == [1]
+    assert results == ['result'] * 5
+    assert errors == []
+
+
+def test_an_error_reaches_every_waiting_caller():
+    flight = SingleFlight()
+    error = ValueError("no response")
+
+    def function(everyone_joined):
+        def call():
+            everyone_joined.wait(5)
+            raise error
+
+        return call
+
+    results, errors = call_concurrently(flight, 'key', function)
+
+    assert results == []
+    assert errors == [error] * 5
+
+
+def test_a_failed_call_isnt_shared_afterwards():
+    flight = SingleFlight(max_age=60)
+
+    def fail():
+        raise ValueError("no response")
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+
+    assert 'key' not in flight._calls
+
+    # the next caller calls again, and its result is shared as usual
+    assert flight.do('key', lambda: 'result') == 'result'
+    assert flight.do('key', fail) == 'result'
+
+
+def test_clear_forgets_finished_calls():
+    flight = SingleFlight(max_age=60)
+
+    flight.do('key', lambda: 'first')
+    flight.clear()
+
+    assert flight.do('key', lambda: 'second') == 'second'
@@ -0,0 +1,114 @@
+"""Tests for the websocket ticker feed in helpers/ticker.py, against the stand-in's feed."""
+
+import asyncio
+import time
+
+import pytest
+
+from bench.standin import StandInServer, StandInConfig
+from helpers import catalog, ticker
+from helpers.singleflight import flight
+
+
+@pytest.fixture
+def server():
+    with StandInServer(StandInConfig(assets=3, ticker_interval=.05)) as server:
+        yield server
+
+    catalog.invalidate(server.url + 'coinbase/')
+
+
+@pytest.fixture
+def start_feed(server):
+    """Get a function that starts a TickerFeed for the stand-in. Every feed is stopped after the test."""
+
+    feeds = []
+
+    def start_feed(feed=None):
+        feed = feed or ticker.TickerFeed(server.url + 'coinbase/', server.feed.url)
+        feeds.append(feed)
+
+        return feed.start()
+
+    yield start_feed
+
+    for feed in feeds:
+        feed.stop()
+
+
+def wait_for(condition, timeout=5):
+    """Poll condition() until it is true, failing the test after timeout seconds."""
+
+    deadline = time.time() + timeout
+
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(.01)
+
+
+def disconnect(feed_server):
+    """Close every websocket the stand-in's feed has open, as Coinbase Pro does now and then."""
+
+    async def close():
+        for ws in list(feed_server._sockets):
+            await ws.close()
+
+    asyncio.run_coroutine_threadsafe(close(), feed_server._loop).result()
+
+
+def test_the_feed_subscribes_to_every_product(server, start_feed):
+    feed = start_feed()
+
+    wait_for(lambda: all(feed.get(product_id) for product_id in server.market.products))
+
+    assert feed.get('BTC-USD')["price"] == str(server.market.price('BTC-USD'))
+    assert server.market.calls['coinbase_feed'] == 1
+
+
+def test_the_feed_reconnects_after_a_disconnect(server, start_feed):
+    feed = start_feed()
+
+    wait_for(lambda: feed.get('BTC-USD'))
+
+    disconnect(server.feed)
+    server.market.prices['BTC'] = 10000.0
+    feed.clear()
+
+    # the old connection was closed before the price changed, so this is the new one
+    wait_for(lambda: (feed.get('BTC-USD') or {}).get("price") == '10000.0')
+
+    assert server.market.calls['coinbase_feed'] == 2
+
+
+def test_stale_tickers_fall_back_to_the_rest_endpoint(server, start_feed):
+    api_url = server.url + 'coinbase/'
+
+    # the feed sends one round of tickers on subscribing, then none for a minute
+    server.reset(StandInConfig(assets=3, ticker_interval=60))
+    ticker.register_feed(api_url, server.feed.url)
+
+    feed = start_feed(ticker.get_feed(api_url))
+    feed.max_age = .5
+
+    wait_for(lambda: feed.get('BTC-USD'))
+
+    calls = server.market.calls['coinbase']
+
+    assert ticker.fresh_price(api_url, 'BTC-USD') == 9000.0
+    assert ticker.get_ticker(api_url, 'BTC-USD')["price"] == '9000.0'
+    assert server.market.calls['coinbase'] == calls
+
+    wait_for(lambda: feed.get('BTC-USD') is None)
+
+    assert ticker.fresh_price(api_url, 'BTC-USD') is None
+
+    flight.clear()
+    server.market.prices['BTC'] = 10000.0
+
+    assert ticker.get_ticker(api_url, 'BTC-USD')["price"] == '10000.0'
+    assert server.market.calls['coinbase'] == calls + 1
+
+    # and the REST ticker is served from the feed until it is stale in turn
+    assert ticker.fresh_price(api_url, 'BTC-USD') == 10000.0
+
+    del ticker.feed_urls[api_url]